@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
 from flask import current_app
 from bson import ObjectId
+from services.revenue_rollup import CONSUMER_NAME as REVENUE_CONSUMER
+from services.status_keys import status_key_group, status_key_match
 
 
 def _date_filter(from_date, to_date):
@@ -74,33 +76,69 @@ def get_recent_users(limit=5, role=None):
     return users
 
 
+REVENUE_STATUSES = ("confirmed", "delivered")
+
+
+def _revenue_days(db, from_date, to_date, day_range):
+    """revenue_daily documents, or the same shape aggregated from orders until the main backend has built it."""
+    checkpoint = db.outbox_checkpoints.find_one({"_id": REVENUE_CONSUMER}, {"lastSeq": 1, "rebuildRequested": 1})
+    if checkpoint and checkpoint.get("lastSeq") is not None and not checkpoint.get("rebuildRequested"):
+        query = {"_id": day_range} if day_range else {}
+        return list(db.revenue_daily.find(query, {"byStatus": 1}).sort("_id", 1))
+    match = status_key_match(db, REVENUE_STATUSES)
+    match.update(_date_filter(from_date, to_date))
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}}, "status": status_key_group(db)},
+            "revenue": {"$sum": {"$ifNull": ["$total", 0]}},
+            "orders": {"$sum": 1},
+        }},
+    ]
+    rows = [{**row["_id"], "count": row["orders"], "revenue": row["revenue"]} for row in db.orders.aggregate(pipeline)]
+    archived = {"status": {"$in": list(REVENUE_STATUSES)}}
+    if day_range:
+        archived["day"] = day_range
+    rows += list(db.orders_archive_rollups.find(archived))
+    days = {}
+    for row in rows:
+        entry = days.setdefault(row["day"], {"_id": row["day"], "byStatus": {}})["byStatus"].setdefault(
+            row["status"], {"orders": 0, "revenue": 0}
+        )
+        entry["orders"] += row.get("count", 0)
+        entry["revenue"] += row.get("revenue", 0)
+    return [days[day] for day in sorted(days)]
+
+
 def get_revenue(range_days=7, from_date=None, to_date=None, group_by="day"):
+    """Revenue per day (or month) from the revenue_daily rollups maintained by the main backend."""
     db = current_app.mongo_db
     if not from_date and not to_date:
         to_date = datetime.utcnow()
         from_date = to_date - timedelta(days=range_days)
-    match = {"status": {"$in": ["CONFIRMED", "DELIVERED"]}}
-    match.update(_date_filter(from_date, to_date))
-    date_format = "%Y-%m-%d" if group_by == "day" else "%Y-%m"
-    pipeline = [
-        {"$match": match},
-        {
-            "$group": {
-                "_id": {"$dateToString": {"format": date_format, "date": "$createdAt"}},
-                "revenue": {"$sum": "$totalAmount"},
-                "orders": {"$sum": 1},
-            }
-        },
-        {"$sort": {"_id": 1}},
-    ]
+    day_range = {}
+    if from_date:
+        day_range["$gte"] = from_date.strftime("%Y-%m-%d")
+    if to_date:
+        day_range["$lte"] = to_date.strftime("%Y-%m-%d")
+    buckets = {}
+    for day in _revenue_days(db, from_date, to_date, day_range):
+        key = day["_id"] if group_by == "day" else day["_id"][:7]
+        bucket = buckets.setdefault(key, {"revenue": 0, "orders": 0})
+        for status in REVENUE_STATUSES:
+            entry = (day.get("byStatus") or {}).get(status) or {}
+            bucket["revenue"] += entry.get("revenue", 0)
+            bucket["orders"] += entry.get("orders", 0)
     results = []
-    for row in db.orders.aggregate(pipeline):
-        orders = row.get("orders", 0) or 1
+    for key, bucket in buckets.items():
+        orders = bucket["orders"]
+        if not orders:
+            continue
         results.append({
-            "date": row.get("_id"),
-            "revenue": row.get("revenue", 0),
+            "date": key,
+            "revenue": bucket["revenue"],
             "orders": orders,
-            "avgOrderValue": (row.get("revenue", 0) / orders) if orders else 0,
+            "avgOrderValue": bucket["revenue"] / orders,
         })
     return results
 
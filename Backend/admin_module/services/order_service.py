@@ -1,5 +1,8 @@
 from datetime import datetime
 from flask import current_app
+from services import outbox
+from services.reservations import release_reservation
+from services.status_keys import status_key
 from ..utils.validators import to_object_id
 
 VALID_TRANSITIONS = {
@@ -63,7 +66,13 @@ def update_status(order_id, new_status, admin_id):
     allowed = VALID_TRANSITIONS.get(current_status, set())
     if new_status not in allowed:
         return False, "Invalid status transition"
-    db.orders.update_one({"_id": oid}, {"$set": {"status": new_status, "updatedAt": datetime.utcnow()}})
+    # statusKey/paymentStatusKey and the order event come with the write (see services/outbox.py)
+    updated = outbox.update_order(
+        db, order, {"$set": {"status": new_status, "updatedAt": datetime.utcnow()}},
+        condition={"status": order.get("status")}, actor=admin_id,
+    )
+    if updated is None:
+        return False, "Order changed meanwhile"
     db.order_logs.insert_one(
         {
             "orderId": oid,
@@ -85,7 +94,9 @@ def update_order(order_id, payload, admin_id):
     order = db.orders.find_one({"_id": oid})
     if not order:
         return False, "Not found"
-    db.orders.update_one({"_id": oid}, {"$set": payload | {"updatedAt": datetime.utcnow()}})
+    fields = payload | {"updatedAt": datetime.utcnow()}
+    if outbox.update_order(db, order, {"$set": fields}, actor=admin_id) is None:
+        return False, "Not found"
     db.order_logs.insert_one(
         {
             "orderId": oid,
@@ -104,7 +115,12 @@ def delete_order(order_id):
     oid = to_object_id(order_id)
     if not oid:
         return False, "Invalid id"
-    db.orders.delete_one({"_id": oid})
+    order = db.orders.find_one({"_id": oid})
+    if not order:
+        return True, None
+    if status_key(order.get("status")) != "delivered":
+        release_reservation(db, oid, "deleted")
+    outbox.delete_order(db, order)
     return True, None
 
 
@@ -3,9 +3,9 @@ import os
 import sys
 import re
 from io import BytesIO
-from flask import Flask, jsonify, redirect, request, send_file
+from flask import Flask, Response, jsonify, redirect, request, send_file
 from flask_cors import CORS
-from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument
 from pymongo.errors import DuplicateKeyError
 import bcrypt
 import jwt
@@ -15,7 +15,8 @@ from config import Config
 from bson import ObjectId
 from bson.errors import InvalidId
 import json
-import requests
+import time
+import traceback
 try:
     import openai
     OPENAI_AVAILABLE = True
@@ -43,8 +44,51 @@ from routes.admin_orders import admin_orders_bp
 from routes.admin_uploads import admin_uploads_bp
 from utils.auth import token_required
 from utils.helpers import serialize_doc
-from vnpay_utils import build_payment_url, verify_vnpay_signature
+from utils.idempotency import IDEMPOTENCY_HEADER, REPLAYED_HEADER, ensure_idempotency_indexes, idempotent
+from vnpay_utils import build_payment_url, create_date_of, verify_vnpay_signature
 from momo_service import create_momo_payment, verify_momo_signature
+from commands import register_commands
+from services import http_client, order_watch, payment_log
+from services.background import start_periodic
+from services.clock import refresh_offset
+from services.dashboard_summary import dashboard_summary
+from services.inventory_ledger import compact_movements, ensure_ledger_indexes
+from services.order_activity import ensure_activity_indexes
+from services.order_archive import (
+    archive_orders,
+    archived_category_stats,
+    archived_order_stats,
+    ensure_archive_indexes,
+    find_orders,
+)
+from services.order_lookup import find_order
+from services.order_numbers import OrderNumberGenerator, ensure_order_id_index
+from services.outbox import STATUS_TOTALS, ensure_outbox_indexes, make_consumer, status_totals, update_order
+from services.payment_callbacks import (
+    AMOUNT_MISMATCH,
+    PAID,
+    callback_key,
+    ensure_callback_indexes,
+    process_vnpay_callback,
+    seen_callback,
+)
+from services.payment_events import PaymentEventWorker, enqueue_event, ensure_payment_event_indexes
+from services.payment_reconciliation import ensure_reconciliation_indexes, reconcile_pending_payments
+from services.product_sales import (
+    WINDOWS as PRODUCT_SALES_WINDOWS,
+    ensure_product_sales_indexes,
+    featured_products,
+    refresh_product_sales,
+)
+from services.revenue_rollup import CONSUMER_NAME as REVENUE_CONSUMER, revenue_series
+from services.reservations import (
+    ensure_reservation_indexes,
+    new_reservation,
+    release_expired_reservations,
+    release_reservation,
+)
+from services.status_keys import ensure_status_key_indexes, ensure_status_keys, status_key, status_key_group, status_key_match, status_keys
+from services.stock import InsufficientStockError, place_order
 
 SHIPPING_FLAT_RATE = 5.0
 TAX_RATE = 0.08
@@ -161,7 +205,8 @@ CORS(
     app,
     origins=Config.CORS_ORIGINS,
     supports_credentials=True,
-    allow_headers=["Content-Type", "Authorization"],
+    allow_headers=["Content-Type", "Authorization", IDEMPOTENCY_HEADER],
+    expose_headers=[REPLAYED_HEADER],
     methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],  # allow PATCH
 )
 
@@ -174,12 +219,27 @@ try:
     db.users.create_index("email", unique=True)
 except Exception as exc:  # pragma: no cover - log but continue startup
     print(f"Warning: failed to ensure unique index on users.email: {exc}")
+ensure_order_id_index(db)
+ensure_idempotency_indexes(db)
+ensure_reservation_indexes(db)
+ensure_ledger_indexes(db)
+ensure_outbox_indexes(db, Config.ORDER_EVENTS_TTL_DAYS)
+ensure_archive_indexes(db)
+ensure_activity_indexes(db)
+ensure_callback_indexes(db)
+ensure_payment_event_indexes(db)
+ensure_reconciliation_indexes(db)
+ensure_status_key_indexes(db)
+ensure_product_sales_indexes(db)
+payment_log.init_payment_log(db)
 app.mongo_db = db
+order_numbers = OrderNumberGenerator(db, block_size=Config.ORDER_NUMBER_BLOCK_SIZE)
 
 app.register_blueprint(admin_bp)
 app.register_blueprint(admin_dashboard_bp)
 app.register_blueprint(admin_orders_bp)
 app.register_blueprint(admin_uploads_bp)
+register_commands(app)
 
 # Helper: normalize status
 def _norm_status(value: str) -> str:
@@ -291,27 +351,15 @@ def _serialize_product_with_reviews(product, include_reviews=False):
 @app.route('/api/admin/dashboard/summary', methods=['GET'])
 def admin_summary():
     try:
-        revenue = 0.0
-        orders_count = db.orders.count_documents({})
-        users_count = db.users.count_documents({})
-        active_products = db.products.count_documents({'is_active': True}) if 'products' in db.list_collection_names() else 0
-
-        # Sum revenue for paid/completed statuses
-        pipeline = [
-            {"$project": {"total": 1, "statusLower": {"$toLower": "$status"}}},
-            {"$match": {"statusLower": {"$in": list(PAID_STATUSES)}}},
-            {"$group": {"_id": None, "rev": {"$sum": "$total"}}},
-        ]
-        agg = list(db.orders.aggregate(pipeline))
-        if agg:
-            revenue = float(agg[0].get("rev", 0) or 0)
-
+        summary, age = dashboard_summary(db, PAID_STATUSES, {'is_active': True})
         return jsonify({
             "data": {
-                "totalRevenue": revenue,
-                "totalOrders": orders_count,
-                "totalUsers": users_count,
-                "activeProducts": active_products,
+                "totalRevenue": summary["revenue"],
+                "totalOrders": summary["orders"],
+                "totalUsers": summary["users"],
+                "activeProducts": summary["activeProducts"],
+                "computedAt": summary["computedAt"].isoformat(),
+                "cacheAgeSeconds": round(age, 1),
             }
         })
     except Exception as exc:
@@ -366,26 +414,15 @@ def admin_revenue():
         range_param = request.args.get('range', '30d')
         days = int(range_param.replace('d', '')) if 'd' in range_param else 30
         since = datetime.utcnow() - timedelta(days=days)
-        pipeline = [
-            {"$project": {"total": 1, "createdAt": 1, "statusLower": {"$toLower": "$status"}}},
-            {"$match": {"statusLower": {"$in": list(PAID_STATUSES)}, "createdAt": {"$gte": since}}},
-            {"$group": {
-                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}},
-                "revenue": {"$sum": "$total"},
-                "orders": {"$sum": 1},
-            }},
-            {"$sort": {"_id": 1}}
-        ]
         data = []
-        for doc in db.orders.aggregate(pipeline):
-            orders = doc.get("orders", 0)
-            revenue = doc.get("revenue", 0)
-            avg = revenue / orders if orders else 0
+        for row in revenue_series(db, since, statuses=PAID_STATUSES):
+            orders = row["orders"]
+            revenue = row["revenue"]
             data.append({
-                "date": doc["_id"],
+                "date": row["date"],
                 "revenue": revenue,
                 "orders": orders,
-                "avgOrderValue": avg,
+                "avgOrderValue": revenue / orders if orders else 0,
             })
         return jsonify({"data": data})
     except Exception as exc:
@@ -408,25 +445,18 @@ def admin_category_stats():
             days = 30
         since = datetime.utcnow() - timedelta(days=days - 1)
 
-        # Bước 1: aggregate từ orders -> items -> productId với quantity/revenue
+        # Gộp theo danh mục đã lưu sẵn trên từng item (vẫn đúng khi sản phẩm đã bị xoá)
         pipeline = [
-            {
-                "$project": {
-                    "items": 1,
-                    "createdAt": 1,
-                    "statusLower": {"$toLower": "$status"},
-                }
-            },
             {
                 "$match": {
-                    "statusLower": {"$in": [s.lower() for s in PAID_STATUSES]},
+                    **status_key_match(db, status_keys(PAID_STATUSES)),
                     "createdAt": {"$gte": since},
                 }
             },
             {"$unwind": "$items"},
             {
                 "$project": {
-                    "productId": "$items.productId",
+                    "category": "$items.category",
                     "quantity": {
                         "$cond": [
                             {"$isNumber": "$items.quantity"},
@@ -452,7 +482,7 @@ def admin_category_stats():
             },
             {
                 "$group": {
-                    "_id": "$productId",
+                    "_id": "$category",
                     "totalQty": {"$sum": "$quantity"},
                     "totalRev": {
                         "$sum": {
@@ -467,51 +497,22 @@ def admin_category_stats():
             },
         ]
 
-        prod_stats = list(db.orders.aggregate(pipeline))
-
-        if not prod_stats:
-            return jsonify({"data": []})
-
-        # Bước 2: tra category của từng product
-        product_ids = []
-        pid_map = {}  # productId (str) -> stats
-        for doc in prod_stats:
-            pid_raw = doc.get("_id")
-            if pid_raw is None:
-                continue
-            pid_str = str(pid_raw)
-            pid_map[pid_str] = {
-                "qty": int(doc.get("totalQty", 0) or 0),
-                "rev": float(doc.get("totalRev", 0) or 0),
-            }
-            try:
-                product_ids.append(ObjectId(pid_raw))
-            except Exception:
-                # nếu pid lưu dạng string không convert được thì bỏ qua lookup
-                pass
-
-        products = {}
-        if product_ids:
-            cursor = db.products.find({"_id": {"$in": product_ids}}, {"category": 1})
-            for p in cursor:
-                products[str(p["_id"])] = p.get("category")
-
-        # Bước 3: gộp theo category
         category_map = {}
-        for pid_str, stats in pid_map.items():
-            category = products.get(pid_str)
-            if not category:
-                continue
-            cat_key = str(category)
-            if cat_key not in category_map:
-                category_map[cat_key] = {"rev": 0.0, "qty": 0}
-            category_map[cat_key]["rev"] += stats["rev"]
-            category_map[cat_key]["qty"] += stats["qty"]
-
+        for doc in db.orders.aggregate(pipeline):
+            entry = category_map.setdefault(doc.get("_id") or None, {"rev": 0.0, "qty": 0})
+            entry["rev"] += float(doc.get("totalRev", 0) or 0)
+            entry["qty"] += int(doc.get("totalQty", 0) or 0)
+        # Cộng thêm số liệu đã gộp của các đơn hàng lưu trữ
+        for category, stats in archived_category_stats(db, PAID_STATUSES, since).items():
+            entry = category_map.setdefault(category or None, {"rev": 0.0, "qty": 0})
+            entry["rev"] += float(stats.get("revenue", 0) or 0)
+            entry["qty"] += int(stats.get("quantity", 0) or 0)
+
+        # Đơn hàng cũ của sản phẩm đã xoá (không còn biết danh mục) được gom vào "Khác"
         data = [
             {
-                "categoryId": cat,
-                "categoryName": cat,
+                "categoryId": str(cat) if cat is not None else "uncategorized",
+                "categoryName": str(cat) if cat is not None else "Khác",
                 "totalRevenue": float(vals["rev"]),
                 "totalQuantity": int(vals["qty"]),
             }
@@ -534,7 +535,13 @@ def admin_payment_methods():
             {"$group": {"_id": "$method", "count": {"$sum": 1}}},
             {"$sort": {"count": -1}}
         ]
-        data = [{"method": doc["_id"], "orders": doc["count"], "revenue": 0} for doc in db.orders.aggregate(pipeline)]
+        counts = {doc["_id"]: doc["count"] for doc in db.orders.aggregate(pipeline)}
+        for doc in archived_order_stats(db, group_by='method'):
+            counts[doc["_id"]] = counts.get(doc["_id"], 0) + doc["count"]
+        data = [
+            {"method": method, "orders": count, "revenue": 0}
+            for method, count in sorted(counts.items(), key=lambda entry: entry[1], reverse=True)
+        ]
         return jsonify({"data": data})
     except Exception as exc:
         return jsonify({"error": str(exc)}), 500
@@ -543,16 +550,19 @@ def admin_payment_methods():
 @app.route('/api/admin/dashboard/order-status-summary', methods=['GET'])
 def admin_order_status_summary():
     try:
+        totals = status_totals(db)
+        if totals is not None:
+            return jsonify({"data": {status.upper(): count for status, count in totals.items() if count}})
+        # order_status_totals is still being built
         pipeline = [
-            {"$project": {"statusLower": {"$toLower": "$status"}}},
-            {"$group": {"_id": "$statusLower", "count": {"$sum": 1}}},
+            {"$group": {"_id": status_key_group(db), "count": {"$sum": 1}}},
             {"$sort": {"count": -1}}
         ]
         entries = db.orders.aggregate(pipeline)
         data_map = {}
-        for doc in entries:
+        for doc in list(entries) + archived_order_stats(db, group_by='status'):
             key = (doc.get("_id") or "").upper()
-            data_map[key] = doc.get("count", 0)
+            data_map[key] = data_map.get(key, 0) + doc.get("count", 0)
         return jsonify({"data": data_map})
     except Exception as exc:
         return jsonify({"error": str(exc)}), 500
@@ -585,10 +595,10 @@ def verify_recaptcha(recaptcha_token: str | None, remote_ip: str | None = None)
         if remote_ip:
             payload['remoteip'] = remote_ip
         
-        response = requests.post(
+        response = http_client.post(
+            'recaptcha',
             'https://www.google.com/recaptcha/api/siteverify',
             data=payload,
-            timeout=5
         )
         result = response.json()
         return result.get('success', False)
@@ -1010,7 +1020,8 @@ def get_category_stats():
 @app.route('/api/products/featured', methods=['GET'])
 def get_featured_products():
     """
-    Best sellers based on total quantity sold in paid/completed orders.
+    Best sellers based on total quantity sold in paid/completed orders,
+    read from the product_sales view (?window=7d|30d for recent best sellers).
     Does not affect existing product APIs.
     """
     try:
@@ -1020,65 +1031,11 @@ def get_featured_products():
         except (TypeError, ValueError):
             limit = 8
         limit = max(1, min(limit, 24))
+        window = request.args.get('window', 'all')
+        if window not in PRODUCT_SALES_WINDOWS:
+            window = 'all'
 
-        paid_statuses = {'paid', 'completed', 'delivered', 'payment success', 'payment successful', 'shipped'}
-
-        pipeline = [
-            {"$match": {"status": {"$exists": True}}},
-            {
-                "$project": {
-                    "items": 1,
-                    "statusLower": {"$toLower": "$status"},
-                }
-            },
-            {"$match": {"statusLower": {"$in": list(paid_statuses)}}},
-            {"$unwind": "$items"},
-            {
-                "$group": {
-                    "_id": "$items.productId",
-                    "totalSold": {"$sum": {"$ifNull": ["$items.quantity", 0]}},
-                }
-            },
-            {"$match": {"_id": {"$ne": None}}},
-            {"$sort": {"totalSold": -1}},
-            {"$limit": limit},
-        ]
-
-        agg_results = list(db.orders.aggregate(pipeline))
-        if not agg_results:
-            return jsonify({"success": True, "data": []})
-
-        # Separate ObjectId and string ids
-        object_ids = []
-        id_to_total = {}
-        for entry in agg_results:
-            pid = entry.get("_id")
-            total = int(entry.get("totalSold", 0))
-            id_to_total[str(pid)] = total
-            try:
-                object_ids.append(ObjectId(pid))
-            except Exception:
-                # If pid already ObjectId, keep; if string not convertible, skip fetch
-                if isinstance(pid, ObjectId):
-                    object_ids.append(pid)
-
-        products_cursor = db.products.find({"_id": {"$in": object_ids}})
-        product_map = {str(prod["_id"]): prod for prod in products_cursor}
-
-        featured = []
-        for entry in agg_results:
-            pid = str(entry.get("_id"))
-            prod = product_map.get(pid)
-            if not prod:
-                continue
-            featured.append({
-                "_id": pid,
-                "name": prod.get("name"),
-                "price": prod.get("price"),
-                "imageUrl": prod.get("image") or (prod.get("images") or [None])[0],
-                "totalSold": int(entry.get("totalSold", 0)),
-            })
-
+        featured = featured_products(db, limit, window, ttl=Config.FEATURED_PRODUCTS_CACHE_SECONDS)
         return jsonify({"success": True, "data": featured}), 200
 
     except Exception as exc:
@@ -1178,8 +1135,9 @@ def chat_with_ai():
                 'error': 'AI service is not configured. Please add OPENAI_API_KEY to .env'
             }), 503
         
-        # Initialize OpenAI client
+        # Initialize OpenAI client (pooled session shared with other outbound calls)
         openai.api_key = api_key
+        openai.requestssession = http_client.session('openai')
         
         system_prompt = """Bạn là một dược sĩ AI chuyên nghiệp của Medicare - một cửa hàng thuốc trực tuyến.
 
@@ -1207,14 +1165,17 @@ Nếu không có sản phẩm phù hợp, hãy nói rõ: "Hiện tại cửa hà
 Format câu trả lời: rõ ràng, có bullet points, thân thiện."""
         
         try:
-            response = openai.ChatCompletion.create(
+            response = http_client.call(
+                'openai',
+                openai.ChatCompletion.create,
                 model="gpt-3.5-turbo",  # Dùng GPT-3.5 để tiết kiệm chi phí
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.7,
-                max_tokens=500
+                max_tokens=500,
+                request_timeout=http_client.timeout_for('openai'),
             )
             
             ai_reply = response.choices[0].message.content
@@ -1369,18 +1330,9 @@ def add_to_cart(current_user):
 
 # ============ ORDERS ============
 
-def _find_order_for_user(order_identifier: str, user_id: str):
+def _find_order_for_user(order_identifier: str, user_id: str, projection=None):
     """Look up an order by Mongo _id or friendly orderId for the given user."""
-    if not order_identifier:
-        return None
-    try:
-        object_id = ObjectId(order_identifier)
-        found = db.orders.find_one({'_id': object_id, 'userId': user_id})
-        if found:
-            return found
-    except Exception:
-        pass
-    return db.orders.find_one({'orderId': order_identifier, 'userId': user_id})
+    return find_order(db, order_identifier, {'userId': user_id}, projection, include_archive=True)
 
 
 @app.route('/api/orders', methods=['GET'])
@@ -1389,7 +1341,7 @@ def get_orders(current_user):
     try:
         user_id = str(current_user['_id'])
         
-        orders = list(db.orders.find({'userId': user_id}).sort('createdAt', -1))
+        orders = find_orders(db, {'userId': user_id}, 'createdAt', -1)
         
         return jsonify({
             'orders': [serialize_doc(order) for order in orders]
@@ -1400,24 +1352,19 @@ def get_orders(current_user):
 
 @app.route('/api/orders', methods=['POST'])
 @token_required
+@idempotent('orders.create')
 def create_order(current_user):
     try:
         data = request.json
         user_id = str(current_user['_id'])
 
-        # Generate order ID
-        order_id = f"ORD{datetime.now().strftime('%Y%m%d%H%M%S')}"
-
         payload = request.get_json(force=True, silent=True) or {}
         raw_items = payload.get('items') or []
 
         if not isinstance(raw_items, list) or not raw_items:
             return jsonify({'error': 'Order items are required'}), 400
 
-        validated_items = []
-        stock_requirements = []
-        subtotal = 0.0
-
+        parsed_items = []
         for raw_item in raw_items:
             product_identifier = (
                 raw_item.get('productId')
@@ -1440,7 +1387,23 @@ def create_order(current_user):
             if quantity < 1:
                 return jsonify({'error': 'Số lượng phải ít nhất là 1'}), 400
 
-            product = db.products.find_one({'_id': product_object_id})
+            parsed_items.append((product_object_id, quantity))
+
+        # Price the whole basket with one round trip instead of one find_one per line
+        products_by_id = {
+            product['_id']: product
+            for product in db.products.find(
+                {'_id': {'$in': list({pid for pid, _ in parsed_items})}},
+                {'name': 1, 'price': 1, 'stock': 1, 'images': 1, 'image': 1, 'category': 1},
+            )
+        }
+
+        validated_items = []
+        stock_requirements = []
+        subtotal = 0.0
+
+        for product_object_id, quantity in parsed_items:
+            product = products_by_id.get(product_object_id)
             if not product:
                 return jsonify({'error': 'Không tìm thấy sản phẩm'}), 404
 
@@ -1466,7 +1429,9 @@ def create_order(current_user):
                 'image': primary_image,
                 'price': price,
                 'quantity': quantity,
-                'subtotal': line_total
+                'subtotal': line_total,
+                # Snapshot so category stats survive product deletion / re-categorisation
+                'category': product.get('category'),
             })
             stock_requirements.append({
                 'product_id': product_object_id,
@@ -1495,6 +1460,9 @@ def create_order(current_user):
         payment_method = str(payment_info.get('method') or 'COD').upper()
         payment_status = str(payment_info.get('status') or 'Pending').title()
 
+        # Generate order ID (sequence-based, unique even for orders placed in the same second)
+        order_id = order_numbers.next()
+
         order = {
             'orderId': order_id,
             'userId': user_id,
@@ -1511,6 +1479,8 @@ def create_order(current_user):
             'totalUsd': total,
             'totalVnd': total_vnd,
             'status': 'Pending',
+            # Gateway orders hold their stock only until the payment window expires
+            'reservation': new_reservation(payment_method),
             'createdAt': datetime.utcnow(),
             'updatedAt': datetime.utcnow()
         }
@@ -1525,72 +1495,48 @@ def create_order(current_user):
             'status': 'pending_payment'
         }
 
-        decremented = []
         try:
-            for requirement in stock_requirements:
-                result = db.products.update_one(
-                    {
-                        '_id': requirement['product_id'],
-                        'stock': {'$gte': requirement['quantity']}
-                    },
-                    {'$inc': {'stock': -requirement['quantity']}}
-                )
-                if result.modified_count == 0:
-                    # Rollback any prior stock updates before returning an error
-                    for change in decremented:
-                        db.products.update_one(
-                            {'_id': change['product_id']},
-                            {'$inc': {'stock': change['quantity']}}
-                        )
-                    return jsonify({'message': f"Hết hàng cho {requirement['name'] or 'sản phẩm'}"}), 400
-                decremented.append(requirement)
-
-            result = db.orders.insert_one(order)
-            order['_id'] = str(result.inserted_id)
-            
-            # ========== PREPARE RESPONSE BASED ON PAYMENT METHOD ==========
-            payment_redirect_data['orderId'] = order_id
-            
-            # For COD: Success immediately (no external payment gateway)
-            if payment_method == 'COD':
-                print(f"✅ COD Order created successfully: {order_id}")
-                # COD is considered successful after order creation
-                # Frontend will redirect to /payment-success
-                return jsonify({
-                    'message': 'Đơn hàng đã được tạo thành công (COD)',
-                    'order': serialize_doc(order),
-                    'paymentRedirect': {
-                        'method': 'cod',
-                        'type': 'success',  # Direct to success page
-                        'orderId': order_id,
-                        'amount': total,
-                        'amountVnd': total_vnd,
-                        'description': 'Thanh toán khi nhận hàng',
-                        'redirectUrl': f'/payment-success?orderId={order_id}&amount={total}&method=cod&transactionType=direct'
-                    }
-                }), 201
-            
-            # For VNPAY/MOMO: Return order for payment gateway setup
-            # Frontend will handle calling payment API separately
+            inserted_id = place_order(db, order, stock_requirements)
+        except InsufficientStockError as exc:
+            return jsonify({'message': f"Hết hàng cho {exc.product_name or 'sản phẩm'}"}), 400
+        order['_id'] = str(inserted_id)
+
+        # ========== PREPARE RESPONSE BASED ON PAYMENT METHOD ==========
+        payment_redirect_data['orderId'] = order_id
+        
+        # For COD: Success immediately (no external payment gateway)
+        if payment_method == 'COD':
+            print(f"✅ COD Order created successfully: {order_id}")
+            # COD is considered successful after order creation
+            # Frontend will redirect to /payment-success
             return jsonify({
-                'message': 'Order created successfully', 
+                'message': 'Đơn hàng đã được tạo thành công (COD)',
                 'order': serialize_doc(order),
                 'paymentRedirect': {
-                    'method': payment_method.lower(),
-                    'type': 'gateway',  # Requires payment gateway
+                    'method': 'cod',
+                    'type': 'success',  # Direct to success page
                     'orderId': order_id,
                     'amount': total,
                     'amountVnd': total_vnd,
-                    'nextStep': f'call_payment_api_for_{payment_method.lower()}'
+                    'description': 'Thanh toán khi nhận hàng',
+                    'redirectUrl': f'/payment-success?orderId={order_id}&amount={total}&method=cod&transactionType=direct'
                 }
             }), 201
-        except Exception:
-            for change in decremented:
-                db.products.update_one(
-                    {'_id': change['product_id']},
-                    {'$inc': {'stock': change['quantity']}}
-                )
-            raise
+        
+        # For VNPAY/MOMO: Return order for payment gateway setup
+        # Frontend will handle calling payment API separately
+        return jsonify({
+            'message': 'Order created successfully', 
+            'order': serialize_doc(order),
+            'paymentRedirect': {
+                'method': payment_method.lower(),
+                'type': 'gateway',  # Requires payment gateway
+                'orderId': order_id,
+                'amount': total,
+                'amountVnd': total_vnd,
+                'nextStep': f'call_payment_api_for_{payment_method.lower()}'
+            }
+        }), 201
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1598,6 +1544,7 @@ def create_order(current_user):
 
 @app.route('/api/payment/vnpay/create', methods=['POST'])
 @token_required
+@idempotent('payment.vnpay.create')
 def create_vnpay_payment(current_user):
     """
     Tạo URL thanh toán VNPAY
@@ -1620,12 +1567,7 @@ def create_vnpay_payment(current_user):
             return jsonify({'error': 'orderId and amount are required'}), 400
 
         # Find order in database
-        order = None
-        try:
-            order_object_id = ObjectId(order_identifier)
-            order = db.orders.find_one({'_id': order_object_id})
-        except (InvalidId, TypeError):
-            order = db.orders.find_one({'orderId': order_identifier})
+        order = find_order(db, order_identifier)
 
         if not order:
             print(f"❌ Order not found: {order_identifier}")
@@ -1672,11 +1614,13 @@ def create_vnpay_payment(current_user):
         )
 
         # Update order payment status
-        db.orders.update_one(
-            {'_id': order['_id']},
+        update_order(
+            db, order,
             {'$set': {
                 'payment.method': 'VNPAY',
                 'payment.status': 'Pending',
+                # querydr (payment reconciliation) needs the URL's vnp_CreateDate
+                'payment.vnpCreateDate': create_date_of(payment_url),
                 'updatedAt': datetime.utcnow()
             }},
         )
@@ -1698,6 +1642,7 @@ def create_vnpay_payment(current_user):
 
 @app.route('/api/payment/vnpay', methods=['POST'])
 @token_required
+@idempotent('payment.vnpay.initiate')
 def initiate_vnpay_payment(current_user):
     try:
         if not Config.VNP_TMN_CODE or not Config.VNP_HASH_SECRET:
@@ -1710,12 +1655,7 @@ def initiate_vnpay_payment(current_user):
         if not order_identifier:
             return jsonify({'error': 'orderId is required'}), 400
 
-        order = None
-        try:
-            order_object_id = ObjectId(order_identifier)
-            order = db.orders.find_one({'_id': order_object_id})
-        except (InvalidId, TypeError):
-            order = db.orders.find_one({'orderId': order_identifier})
+        order = find_order(db, order_identifier)
 
         if not order:
             return jsonify({'error': 'Order not found'}), 404
@@ -1743,9 +1683,14 @@ def initiate_vnpay_payment(current_user):
             description or f'Thanh toan don hang {order_ref}',
         )
 
-        db.orders.update_one(
-            {'_id': order['_id']},
-            {'$set': {'payment.method': 'VNPAY', 'payment.status': 'Pending', 'updatedAt': datetime.utcnow()}},
+        update_order(
+            db, order,
+            {'$set': {
+                'payment.method': 'VNPAY',
+                'payment.status': 'Pending',
+                'payment.vnpCreateDate': create_date_of(payment_url),
+                'updatedAt': datetime.utcnow(),
+            }},
         )
 
         return jsonify({'paymentUrl': payment_url, 'orderId': order_ref})
@@ -1758,127 +1703,66 @@ def vnpay_return():
     """
     VNPAY return URL handler - người dùng redirect về đây sau khi thanh toán
     """
-    print("=" * 80)
-    print("🔔 VNPAY RETURN HANDLER CALLED")
-    print("=" * 80)
-    
     if not Config.VNP_TMN_CODE or not Config.VNP_HASH_SECRET:
-        print("❌ VNPAY config missing")
+        payment_log.record('return_rejected', 'vnpay', level='error', reason='config_missing')
         return redirect('http://localhost:5173/payment-fail?method=vnpay&message=Config+missing')
 
     # Lấy tất cả params từ VNPAY
     params = request.args.to_dict()
-    print(f"\n📥 Raw params from VNPAY:")
-    for k, v in params.items():
-        print(f"   {k}: {v}")
+    txn_ref = params.get('vnp_TxnRef')
 
     # Verify signature
     if not verify_vnpay_signature(params):
-        print("\n❌ Signature verification FAILED")
+        payment_log.record('return_rejected', 'vnpay', txn_ref, level='warning', reason='invalid_signature', params=params)
         return redirect('http://localhost:5173/payment-fail?method=vnpay&message=Invalid+signature')
-    print("\n✅ Signature verification PASSED")
-
-    # Extract key params
-    response_code = params.get('vnp_ResponseCode')
-    txn_ref = params.get('vnp_TxnRef')
-    paid_vnd = int(params.get('vnp_Amount', '0')) // 100
-    
-    print(f"\n📊 Key Parameters:")
-    print(f"   Response Code: {response_code}")
-    print(f"   TxnRef (Order ID): {txn_ref}")
-    print(f"   Paid Amount (VND): {paid_vnd}")
-
-    # Find order
-    order = None
-    try:
-        order = db.orders.find_one({'_id': ObjectId(txn_ref)})
-    except (InvalidId, TypeError):
-        order = None
 
-    if not order and txn_ref:
-        order = db.orders.find_one({'orderId': txn_ref})
+    # Applies the result once; a duplicate (IPN already handled it, browser refresh)
+    # is answered from the stored outcome
+    record = process_vnpay_callback(db, params)
 
-    if not order:
-        print(f"\n❌ Order NOT found: {txn_ref}")
+    if record is None:
+        payment_log.record('return_rejected', 'vnpay', txn_ref, level='warning', reason='order_not_found', params=params)
         return redirect(f'http://localhost:5173/payment-fail?method=vnpay&message=Order+not+found')
 
-    # Verify amount
-    expected_total_usd = float(order.get('total') or order.get('totalUsd') or 0)
-    expected_total_vnd = int(order.get('totalVnd') or round(expected_total_usd * Config.EXCHANGE_RATE))
-    
-    print(f"\n💰 Amount Verification:")
-    print(f"   Expected VND: {expected_total_vnd}")
-    print(f"   Paid VND: {paid_vnd}")
-    print(f"   Match: {paid_vnd == expected_total_vnd}")
-
-    if paid_vnd != expected_total_vnd:
-        print(f"\n❌ Amount MISMATCH - Setting order to FAILED")
-        db.orders.update_one(
-            {'_id': order['_id']},
-            {'$set': {
-                'payment.status': 'Failed',
-                'status': 'Payment Failed',
-                'payment.note': f'Amount mismatch: paid {paid_vnd} VND vs expected {expected_total_vnd} VND',
-                'updatedAt': datetime.utcnow()
-            }}
-        )
-        return redirect(f'http://localhost:5173/payment-fail?orderId={txn_ref}&method=vnpay&message=Amount+mismatch&amount={expected_total_usd}')
-
-    # Determine success
-    is_success = response_code == '00'
-    print(f"\n🎯 Payment Result: {'SUCCESS' if is_success else 'FAILED'}")
-    print(f"   Response Code: {response_code}")
-
-    if is_success:
-        # Update order to PAID
-        db.orders.update_one(
-            {'_id': order['_id']},
-            {'$set': {
-                'payment.method': 'VNPAY',
-                'payment.status': 'Paid',
-                'payment.transactionId': params.get('vnp_TransactionNo'),
-                'status': 'Paid',
-                'updatedAt': datetime.utcnow()
-            }}
-        )
-        print(f"✅ Order {txn_ref} set to PAID status")
-        
-        redirect_url = f"http://localhost:5173/payment-success?orderId={txn_ref}&amount={expected_total_usd}&method=vnpay"
-    else:
-        # Update order to FAILED
-        db.orders.update_one(
-            {'_id': order['_id']},
-            {'$set': {
-                'payment.method': 'VNPAY',
-                'payment.status': 'Failed',
-                'payment.transactionId': params.get('vnp_TransactionNo'),
-                'status': 'Payment Failed',
-                'updatedAt': datetime.utcnow()
-            }}
-        )
-        print(f"❌ Order {txn_ref} set to FAILED status")
-        
-        error_message = {
-            '01': 'Giao dịch bị từ chối',
-            '02': 'Merchant closed',
-            '04': 'Số tiền không đúng',
-            '05': 'Khác',
-            '06': 'Sai tham số',
-            '07': 'Sai tham số giá trị',
-            '08': 'Giao dịch không tồn tại',
-            '09': 'Sai chữ ký',
-            '10': 'Đã huỷ giao dịch',
-            '11': 'Sai mã merchant',
-            '12': 'Lỗi khác'
-        }.get(response_code, f'Mã lỗi {response_code}')
-        
-        from urllib.parse import quote
-        redirect_url = f"http://localhost:5173/payment-fail?orderId={txn_ref}&amount={expected_total_usd}&method=vnpay&message={quote(error_message)}"
-
-    print(f"\n🔄 Redirecting to: {redirect_url[:80]}...")
-    print("=" * 80 + "\n")
-    
-    return redirect(redirect_url)
+    payment_log.record(
+        'return_processed', 'vnpay', txn_ref,
+        outcome=record.get('outcome'), applied=record.get('applied'), params=params,
+    )
+    # What the order ended up as: a success callback may have lost to a cancellation or expiry
+    order = db.orders.find_one({'_id': record.get('orderRef')}, {'payment.status': 1})
+    return redirect(_vnpay_result_redirect(txn_ref, record, order))
+
+
+VNPAY_RETURN_MESSAGES = {
+    '01': 'Giao dịch bị từ chối',
+    '02': 'Merchant closed',
+    '04': 'Số tiền không đúng',
+    '05': 'Khác',
+    '06': 'Sai tham số',
+    '07': 'Sai tham số giá trị',
+    '08': 'Giao dịch không tồn tại',
+    '09': 'Sai chữ ký',
+    '10': 'Đã huỷ giao dịch',
+    '11': 'Sai mã merchant',
+    '12': 'Lỗi khác'
+}
+
+
+def _vnpay_result_redirect(txn_ref, record, order):
+    """Frontend result page for a processed VNPAY callback; success only when ``order`` is paid."""
+    from urllib.parse import quote
+
+    amount = record.get('amountUsd')
+    if status_key(((order or {}).get('payment') or {}).get('status')) == 'paid':
+        return f"http://localhost:5173/payment-success?orderId={txn_ref}&amount={amount}&method=vnpay"
+    if record.get('outcome') == AMOUNT_MISMATCH:
+        return f'http://localhost:5173/payment-fail?orderId={txn_ref}&method=vnpay&message=Amount+mismatch&amount={amount}'
+    if record.get('outcome') == PAID:
+        # Paid at VNPAY, but the order had already been cancelled or had expired
+        return f'http://localhost:5173/payment-fail?orderId={txn_ref}&method=vnpay&message=Order+already+updated&amount={amount}'
+    response_code = record.get('responseCode')
+    error_message = VNPAY_RETURN_MESSAGES.get(response_code, f'Mã lỗi {response_code}')
+    return f"http://localhost:5173/payment-fail?orderId={txn_ref}&amount={amount}&method=vnpay&message={quote(error_message)}"
 
 
 @app.route('/api/orders/<order_id>', methods=['GET'])
@@ -1903,6 +1787,134 @@ def get_order_detail(current_user, order_id):
         return jsonify({'error': str(e)}), 500
 
 
+PAYMENT_FINAL_STATUSES = {'paid', 'failed', 'expired', 'refunded'}
+PAYMENT_STATE_PROJECTION = {'orderId': 1, 'status': 1, 'payment': 1, 'updatedAt': 1}
+
+
+def _payment_state(order):
+    payment = order.get('payment') or {}
+    payment_status = payment.get('status') or 'Pending'
+    updated_at = order.get('updatedAt')
+    return {
+        '_id': str(order['_id']),
+        'orderId': order.get('orderId'),
+        'status': order.get('status'),
+        'paymentStatus': payment_status,
+        'paymentMethod': payment.get('method'),
+        'failReason': payment.get('failReason'),
+        'final': str(payment_status).lower() in PAYMENT_FINAL_STATUSES,
+        'updatedAt': updated_at.isoformat() if isinstance(updated_at, datetime) else updated_at,
+    }
+
+
+def _state_key(state):
+    return (state['status'], state['paymentStatus'])
+
+
+def _wait_for_payment_change(order_ref, known, timeout):
+    """Block until the payment state of ``order_ref`` differs from ``known``.
+
+    Returns ``(changed, state)``; ``state`` is None when the order is gone.
+    Woken by ``services.order_watch`` for changes made in this process and
+    re-reads the order every PAYMENT_STREAM_RECHECK_SECONDS for the others.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        event = order_watch.subscribe(order_ref)
+        try:
+            order = find_order(db, order_ref, projection=PAYMENT_STATE_PROJECTION, include_archive=True)
+            state = _payment_state(order) if order else None
+            if state is None or _state_key(state) != known:
+                return True, state
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, state
+            event.wait(min(remaining, Config.PAYMENT_STREAM_RECHECK_SECONDS))
+        finally:
+            order_watch.unsubscribe(order_ref, event)
+
+
+def _sse(state):
+    return f"event: payment\ndata: {json.dumps(state)}\n\n"
+
+
+def _payment_event_stream(order_ref, state):
+    deadline = time.monotonic() + Config.PAYMENT_STREAM_MAX_SECONDS
+    yield f"retry: {int(Config.PAYMENT_STREAM_RECHECK_SECONDS * 1000)}\n" + _sse(state)
+    while not state['final']:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        changed, current = _wait_for_payment_change(
+            order_ref, _state_key(state), min(remaining, Config.PAYMENT_STREAM_HEARTBEAT_SECONDS)
+        )
+        if current is None:
+            return
+        if not changed:
+            yield ": keep-alive\n\n"
+            continue
+        state = current
+        yield _sse(state)
+
+
+@app.route('/api/orders/<order_id>/payment-events', methods=['GET'])
+@token_required
+def payment_events(current_user, order_id):
+    """
+    Push the payment state of an order instead of having the result pages poll.
+
+    - Accept: text/event-stream -> SSE: the current state, then one 'payment'
+      event per change until the payment is final (or PAYMENT_STREAM_MAX_SECONDS)
+    - otherwise long-poll: answers as soon as the state differs from ?since=
+      (the paymentStatus the client knows; default: the current one), or with
+      changed=false after ?timeout= seconds (max PAYMENT_STREAM_TIMEOUT_SECONDS)
+    """
+    try:
+        user_id = str(current_user['_id'])
+        order = _find_order_for_user(order_id, user_id, PAYMENT_STATE_PROJECTION)
+        if not order:
+            return jsonify({'error': 'Order not found'}), 404
+
+        state = _payment_state(order)
+        order_ref = order['_id']
+        # Every held request pins a worker thread: past the cap, answer right away
+        busy = order_watch.waiting() >= Config.PAYMENT_STREAM_MAX_WAITERS
+
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            if busy or state['final']:
+                body = f"retry: {int(Config.PAYMENT_STREAM_HEARTBEAT_SECONDS * 1000)}\n" + _sse(state)
+                return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+            return Response(
+                _payment_event_stream(order_ref, state),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
+
+        since = request.args.get('since')
+        known = (state['status'], since) if since else _state_key(state)
+        if since and since != state['paymentStatus']:
+            return jsonify({**state, 'changed': True})
+        if busy:
+            retry_after = str(int(Config.PAYMENT_STREAM_HEARTBEAT_SECONDS))
+            return jsonify({**state, 'changed': False}), 200, {'Retry-After': retry_after}
+        if state['final'] and not since:
+            return jsonify({**state, 'changed': False})
+
+        try:
+            timeout = float(request.args.get('timeout', Config.PAYMENT_STREAM_TIMEOUT_SECONDS))
+        except (TypeError, ValueError):
+            timeout = Config.PAYMENT_STREAM_TIMEOUT_SECONDS
+        timeout = max(0.0, min(timeout, Config.PAYMENT_STREAM_TIMEOUT_SECONDS))
+
+        changed, current = _wait_for_payment_change(order_ref, known, timeout)
+        if current is None:
+            return jsonify({'error': 'Order not found'}), 404
+        return jsonify({**current, 'changed': changed})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/orders/<order_id>/status', methods=['PATCH'])
 @token_required
 def update_order_status_user(current_user, order_id):
@@ -1933,8 +1945,14 @@ def update_order_status_user(current_user, order_id):
             '$set': {'status': 'cancelled', 'updatedAt': datetime.utcnow()},
         }
 
-        db.orders.update_one({'_id': order['_id']}, update_doc)
-        updated = db.orders.find_one({'_id': order['_id']})
+        # Still pending and unpaid at write time: a payment callback may have landed since the read
+        updated = update_order(
+            db, order, update_doc,
+            condition={'status': order.get('status'), 'payment.status': {'$nin': ['Paid', 'paid', 'PAID']}},
+        )
+        if updated is None:
+            return jsonify({'error': 'Order changed meanwhile and can no longer be cancelled'}), 409
+        release_reservation(db, order['_id'], 'cancelled')
 
         return jsonify(order_to_dict(updated))
 
@@ -1942,14 +1960,80 @@ def update_order_status_user(current_user, order_id):
         return jsonify({'error': str(e)}), 500
 
 
+REORDER_MODES = {'replace', 'merge'}
+
+
+def _first_image(doc):
+    images = doc.get('images')
+    if isinstance(images, list) and images:
+        return images[0]
+    return doc.get('image')
+
+
+def _merge_cart_pipeline(lines, now):
+    """Update pipeline that adds ``lines`` to the stored cart in one atomic write.
+
+    Lines for products already in the cart bump the quantity (and take the
+    current price); the rest are appended. Totals are recomputed server-side.
+    """
+    existing = {'$ifNull': ['$items', []]}
+    merged_existing = existing
+    if lines:
+        # Every stored value goes in as $literal: a name like "$price" must not read as a field path
+        merged_existing = {'$map': {
+            'input': existing,
+            'as': 'item',
+            'in': {'$switch': {
+                'branches': [
+                    {
+                        'case': {'$eq': ['$$item.productId', {'$literal': line['productId']}]},
+                        'then': {'$mergeObjects': ['$$item', {
+                            'name': {'$literal': line['name']},
+                            'image': {'$literal': line['image']},
+                            'price': {'$literal': line['price']},
+                            'quantity': {'$add': [{'$ifNull': ['$$item.quantity', 0]}, {'$literal': line['quantity']}]},
+                            'subtotal': {'$multiply': [
+                                {'$literal': line['price']},
+                                {'$add': [{'$ifNull': ['$$item.quantity', 0]}, {'$literal': line['quantity']}]},
+                            ]},
+                        }]},
+                    }
+                    for line in lines
+                ],
+                'default': '$$item',
+            }},
+        }}
+    appended = {'$filter': {
+        'input': {'$literal': lines},
+        'as': 'line',
+        'cond': {'$not': {'$in': ['$$line.productId', {'$map': {
+            'input': existing, 'as': 'item', 'in': '$$item.productId',
+        }}]}},
+    }}
+    return [
+        {'$set': {'items': {'$concatArrays': [merged_existing, appended]}}},
+        {'$set': {'total': {'$sum': '$items.subtotal'}, 'updatedAt': now}},
+    ]
+
+
 @app.route('/api/orders/<order_id>/reorder', methods=['POST'])
 @token_required
 def reorder_order(current_user, order_id):
-    """Replace cart with items from a past order (1:1 clone)."""
+    """Copy a past order's items into the cart.
+
+    ``mode=replace`` (default) swaps the cart for the order's lines;
+    ``mode=merge`` adds them to what is already there. Products are resolved
+    with one query and the cart is written with one atomic update, whatever
+    the order size. Each line reports the current price and stock.
+    """
     try:
         user_id = str(current_user['_id'])
+        payload = request.get_json(force=True, silent=True) or {}
+        mode = str(payload.get('mode') or request.args.get('mode') or 'replace').lower()
+        if mode not in REORDER_MODES:
+            return jsonify({'success': False, 'message': 'mode must be "replace" or "merge"'}), 400
 
-        order = _find_order_for_user(order_id, user_id)
+        order = _find_order_for_user(order_id, user_id, {'items': 1})
         if not order:
             return jsonify({'success': False, 'message': 'Order not found'}), 404
 
@@ -1957,66 +2041,88 @@ def reorder_order(current_user, order_id):
         if not items:
             return jsonify({'success': False, 'message': 'Order has no items'}), 400
 
-        cart = db.carts.find_one({'userId': user_id})
-        if not cart:
-            cart = {'userId': user_id, 'items': [], 'total': 0, 'updatedAt': datetime.utcnow()}
-            res = db.carts.insert_one(cart)
-            cart['_id'] = res.inserted_id
-
-        # Replace cart items completely
-        cart_items = []
-        added_count = 0
-
+        # Collapse repeated products and keep the original line order
+        requested = {}
+        skipped = []
         for order_item in items:
-            pid = order_item.get('productId')
-            if not pid:
+            pid = str(order_item.get('productId') or '')
+            if not ObjectId.is_valid(pid):
+                skipped.append({'productId': pid or None, 'name': order_item.get('name'), 'reason': 'invalid_id'})
                 continue
-            # Ensure product still exists; allow inactive if no is_active flag
-            product_doc = None
-            try:
-                product_doc = db.products.find_one({'_id': ObjectId(pid)})
-            except Exception:
-                product_doc = db.products.find_one({'_id': pid})
-            if not product_doc:
-                continue  # skip missing products
-
             try:
                 qty = int(order_item.get('quantity', 1))
             except Exception:
                 qty = 1
-            qty = max(qty, 1)
-
-            # Prefer order item price/name/image; fallback to product doc
-            price = float(order_item.get('price') or product_doc.get('price') or 0)
-            name = order_item.get('name') or product_doc.get('name')
-            image = (
-                order_item.get('image')
-                or (product_doc.get('images')[0] if isinstance(product_doc.get('images'), list) and product_doc.get('images') else None)
-                or product_doc.get('image')
+            line = requested.setdefault(pid, {'item': order_item, 'quantity': 0})
+            line['quantity'] += max(qty, 1)
+
+        products = {
+            str(doc['_id']): doc
+            for doc in db.products.find(
+                {'_id': {'$in': [ObjectId(pid) for pid in requested]}},
+                {'name': 1, 'price': 1, 'stock': 1, 'images': 1, 'image': 1, 'is_active': 1},
             )
+        }
 
-            cart_items.append({
-                'productId': str(product_doc['_id']),
-                'name': name,
-                'image': image,
+        cart_items = []
+        annotated = []
+        for pid, line in requested.items():
+            order_item = line['item']
+            qty = line['quantity']
+            product_doc = products.get(pid)
+            if not product_doc or product_doc.get('is_active') is False:
+                skipped.append({
+                    'productId': pid,
+                    'name': order_item.get('name'),
+                    'reason': 'unavailable' if product_doc else 'not_found',
+                })
+                continue
+
+            ordered_price = float(order_item.get('price') or 0)
+            price = float(product_doc.get('price') or ordered_price)
+            stock = int(product_doc.get('stock') or 0)
+            cart_line = {
+                'productId': pid,
+                'name': product_doc.get('name') or order_item.get('name'),
+                'image': _first_image(product_doc) or order_item.get('image'),
                 'price': price,
                 'quantity': qty,
-                'subtotal': price * qty
+                'subtotal': price * qty,
+            }
+            cart_items.append(cart_line)
+            annotated.append({
+                **cart_line,
+                'orderedPrice': ordered_price,
+                'priceChanged': abs(price - ordered_price) > 1e-9,
+                'stock': stock,
+                'inStock': stock >= qty,
             })
 
-            added_count += 1
-
-        cart['items'] = cart_items
-        cart['total'] = sum(item.get('subtotal', 0) for item in cart_items)
-        cart['updatedAt'] = datetime.utcnow()
-
-        db.carts.update_one({'_id': cart['_id']}, {'$set': cart}, upsert=True)
+        now = datetime.utcnow()
+        if mode == 'merge':
+            update = _merge_cart_pipeline(cart_items, now)
+        else:
+            update = {'$set': {
+                'items': cart_items,
+                'total': sum(item['subtotal'] for item in cart_items),
+                'updatedAt': now,
+            }}
+        cart = db.carts.find_one_and_update(
+            {'userId': user_id},
+            update,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
 
         return jsonify({
             'success': True,
             'message': 'Items from order have been added to your cart.',
-            'cartItemCount': len(cart_items),
-            'addedItems': added_count
+            'mode': mode,
+            'cartItemCount': len(cart.get('items') or []),
+            'addedItems': len(cart_items),
+            'items': annotated,
+            'skippedItems': skipped,
+            'cart': serialize_doc(cart),
         }), 200
 
     except Exception as exc:
@@ -2195,6 +2301,7 @@ def update_user_profile(current_user):
 
 @app.route('/api/payment/momo', methods=['POST'])
 @token_required
+@idempotent('payment.momo.create')
 def create_momo_payment_endpoint(current_user):
     """
     Create MoMo payment URL for order.
@@ -2215,12 +2322,7 @@ def create_momo_payment_endpoint(current_user):
             return jsonify({'error': 'orderId is required'}), 400
 
         # Find order in database
-        order = None
-        try:
-            order_object_id = ObjectId(order_identifier)
-            order = db.orders.find_one({'_id': order_object_id})
-        except (InvalidId, TypeError):
-            order = db.orders.find_one({'orderId': order_identifier})
+        order = find_order(db, order_identifier)
 
         if not order:
             print(f"❌ Order not found: {order_identifier}")
@@ -2242,7 +2344,7 @@ def create_momo_payment_endpoint(current_user):
             return jsonify({'error': 'Payment method is not MoMo for this order'}), 400
 
         # Create MoMo payment
-        momo_response = create_momo_payment(order)
+        momo_response = create_momo_payment(db, order)
 
         if momo_response.get('resultCode') != 0:
             print(f"❌ MoMo creation failed: {momo_response.get('message')}")
@@ -2261,8 +2363,8 @@ def create_momo_payment_endpoint(current_user):
             }), 400
 
         # Update order payment status to pending
-        db.orders.update_one(
-            {'_id': order['_id']},
+        update_order(
+            db, order,
             {'$set': {
                 'payment.method': 'MOMO',
                 'payment.status': 'Pending',
@@ -2287,131 +2389,43 @@ def create_momo_payment_endpoint(current_user):
         return jsonify({'error': str(e)}), 500
 
 
+def _momo_ipn_ack(record):
+    message = 'Amount mismatch' if record.get('outcome') == AMOUNT_MISMATCH else 'OK'
+    return {'message': message, 'resultCode': 0}
+
+
 @app.route('/api/payment/momo/ipn', methods=['POST'])
 def momo_ipn_handler():
     """
     MoMo IPN (Instant Payment Notification) webhook handler.
     MoMo calls this endpoint to notify payment result.
     """
-    print("=" * 80)
-    print("🔔 MOMO IPN HANDLER CALLED")
-    print("=" * 80)
-    
+    data = {}
     try:
         data = request.get_json(force=True, silent=True) or {}
-        
-        print(f"\n📥 Raw IPN data from MoMo:")
-        for k, v in data.items():
-            if k != 'signature':
-                print(f"   {k}: {v}")
+        order_id = data.get('orderId')
 
         # Verify signature
         if not verify_momo_signature(data):
-            print("\n❌ Signature verification FAILED")
-            print("=" * 80 + "\n")
+            payment_log.record('ipn_rejected', 'momo', order_id, level='warning', reason='invalid_signature', payload=data)
             return jsonify({'message': 'Invalid signature', 'resultCode': 1}), 400
-        print("\n✅ Signature verification PASSED")
-
-        order_id = data.get('orderId')
-        result_code = int(data.get('resultCode', -1))  # 0 = success
-        amount_vnd = data.get('amount')  # MoMo returns amount as VND (not x100)
-        transaction_id = data.get('transId')
-        
-        print(f"\n📊 Key Parameters:")
-        print(f"   Order ID: {order_id}")
-        print(f"   Result Code: {result_code} (0=success)")
-        print(f"   Amount VND: {amount_vnd}")
-        print(f"   Transaction ID: {transaction_id}")
-
-        # Find order
-        order = None
-        try:
-            if order_id:
-                order = db.orders.find_one({'_id': ObjectId(order_id)})
-        except (InvalidId, TypeError):
-            if order_id:
-                order = db.orders.find_one({'orderId': order_id})
-
-        if not order:
-            print(f"\n❌ Order NOT found: {order_id}")
-            print("=" * 80 + "\n")
-            return jsonify({'message': 'Order not found', 'resultCode': 1}), 400
-
-        print(f"✅ Order found: {order.get('orderId')}")
-
-        # Verify amount BEFORE checking result code
-        try:
-            paid_vnd = int(amount_vnd) if amount_vnd else 0
-        except (TypeError, ValueError):
-            paid_vnd = 0
 
-        expected_total_usd = float(order.get('total') or order.get('totalUsd') or 0)
-        expected_total_vnd = int(order.get('totalVnd') or round(expected_total_usd * Config.EXCHANGE_RATE))
-        
-        print(f"\n💰 Amount Verification:")
-        print(f"   Expected VND: {expected_total_vnd}")
-        print(f"   Paid VND: {paid_vnd}")
-        print(f"   Match: {paid_vnd == expected_total_vnd}")
-
-        # Amount mismatch is ALWAYS a failure (regardless of resultCode)
-        if paid_vnd != expected_total_vnd:
-            print(f"\n❌ Amount MISMATCH - Setting order to FAILED")
-            db.orders.update_one(
-                {'_id': order['_id']},
-                {'$set': {
-                    'payment.method': 'MOMO',
-                    'payment.status': 'Failed',
-                    'payment.transactionId': transaction_id,
-                    'payment.resultCode': result_code,
-                    'payment.note': f'Amount mismatch: paid {paid_vnd} VND vs expected {expected_total_vnd} VND',
-                    'status': 'Payment Failed',
-                    'updatedAt': datetime.utcnow()
-                }}
-            )
-            print("=" * 80 + "\n")
-            return jsonify({'message': 'Amount mismatch', 'resultCode': 0}), 200
-
-        # Now check MoMo result code
-        print(f"\n🎯 MoMo Payment Result: {'SUCCESS' if result_code == 0 else 'FAILED'}")
-        print(f"   Result Code: {result_code}")
-
-        if result_code == 0:
-            # MoMo says success AND amount matches → SET TO PAID
-            print(f"✅ Order {order_id} set to PAID status")
-            db.orders.update_one(
-                {'_id': order['_id']},
-                {'$set': {
-                    'payment.method': 'MOMO',
-                    'payment.status': 'Paid',
-                    'payment.transactionId': transaction_id,
-                    'payment.resultCode': result_code,
-                    'status': 'Paid',
-                    'updatedAt': datetime.utcnow()
-                }}
-            )
-        else:
-            # MoMo says failure → SET TO FAILED
-            print(f"❌ Order {order_id} set to FAILED status (MoMo resultCode={result_code})")
-            db.orders.update_one(
-                {'_id': order['_id']},
-                {'$set': {
-                    'payment.method': 'MOMO',
-                    'payment.status': 'Failed',
-                    'payment.transactionId': transaction_id,
-                    'payment.resultCode': result_code,
-                    'status': 'Payment Failed',
-                    'updatedAt': datetime.utcnow()
-                }}
-            )
+        # MoMo retries IPNs until acknowledged: answer duplicates from the stored outcome
+        seen = seen_callback(db, 'momo', callback_key(data.get('transId'), data.get('signature')))
+        if seen:
+            payment_log.record('ipn_duplicate', 'momo', order_id, outcome=seen.get('outcome'), transId=data.get('transId'))
+            return jsonify(_momo_ipn_ack(seen)), 200
 
-        print("=" * 80 + "\n")
-        return jsonify({'message': 'OK', 'resultCode': 0}), 200
+        # Store and acknowledge; the payment-events worker applies it (see services.payment_events)
+        event_id = enqueue_event(db, 'momo', order_id, data)
+        payment_log.record('ipn_queued', 'momo', order_id, eventId=event_id, payload=data)
+        return jsonify({'message': 'Received', 'resultCode': 0}), 200
 
     except Exception as e:
-        print(f"❌ Exception in MoMo IPN: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        print("=" * 80 + "\n")
+        payment_log.record(
+            'ipn_error', 'momo', data.get('orderId'), level='error',
+            error=str(e), traceback=traceback.format_exc(), payload=data,
+        )
         return jsonify({'error': str(e), 'resultCode': 1}), 500
 
 
@@ -2439,10 +2453,7 @@ def momo_return_handler():
     - IPN handler sẽ cập nhật DB (server-to-server, đáng tin hơn)
     - Nếu IPN chậm, frontend có thể retry sau 2s
     """
-    print("=" * 80)
-    print("🔔 MOMO RETURN HANDLER CALLED")
-    print("=" * 80)
-    
+    data = {}
     try:
         # MoMo có thể gửi qua GET hoặc POST
         if request.method == 'POST':
@@ -2450,61 +2461,33 @@ def momo_return_handler():
         else:
             data = request.args.to_dict()
         
-        print(f"\n📥 Raw return data from MoMo (Method: {request.method}):")
-        for k, v in data.items():
-            if k != 'signature':
-                print(f"   {k}: {v}")
-        
         # Extract key params
         order_id = data.get('orderId')
         result_code_str = data.get('resultCode')
-        amount = data.get('amount')
         trans_id = data.get('transId')
-        message = data.get('message', '')
         
         try:
             result_code_int = int(result_code_str) if result_code_str else -1
         except (TypeError, ValueError):
             result_code_int = -1
         
-        print(f"\n📊 Key parameters:")
-        print(f"   Order ID: {order_id}")
-        print(f"   Result Code: {result_code_int}")
-        print(f"   Amount (VND): {amount}")
-        print(f"   Transaction ID: {trans_id}")
-        print(f"   Message: {message}")
-        
         # Find order in DB
-        order = None
-        try:
-            if order_id:
-                order = db.orders.find_one({'_id': ObjectId(order_id)})
-        except (InvalidId, TypeError):
-            if order_id:
-                order = db.orders.find_one({'orderId': order_id})
+        order = find_order(db, order_id)
         
         if not order:
-            print(f"\n❌ Order NOT found: {order_id}")
-            print("=" * 80 + "\n")
+            payment_log.record('return_rejected', 'momo', order_id, level='warning', reason='order_not_found', payload=data)
             return jsonify({
                 'success': False,
                 'status': 'NOT_FOUND',
                 'message': 'Order not found in database'
             }), 404
         
-        print(f"✅ Order found: {order.get('orderId')}")
-        
         # Get current DB status
         db_status = order.get('status') or 'Pending'
         payment_info = order.get('payment') or {}
         payment_status = payment_info.get('status') or 'Pending'
         db_result_code = payment_info.get('resultCode')
         
-        print(f"\n📋 Current DB state:")
-        print(f"   Order status: {db_status}")
-        print(f"   Payment status: {payment_status}")
-        print(f"   Payment resultCode: {db_result_code}")
-        
         # Map MoMo resultCode to order status
         result_code_map = {
             0: 'Paid',              # Thành công
@@ -2536,10 +2519,6 @@ def momo_return_handler():
         expected_status = result_code_map.get(result_code_int, 'Failed')
         status_description = result_code_descriptions.get(result_code_int, 'Lỗi không xác định')
         
-        print(f"\n📖 Result Code mapping:")
-        print(f"   {result_code_int} → Expected status: '{expected_status}'")
-        print(f"   Description: {status_description}")
-        
         # Check if DB is synced with MoMo result
         # Allow small difference: if both are success or both are failure
         is_synced = (
@@ -2547,15 +2526,13 @@ def momo_return_handler():
             (db_result_code == result_code_int)
         )
         
-        if is_synced:
-            print(f"\n✅ DB status SYNCED with MoMo result code")
-        else:
-            print(f"\n⚠️ DB status NOT SYNCED yet with MoMo result")
-            print(f"   DB says: {db_status}, MoMo says: {expected_status}")
-            print(f"   (IPN handler might not have processed yet - will sync soon)")
-        
-        print("=" * 80 + "\n")
-        
+        # Not synced yet usually means the IPN is still queued (see services.payment_events)
+        payment_log.record(
+            'return_received', 'momo', order_id,
+            method=request.method, resultCode=result_code_int, expectedStatus=expected_status,
+            dbStatus=db_status, paymentStatus=payment_status, isSynced=is_synced, payload=data,
+        )
+
         # Return comprehensive response
         return jsonify({
             'success': True,
@@ -2574,16 +2551,69 @@ def momo_return_handler():
         }), 200
     
     except Exception as e:
-        print(f"❌ Exception in MoMo return handler: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        print("=" * 80 + "\n")
+        payment_log.record(
+            'return_error', 'momo', data.get('orderId'), level='error',
+            error=str(e), traceback=traceback.format_exc(), payload=data,
+        )
         return jsonify({
             'success': False,
             'error': str(e),
             'message': 'Error processing MoMo return'
         }), 500
 
+# ============ BACKGROUND JOBS ============
+
+# Per-process: every worker keeps its own clock offset for VNPAY timestamps.
+if Config.CLOCK_SYNC_INTERVAL_SECONDS > 0:
+    start_periodic('clock-sync', refresh_offset, Config.CLOCK_SYNC_INTERVAL_SECONDS)
+
+if Config.RUN_BACKGROUND_WORKERS:
+    # Retried hourly until it has completed once, then a single marker lookup
+    start_periodic('status-keys-backfill', lambda: ensure_status_keys(db), 3600)
+    start_periodic(
+        'reservation-sweeper',
+        lambda: release_expired_reservations(db),
+        Config.STOCK_RESERVATION_SWEEP_SECONDS,
+    )
+    start_periodic(
+        'inventory-compaction',
+        lambda: compact_movements(db, older_than_days=Config.INVENTORY_LEDGER_RETENTION_DAYS),
+        Config.INVENTORY_COMPACTION_INTERVAL_SECONDS,
+        run_immediately=False,
+    )
+    start_periodic(
+        'payment-events',
+        PaymentEventWorker(db).run_once,
+        Config.PAYMENT_EVENTS_POLL_SECONDS,
+    )
+    start_periodic(
+        'payment-reconciliation',
+        lambda: reconcile_pending_payments(db),
+        Config.PAYMENT_RECONCILE_INTERVAL_SECONDS,
+        run_immediately=False,
+    )
+    start_periodic(
+        'status-totals',
+        make_consumer(db, STATUS_TOTALS).run_once,
+        Config.STATUS_TOTALS_INTERVAL_SECONDS,
+    )
+    start_periodic(
+        'revenue-rollup',
+        make_consumer(db, REVENUE_CONSUMER).run_once,
+        Config.REVENUE_ROLLUP_INTERVAL_SECONDS,
+    )
+    start_periodic(
+        'product-sales',
+        lambda: refresh_product_sales(db),
+        Config.PRODUCT_SALES_REFRESH_SECONDS,
+    )
+    start_periodic(
+        'order-archiver',
+        lambda: archive_orders(db, Config.ORDER_ARCHIVE_AFTER_DAYS),
+        Config.ORDER_ARCHIVE_INTERVAL_SECONDS,
+        run_immediately=False,
+    )
+
 # ============ RUN SERVER ============
 
 if __name__ == '__main__':
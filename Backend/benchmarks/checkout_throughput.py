@@ -0,0 +1,129 @@
+"""Checkout throughput benchmark for ``POST /api/orders``.
+
+Seeds a throwaway database with products, then drives ``create_order`` through
+Flask's test client from several threads for baskets of 1, 10 and 50 items and
+reports orders/second and latency percentiles.
+
+Run from the ``Backend`` directory against a real MongoDB (point
+``MONGO_URI`` at a replica set to exercise the transaction path)::
+
+    JWT_SECRET_KEY=bench ENABLE_RECAPTCHA=False \\
+        python -m benchmarks.checkout_throughput --orders 500 --concurrency 8
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Never benchmark against the real catalogue: pick the database before config loads.
+os.environ.setdefault("DATABASE_NAME", "medicare_bench")
+
+import jwt  # noqa: E402
+
+from app import app, db  # noqa: E402
+from config import Config  # noqa: E402
+
+BASKET_SIZES = (1, 10, 50)
+
+
+def _seed(product_count: int) -> list[str]:
+    db.products.delete_many({"benchmark": True})
+    now = datetime.utcnow()
+    docs = [
+        {
+            "name": f"Bench product {index}",
+            "price": 1.5 + index % 7,
+            "stock": 10_000_000,
+            "images": [],
+            "category": "vitamins",
+            "is_active": True,
+            "benchmark": True,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        for index in range(product_count)
+    ]
+    return [str(product_id) for product_id in db.products.insert_many(docs).inserted_ids]
+
+
+def _auth_header() -> dict[str, str]:
+    user = db.users.find_one_and_update(
+        {"email": "checkout-bench@medicare.local"},
+        {"$setOnInsert": {"name": "Bench", "role": "customer", "password": "!", "createdAt": datetime.utcnow()}},
+        upsert=True,
+        return_document=True,
+    )
+    token = jwt.encode(
+        {"user_id": str(user["_id"]), "email": user["email"], "role": "customer", "exp": datetime.utcnow() + timedelta(hours=1)},
+        Config.JWT_SECRET_KEY,
+        algorithm=Config.JWT_ALGORITHM,
+    )
+    return {"Authorization": f"Bearer {token}"}
+
+
+def _run(product_ids: list[str], basket_size: int, orders: int, concurrency: int, headers: dict[str, str]) -> dict:
+    payloads = [
+        {
+            "items": [
+                {"productId": product_ids[(offset + line) % len(product_ids)], "quantity": 1}
+                for line in range(basket_size)
+            ],
+            "payment": {"method": "COD"},
+        }
+        for offset in range(orders)
+    ]
+
+    def _place(payload):
+        client = app.test_client()
+        started = time.perf_counter()
+        response = client.post("/api/orders", json=payload, headers=headers)
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_place, payloads))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, status in results if status != 201)
+    return {
+        "basket": basket_size,
+        "orders": orders,
+        "failures": failures,
+        "orders_per_sec": orders / elapsed if elapsed else 0.0,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=200, help="orders per basket size")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="keep benchmark products and orders")
+    args = parser.parse_args()
+
+    product_ids = _seed(args.products)
+    headers = _auth_header()
+    print(f"Database: {Config.DATABASE_NAME}  concurrency={args.concurrency}")
+    print(f"{'items':>6} {'orders':>7} {'fail':>5} {'orders/s':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    try:
+        for basket_size in BASKET_SIZES:
+            row = _run(product_ids, basket_size, args.orders, args.concurrency, headers)
+            print(
+                f"{row['basket']:>6} {row['orders']:>7} {row['failures']:>5} "
+                f"{row['orders_per_sec']:>10.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f}"
+            )
+    finally:
+        if not args.keep:
+            db.products.delete_many({"benchmark": True})
+            db.orders.delete_many({"items.productId": {"$in": product_ids}})
+
+
+if __name__ == "__main__":
+    main()
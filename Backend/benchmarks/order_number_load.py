@@ -0,0 +1,78 @@
+"""Load test for ``OrderNumberGenerator`` uniqueness across worker processes.
+
+Spawns several processes, each with its own MongoClient and several threads,
+that generate order numbers as fast as possible against a shared counter.
+Every id is also inserted into a scratch collection with a unique index, so a
+collision fails loudly instead of only showing up in the final count.
+
+Run from the ``Backend`` directory::
+
+    JWT_SECRET_KEY=bench python -m benchmarks.order_number_load --workers 4 --per-worker 5000
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+os.environ.setdefault("DATABASE_NAME", "medicare_bench")
+
+from pymongo import InsertOne, MongoClient  # noqa: E402
+
+from config import Config  # noqa: E402
+from services.order_numbers import OrderNumberGenerator  # noqa: E402
+
+COUNTER_NAME = "orderId-loadtest"
+SCRATCH_COLLECTION = "order_number_loadtest"
+
+
+def _worker(args: tuple[int, int, int]) -> list[str]:
+    per_worker, threads, block_size = args
+    db = MongoClient(Config.MONGODB_URI)[Config.DATABASE_NAME]
+    generator = OrderNumberGenerator(db, block_size=block_size, counter_name=COUNTER_NAME)
+    per_thread = per_worker // threads
+
+    def _generate(_):
+        return [generator.next() for _ in range(per_thread)]
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        ids = [order_id for chunk in pool.map(_generate, range(threads)) for order_id in chunk]
+
+    # Unique index turns any duplicate into a BulkWriteError.
+    db[SCRATCH_COLLECTION].bulk_write([InsertOne({"_id": order_id}) for order_id in ids], ordered=False)
+    return ids
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker process")
+    parser.add_argument("--per-worker", type=int, default=5000)
+    parser.add_argument("--block-size", type=int, default=Config.ORDER_NUMBER_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    db = MongoClient(Config.MONGODB_URI)[Config.DATABASE_NAME]
+    db.counters.delete_one({"_id": COUNTER_NAME})
+    db[SCRATCH_COLLECTION].drop()
+
+    started = time.perf_counter()
+    with Pool(args.workers) as pool:
+        batches = pool.map(_worker, [(args.per_worker, args.threads, args.block_size)] * args.workers)
+    elapsed = time.perf_counter() - started
+
+    ids = [order_id for batch in batches for order_id in batch]
+    unique = len(set(ids))
+    print(f"workers={args.workers} threads={args.threads} block={args.block_size}")
+    print(f"generated={len(ids)} unique={unique} duplicates={len(ids) - unique}")
+    print(f"elapsed={elapsed:.2f}s  rate={len(ids) / elapsed:,.0f} ids/s (including verification inserts)")
+
+    db.counters.delete_one({"_id": COUNTER_NAME})
+    db[SCRATCH_COLLECTION].drop()
+    if unique != len(ids):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
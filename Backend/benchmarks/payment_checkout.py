@@ -0,0 +1,331 @@
+"""End-to-end gateway checkout benchmark against the local payment simulator.
+
+Starts the gateway simulator (``simulators.gateways``) as a separate process,
+serves the API from this process over HTTP (so the simulator can deliver
+IPNs to it) and drives complete checkouts at a fixed arrival rate:
+
+    create order -> create payment (VNPAY URL / MoMo create API)
+    -> customer pays on the simulator -> callback (VNPAY return URL / MoMo IPN)
+    -> order settled (payment status no longer Pending)
+
+Latency is measured from each checkout's *scheduled* start, so queueing
+behind a saturated API counts (no coordinated omission). The final payment
+status of every order is checked against the outcome the simulator chose.
+
+Run from the ``Backend`` directory against a real MongoDB::
+
+    JWT_SECRET_KEY=bench ENABLE_RECAPTCHA=False \\
+        python -m benchmarks.payment_checkout --rate 20 --duration 30 --method mixed \\
+        --latency-ms 50 --decline-rate 0.1 --duplicate-rate 0.2
+
+MoMo settles through the payment-events worker, so its latency includes up to
+``PAYMENT_EVENTS_POLL_SECONDS`` of polling. ``--check`` exits non-zero on any
+failed or mismatched checkout (for CI).
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import jwt
+import requests
+from bson import ObjectId
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+STAGES = ("order", "payment", "pay", "callback")
+
+
+def _configure_environment(args: argparse.Namespace) -> tuple[str, str]:
+    """Point the API at the simulator; must run before ``config`` is imported."""
+
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    sim_url = args.sim_url or f"http://127.0.0.1:{args.sim_port}"
+    # Never benchmark against the real catalogue.
+    os.environ.setdefault("DATABASE_NAME", "medicare_bench")
+    os.environ.setdefault("VNP_TMN_CODE", "SIMULATOR")
+    os.environ.setdefault("VNP_HASH_SECRET", "simulator-secret")
+    os.environ.update(
+        {
+            "MOMO_ENDPOINT": f"{sim_url}/momo/v2/gateway/api/create",
+            "MOMO_QUERY_ENDPOINT": f"{sim_url}/momo/v2/gateway/api/query",
+            "MOMO_IPN_URL": f"{api_url}/api/payment/momo/ipn",
+            "VNP_PAY_URL": f"{sim_url}/vnpay/paymentv2/vpcpay.html",
+            "VNP_QUERY_URL": f"{sim_url}/vnpay/merchant_webapi/api/transaction",
+            "VNP_RETURN_URL": f"{api_url}/vnpay_return",
+            # IPNs are applied by the payment-events background worker
+            "RUN_BACKGROUND_WORKERS": "True",
+        }
+    )
+    return api_url, sim_url
+
+
+def _start_simulator(args: argparse.Namespace, sim_url: str) -> subprocess.Popen | None:
+    if args.sim_url:
+        return None
+    command = [
+        sys.executable, "-m", "simulators.gateways", "--quiet",
+        "--port", str(args.sim_port),
+        "--latency-ms", str(args.latency_ms),
+        "--jitter-ms", str(args.jitter_ms),
+        "--failure-rate", str(args.failure_rate),
+        "--decline-rate", str(args.decline_rate),
+        "--callback-delay-ms", str(args.callback_delay_ms),
+        "--duplicate-rate", str(args.duplicate_rate),
+        "--drop-rate", str(args.drop_rate),
+    ]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{sim_url}/_sim/config", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit(f"Gateway simulator did not start on {sim_url}")
+
+
+def _seed(db, product_count: int) -> list[str]:
+    db.products.delete_many({"benchmark": True})
+    now = datetime.utcnow()
+    docs = [
+        {
+            "name": f"Bench product {index}",
+            "price": 1.5 + index % 7,
+            "stock": 10_000_000,
+            "images": [],
+            "category": "vitamins",
+            "is_active": True,
+            "benchmark": True,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        for index in range(product_count)
+    ]
+    return [str(product_id) for product_id in db.products.insert_many(docs).inserted_ids]
+
+
+def _auth_header(db, config) -> dict[str, str]:
+    user = db.users.find_one_and_update(
+        {"email": "checkout-bench@medicare.local"},
+        {"$setOnInsert": {"name": "Bench", "role": "customer", "password": "!", "createdAt": datetime.utcnow()}},
+        upsert=True,
+        return_document=True,
+    )
+    token = jwt.encode(
+        {"user_id": str(user["_id"]), "email": user["email"], "role": "customer", "exp": datetime.utcnow() + timedelta(hours=2)},
+        config.JWT_SECRET_KEY,
+        algorithm=config.JWT_ALGORITHM,
+    )
+    return {"Authorization": f"Bearer {token}"}
+
+
+class CheckoutDriver:
+    """One simulated customer checkout per ``run`` call (thread-safe)."""
+
+    def __init__(self, db, api_url: str, headers: dict[str, str], product_ids: list[str], settle_timeout: float):
+        self.db = db
+        self.api_url = api_url
+        self.headers = headers
+        self.product_ids = product_ids
+        self.settle_timeout = settle_timeout
+        self._local = threading.local()
+
+    @property
+    def http(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _wait_settled(self, order_id) -> str | None:
+        deadline = time.monotonic() + self.settle_timeout
+        while time.monotonic() < deadline:
+            order = self.db.orders.find_one({"_id": order_id}, {"payment.status": 1})
+            status = ((order or {}).get("payment") or {}).get("status")
+            if status != "Pending":
+                return status
+            time.sleep(0.02)
+        return None
+
+    def run(self, index: int, method: str, scheduled: float) -> dict:
+        result = {"method": method, "ok": False, "error": None, "stages": {}}
+        mark = scheduled
+
+        def _stage(name: str) -> None:
+            nonlocal mark
+            now = time.perf_counter()
+            result["stages"][name] = now - mark
+            mark = now
+
+        try:
+            product_id = self.product_ids[index % len(self.product_ids)]
+            response = self.http.post(
+                f"{self.api_url}/api/orders",
+                json={"items": [{"productId": product_id, "quantity": 1}], "payment": {"method": method}},
+                headers=self.headers,
+                timeout=30,
+            )
+            if response.status_code != 201:
+                raise RuntimeError(f"create order: HTTP {response.status_code}")
+            order = response.json()["order"]
+            _stage("order")
+
+            if method == "VNPAY":
+                response = self.http.post(
+                    f"{self.api_url}/api/payment/vnpay/create",
+                    json={"orderId": order["_id"], "amount": order["totalVnd"]},
+                    headers=self.headers,
+                    timeout=30,
+                )
+                pay_url = (response.json() or {}).get("paymentUrl")
+            else:
+                response = self.http.post(
+                    f"{self.api_url}/api/payment/momo", json={"orderId": order["_id"]}, headers=self.headers, timeout=30
+                )
+                pay_url = (response.json() or {}).get("payUrl")
+            if response.status_code != 200 or not pay_url:
+                raise RuntimeError(f"create payment: HTTP {response.status_code}")
+            _stage("payment")
+
+            # The customer pays; the simulator redirects back with the result.
+            response = self.http.get(pay_url, allow_redirects=False, timeout=30)
+            location = response.headers.get("Location")
+            if response.status_code != 302 or not location:
+                raise RuntimeError(f"pay: HTTP {response.status_code}")
+            returned = {key: values[0] for key, values in parse_qs(urlsplit(location).query).items()}
+            if method == "VNPAY":
+                expected = "Paid" if returned.get("vnp_ResponseCode") == "00" else "Failed"
+            else:
+                expected = "Paid" if returned.get("resultCode") == "0" else "Failed"
+            _stage("pay")
+
+            if method == "VNPAY":
+                # The browser follows the redirect to our return URL, which settles the order.
+                self.http.get(location, allow_redirects=False, timeout=30)
+            status = self._wait_settled(ObjectId(order["_id"]))
+            _stage("callback")
+            if status is None:
+                raise RuntimeError("not settled in time")
+            if status != expected:
+                raise RuntimeError(f"settled as {status}, gateway said {expected}")
+            result["ok"] = True
+        except Exception as exc:
+            result["error"] = f"{exc}"
+        result["total"] = time.perf_counter() - scheduled
+        return result
+
+
+def _percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] * 1000
+
+
+def _report(results: list[dict], elapsed: float) -> None:
+    print(f"{'method':>7} {'runs':>5} {'ok':>5} {'fail':>5} {'ok/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  p95 per stage (ms)")
+    for method in sorted({row["method"] for row in results}):
+        rows = [row for row in results if row["method"] == method]
+        ok = [row for row in rows if row["ok"]]
+        totals = [row["total"] for row in ok]
+        stages = "  ".join(
+            f"{name}={_percentile([row['stages'][name] for row in ok if name in row['stages']], 0.95):.0f}" for name in STAGES
+        )
+        print(
+            f"{method:>7} {len(rows):>5} {len(ok):>5} {len(rows) - len(ok):>5} {len(ok) / elapsed:>7.1f} "
+            f"{statistics.median(totals) * 1000 if totals else 0:>8.1f} {_percentile(totals, 0.95):>8.1f} "
+            f"{_percentile(totals, 0.99):>8.1f}  {stages}"
+        )
+    errors: dict[str, int] = {}
+    for row in results:
+        if row["error"]:
+            errors[row["error"]] = errors.get(row["error"], 0) + 1
+    for error, count in sorted(errors.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {count:>5} x {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=10, help="checkouts started per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--method", choices=["VNPAY", "MOMO", "mixed"], default="mixed")
+    parser.add_argument("--concurrency", type=int, default=32, help="max checkouts in flight")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--settle-timeout", type=float, default=30, help="seconds to wait for the callback to settle an order")
+    parser.add_argument("--api-port", type=int, default=5055)
+    parser.add_argument("--sim-port", type=int, default=9080)
+    parser.add_argument("--sim-url", default=None, help="use an already running simulator instead of starting one")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--decline-rate", type=float, default=0.1)
+    parser.add_argument("--callback-delay-ms", type=float, default=0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--keep", action="store_true", help="keep benchmark products and orders")
+    parser.add_argument("--check", action="store_true", help="exit 1 if any checkout failed")
+    parser.add_argument("--verbose", action="store_true", help="show the API's own logging")
+    args = parser.parse_args()
+
+    api_url, sim_url = _configure_environment(args)
+    simulator = _start_simulator(args, sim_url)
+    quiet = open(os.devnull, "w")
+    try:
+        from werkzeug.serving import make_server
+
+        with contextlib.redirect_stdout(quiet if not args.verbose else sys.stdout):
+            from app import app, db
+            from config import Config
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", args.api_port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="api", daemon=True).start()
+
+        product_ids = _seed(db, args.products)
+        driver = CheckoutDriver(db, api_url, _auth_header(db, Config), product_ids, args.settle_timeout)
+        total = max(1, int(args.rate * args.duration))
+        methods = ["VNPAY", "MOMO"] if args.method == "mixed" else [args.method]
+        print(f"Database: {Config.DATABASE_NAME}  simulator={sim_url}  rate={args.rate}/s  checkouts={total}")
+
+        futures = []
+        with contextlib.redirect_stdout(quiet if not args.verbose else sys.stdout):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="checkout") as pool:
+                for index in range(total):
+                    scheduled = started + index / args.rate
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    futures.append(pool.submit(driver.run, index, methods[index % len(methods)], scheduled))
+                results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - started
+
+        _report(results, elapsed)
+        stats = requests.get(f"{sim_url}/_sim/stats", timeout=5).json()
+        print(f"Simulator callbacks: {stats['callbacks']}")
+        server.shutdown()
+
+        if not args.keep:
+            db.products.delete_many({"benchmark": True})
+            db.orders.delete_many({"items.productId": {"$in": product_ids}})
+        if args.check and any(not row["ok"] for row in results):
+            raise SystemExit(1)
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
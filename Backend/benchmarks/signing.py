@@ -0,0 +1,118 @@
+"""Micro-benchmark for payment gateway signing and signature verification.
+
+Measures, single-threaded, operations per second for:
+
+* raw HMAC-SHA512 / HMAC-SHA256 over a typical payload, keying a new HMAC per
+  call (``hmac.new``) versus copying the cached pre-keyed prototype
+  (``services.signing.hmac_hex``);
+* building a signed VNPAY payment URL and verifying a VNPAY return;
+* verifying a MoMo IPN.
+
+Run from the ``Backend`` directory (no database needed)::
+
+    JWT_SECRET_KEY=bench python -m benchmarks.signing --seconds 1
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import hmac
+import os
+import time
+from typing import Callable
+
+os.environ.setdefault("VNP_TMN_CODE", "BENCHTMN")
+os.environ.setdefault("VNP_HASH_SECRET", "BENCHSECRETBENCHSECRETBENCHSECRET")
+
+from config import Config  # noqa: E402
+from momo_service import hmac_sha256, momo_canonical, verify_momo_signature  # noqa: E402
+from services.signing import hmac_hex  # noqa: E402
+from vnpay_utils import build_payment_url, canonical_query, hmac_sha512, verify_vnpay_signature  # noqa: E402
+
+
+def _vnpay_return() -> dict[str, str]:
+    params = {
+        "vnp_Amount": "36250000",
+        "vnp_BankCode": "NCB",
+        "vnp_BankTranNo": "VNP14422574",
+        "vnp_CardType": "ATM",
+        "vnp_OrderInfo": "Thanh toan don hang 6650f2a1c3b1d2e4f5a6b7c8",
+        "vnp_PayDate": "20240524153045",
+        "vnp_ResponseCode": "00",
+        "vnp_TmnCode": Config.VNP_TMN_CODE,
+        "vnp_TransactionNo": "14422574",
+        "vnp_TransactionStatus": "00",
+        "vnp_TxnRef": "6650f2a1c3b1d2e4f5a6b7c8",
+    }
+    params["vnp_SecureHash"] = hmac_sha512(Config.VNP_HASH_SECRET, canonical_query(params))
+    return params
+
+
+def _momo_ipn() -> dict:
+    payload = {
+        "partnerCode": Config.MOMO_PARTNER_CODE,
+        "orderId": "6650f2a1c3b1d2e4f5a6b7c8",
+        "requestId": "5f0c7a0e-8a57-4f51-a3e4-8d6f1f3b2c11",
+        "amount": 362500,
+        "orderInfo": "Thanh toan don hang 6650f2a1c3b1d2e4f5a6b7c8",
+        "orderType": "momo_wallet",
+        "transId": 4088878653,
+        "resultCode": 0,
+        "message": "Successful.",
+        "payType": "qr",
+        "responseTime": 1716539445000,
+        "transTime": 1716539445000,
+        "extraData": "",
+        "requestType": Config.MOMO_REQUEST_TYPE,
+    }
+    signed = {key: payload[key] for key in ("amount", "extraData", "orderId", "orderInfo", "partnerCode", "requestId", "requestType", "transId", "transTime")}
+    payload["signature"] = hmac_sha256(
+        Config.MOMO_SECRET_KEY,
+        momo_canonical({"accessKey": Config.MOMO_ACCESS_KEY, "ipnUrl": Config.MOMO_IPN_URL, "redirectUrl": Config.MOMO_REDIRECT_URL, **signed}),
+    )
+    return payload
+
+
+def _measure(fn: Callable[[], object], seconds: float) -> float:
+    """Return operations per second, calling ``fn`` in batches for about ``seconds``."""
+
+    fn()  # warm up caches
+    calls, batch = 0, 256
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(batch):
+            fn()
+        calls += batch
+    return calls / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent per case")
+    args = parser.parse_args()
+
+    vnpay_return = _vnpay_return()
+    momo_ipn = _momo_ipn()
+    assert verify_vnpay_signature(vnpay_return) and verify_momo_signature(momo_ipn)
+
+    secret = Config.VNP_HASH_SECRET
+    data = canonical_query(vnpay_return)
+    cases: list[tuple[str, Callable[[], object]]] = [
+        ("hmac-sha512 new key per call", lambda: hmac.new(secret.encode(), data.encode(), hashlib.sha512).hexdigest()),
+        ("hmac-sha512 pre-keyed copy", lambda: hmac_hex(secret, data, "sha512")),
+        ("hmac-sha256 new key per call", lambda: hmac.new(secret.encode(), data.encode(), hashlib.sha256).hexdigest()),
+        ("hmac-sha256 pre-keyed copy", lambda: hmac_hex(secret, data, "sha256")),
+        ("vnpay build_payment_url", lambda: build_payment_url("6650f2a1c3b1d2e4f5a6b7c8", 362500, "127.0.0.1", "Thanh toan don hang")),
+        ("vnpay verify return", lambda: verify_vnpay_signature(vnpay_return)),
+        ("momo verify ipn", lambda: verify_momo_signature(momo_ipn)),
+    ]
+
+    print(f"{'case':<32} {'ops/s':>12} {'us/op':>8}")
+    for name, fn in cases:
+        rate = _measure(fn, args.seconds)
+        print(f"{name:<32} {rate:>12,.0f} {1e6 / rate:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
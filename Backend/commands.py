@@ -0,0 +1,216 @@
+"""Maintenance commands exposed through ``flask --app app <group> <command>``."""
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+import click
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import current_app
+from flask.cli import AppGroup
+
+from config import Config
+from services.inventory_ledger import compact_movements, reconcile_inventory
+from services.item_categories import backfill_item_categories
+from services.order_activity import migrate_activity_logs
+from services.order_archive import archive_orders
+from services.outbox import CONSUMERS, STATUS_TOTALS, OutboxConsumer, make_consumer, rebuild_status_totals
+from services.payment_events import PaymentEventWorker, replay_events
+from services.payment_reconciliation import reconcile_pending_payments
+from services.product_sales import refresh_product_sales
+from services.revenue_rollup import CONSUMER_NAME as REVENUE_CONSUMER, rebuild_revenue_daily
+from services.status_keys import backfill_status_keys
+
+inventory_cli = AppGroup("inventory", help="Inventory ledger maintenance.")
+outbox_cli = AppGroup("outbox", help="Order lifecycle outbox consumers.")
+orders_cli = AppGroup("orders", help="Order maintenance.")
+payments_cli = AppGroup("payments", help="Payment notification queue and reconciliation.")
+
+
+@inventory_cli.command("compact")
+@click.option("--older-than-days", type=int, default=None, help="Defaults to INVENTORY_LEDGER_RETENTION_DAYS.")
+def compact_command(older_than_days):
+    """Fold old inventory movements into per-product snapshots."""
+
+    days = Config.INVENTORY_LEDGER_RETENTION_DAYS if older_than_days is None else older_than_days
+    removed = compact_movements(current_app.mongo_db, older_than_days=days)
+    click.echo(f"Compacted {removed} movements older than {days} days")
+
+
+@inventory_cli.command("reconcile")
+@click.option("--product", "product_ids", multiple=True, help="Limit the check to these product ids.")
+@click.option("--adopt", is_flag=True, help="Record the drift as ledger adjustments (opening balances).")
+def reconcile_command(product_ids, adopt):
+    """Verify products.stock against snapshots plus recorded movements."""
+
+    try:
+        ids = [ObjectId(value) for value in product_ids] or None
+    except (InvalidId, TypeError) as exc:
+        raise click.BadParameter(str(exc), param_hint="--product") from exc
+
+    drift = reconcile_inventory(current_app.mongo_db, product_ids=ids, record_adjustments=adopt)
+    for entry in drift:
+        click.echo(
+            f"{entry['productId']}  {entry.get('name') or '-'}: stock={entry['stock']} "
+            f"ledger={entry['ledger']} drift={entry['drift']:+d}"
+        )
+    if not drift:
+        click.echo("Inventory matches the ledger")
+    elif adopt:
+        click.echo(f"Recorded adjustments for {len(drift)} products")
+    else:
+        raise SystemExit(1)
+
+
+@outbox_cli.command("consume")
+@click.argument("consumer", type=click.Choice(sorted(CONSUMERS)))
+@click.option("--once", is_flag=True, help="Drain pending events and exit instead of tailing.")
+@click.option("--batch-size", type=int, default=200, show_default=True)
+@click.option("--poll-interval", type=float, default=5.0, show_default=True)
+def consume_command(consumer, once, batch_size, poll_interval):
+    """Feed order_events to CONSUMER from its stored checkpoint."""
+
+    runner = make_consumer(current_app.mongo_db, consumer, batch_size=batch_size)
+    if once:
+        try:
+            click.echo(f"Processed {runner.run_once()} events")
+        finally:
+            runner.release()
+        return
+    click.echo(f"Tailing order_events for '{consumer}' (Ctrl+C to stop)")
+    try:
+        runner.run_forever(poll_interval=poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def _rebuild_consumer(name, rebuild):
+    runner = OutboxConsumer(current_app.mongo_db, name, CONSUMERS[name][0], rebuild=rebuild)
+    if runner.acquire() is None:
+        runner.request_rebuild()
+        click.echo(f"'{name}' is running in another process; it will rebuild on its next run")
+        return
+    try:
+        click.echo(f"Rebuilt '{name}' up to event {runner.rebuild_projection()}")
+    finally:
+        runner.release()
+
+
+@outbox_cli.command("rebuild-status-totals")
+def rebuild_status_totals_command():
+    """Recompute order_status_totals from orders and the archive, then resume the consumer from there."""
+
+    _rebuild_consumer(STATUS_TOTALS, rebuild_status_totals)
+
+
+@outbox_cli.command("rebuild-revenue")
+def rebuild_revenue_command():
+    """Recompute revenue_daily from orders and the archive rollups, then resume the consumer from there."""
+
+    _rebuild_consumer(REVENUE_CONSUMER, rebuild_revenue_daily)
+
+
+@orders_cli.command("archive")
+@click.option("--older-than-days", type=int, default=None, help="Defaults to ORDER_ARCHIVE_AFTER_DAYS.")
+@click.option("--batch-size", type=int, default=500, show_default=True)
+def archive_command(older_than_days, batch_size):
+    """Move finished orders into orders_archive and update the archive rollups."""
+
+    days = Config.ORDER_ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    moved = archive_orders(current_app.mongo_db, days, batch_size=batch_size)
+    click.echo(f"Archived {moved} orders older than {days} days")
+
+
+@orders_cli.command("migrate-activity")
+@click.option("--batch-size", type=int, default=200, show_default=True)
+def migrate_activity_command(batch_size):
+    """Move embedded activityLog history into order_activity, keeping a short preview."""
+
+    migrated = migrate_activity_logs(current_app.mongo_db, batch_size=batch_size)
+    click.echo(f"Migrated activity history of {migrated} orders")
+
+
+@orders_cli.command("backfill-status-keys")
+@click.option("--batch-size", type=int, default=500, show_default=True)
+def backfill_status_keys_command(batch_size):
+    """Store statusKey / paymentStatusKey on hot and archived orders written before they existed."""
+
+    updated = backfill_status_keys(current_app.mongo_db, batch_size=batch_size)
+    click.echo(f"Set status keys on {updated} orders")
+
+
+@orders_cli.command("backfill-item-categories")
+@click.option("--batch-size", type=int, default=500, show_default=True)
+def backfill_item_categories_command(batch_size):
+    """Snapshot product categories onto items of orders (and archive rollups) written before they were stored."""
+
+    counts = backfill_item_categories(current_app.mongo_db, batch_size=batch_size)
+    click.echo(
+        f"Set item categories on {counts['orders']} orders, {counts['archived']} archived orders "
+        f"and {counts['rollups']} archive rollups"
+    )
+
+
+@orders_cli.command("refresh-product-sales")
+def refresh_product_sales_command():
+    """Rebuild the product_sales best-seller view now (the background job does this periodically)."""
+
+    products = refresh_product_sales(current_app.mongo_db)
+    click.echo(f"Refreshed sales of {products} products")
+
+
+@payments_cli.command("process")
+def process_payment_events_command():
+    """Process every due payment event now (the background worker does this continuously)."""
+
+    settled = PaymentEventWorker(current_app.mongo_db).run_once()
+    click.echo(f"Settled {settled} payment events")
+
+
+@payments_cli.command("replay")
+@click.option("--event", "event_ids", multiple=True, help="Replay these payment event ids.")
+@click.option("--order", "order_key", default=None, help="Only events for this order (TxnRef / orderId as sent by the gateway).")
+@click.option(
+    "--status",
+    type=click.Choice(["dead", "done", "pending", "all"]),
+    default="dead",
+    show_default=True,
+    help="Which stored events to queue again.",
+)
+@click.option("--since-hours", type=float, default=None, help="Only events received in the last N hours.")
+@click.option("--process", "process_now", is_flag=True, help="Process the replayed events immediately.")
+def replay_payment_events_command(event_ids, order_key, status, since_hours, process_now):
+    """Queue stored payment events for processing again."""
+
+    try:
+        ids = [ObjectId(value) for value in event_ids] or None
+    except (InvalidId, TypeError) as exc:
+        raise click.BadParameter(str(exc), param_hint="--event") from exc
+
+    since = datetime.utcnow() - timedelta(hours=since_hours) if since_hours is not None else None
+    db = current_app.mongo_db
+    replayed = replay_events(db, event_ids=ids, order_key=order_key, status=None if status == "all" else status, since=since)
+    click.echo(f"Queued {replayed} payment events again")
+    if process_now and replayed:
+        click.echo(f"Settled {PaymentEventWorker(db).run_once()} payment events")
+
+
+@payments_cli.command("reconcile")
+@click.option("--batch-size", type=int, default=200, show_default=True, help="Orders queried per run.")
+def reconcile_payments_command(batch_size):
+    """Ask VNPAY / MoMo about stale pending payments and apply their final status."""
+
+    stats = reconcile_pending_payments(current_app.mongo_db, batch_size=batch_size)
+    click.echo(
+        f"Checked {stats['checked']} payments: {stats['paid']} paid, {stats['failed']} failed, "
+        f"{stats['pending']} still pending, {stats['errors']} query errors"
+    )
+
+def register_commands(app) -> None:
+    app.cli.add_command(inventory_cli)
+    app.cli.add_command(outbox_cli)
+    app.cli.add_command(orders_cli)
+    app.cli.add_command(payments_cli)
+
+
+__all__ = ["register_commands"]
@@ -37,11 +37,98 @@ class Config:
     # Backwards-compatible name (float) - keep for any existing references
     EXCHANGE_RATE_USD_TO_VND = float(os.getenv('EXCHANGE_RATE_USD_TO_VND', EXCHANGE_RATE))
 
+    # Order numbers are reserved from the `counters` collection in blocks of this size per process
+    ORDER_NUMBER_BLOCK_SIZE = int(os.getenv('ORDER_NUMBER_BLOCK_SIZE', 100))
+
+    # Idempotency-Key handling for order creation and payment initiation
+    IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_KEY_TTL_SECONDS', 86400))
+    IDEMPOTENCY_LOCK_TIMEOUT_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT_SECONDS', 60))
+    IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 10))
+
+    # Stock held for unpaid VNPAY/MoMo orders is released after this many minutes
+    STOCK_RESERVATION_TTL_MINUTES = int(os.getenv('STOCK_RESERVATION_TTL_MINUTES', 30))
+    STOCK_RESERVATION_SWEEP_SECONDS = int(os.getenv('STOCK_RESERVATION_SWEEP_SECONDS', 60))
+
+    # Inventory ledger: movements older than the retention window are folded into snapshots
+    INVENTORY_LEDGER_RETENTION_DAYS = int(os.getenv('INVENTORY_LEDGER_RETENTION_DAYS', 30))
+    INVENTORY_COMPACTION_INTERVAL_SECONDS = int(os.getenv('INVENTORY_COMPACTION_INTERVAL_SECONDS', 86400))
+
+    # Order lifecycle outbox: events are kept this long for consumers to catch up
+    ORDER_EVENTS_TTL_DAYS = int(os.getenv('ORDER_EVENTS_TTL_DAYS', 7))
+    # One process at a time runs each outbox consumer; it holds the lease this long between runs
+    OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', 60))
+    # Order counts per status (order_status_totals): how often the outbox consumer folds new events in
+    STATUS_TOTALS_INTERVAL_SECONDS = int(os.getenv('STATUS_TOTALS_INTERVAL_SECONDS', 15))
+
+    # Finished orders older than this move to orders_archive
+    ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv('ORDER_ARCHIVE_AFTER_DAYS', 180))
+    ORDER_ARCHIVE_INTERVAL_SECONDS = int(os.getenv('ORDER_ARCHIVE_INTERVAL_SECONDS', 21600))
+
+    # Activity entries kept on the order document; the full history lives in order_activity
+    ORDER_ACTIVITY_PREVIEW_SIZE = int(os.getenv('ORDER_ACTIVITY_PREVIEW_SIZE', 5))
+
+    # Clock-skew estimate used for VNPAY timestamps (0 disables the periodic re-sync)
+    CLOCK_SYNC_INTERVAL_SECONDS = int(os.getenv('CLOCK_SYNC_INTERVAL_SECONDS', 3600))
+    CLOCK_SYNC_TIMEOUT_SECONDS = float(os.getenv('CLOCK_SYNC_TIMEOUT_SECONDS', 2))
+
+    # Outbound HTTP (MoMo, reCAPTCHA, OpenAI, ...): keep-alive pool size and circuit breaker
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 10))
+    HTTP_BREAKER_FAILURES = int(os.getenv('HTTP_BREAKER_FAILURES', 5))
+    HTTP_BREAKER_RESET_SECONDS = float(os.getenv('HTTP_BREAKER_RESET_SECONDS', 30))
+
+    # Payment IPN queue (payment_events): worker threads, retry backoff base, attempts before dead-lettering
+    PAYMENT_EVENTS_WORKERS = int(os.getenv('PAYMENT_EVENTS_WORKERS', 4))
+    PAYMENT_EVENTS_POLL_SECONDS = float(os.getenv('PAYMENT_EVENTS_POLL_SECONDS', 1))
+    PAYMENT_EVENTS_RETRY_SECONDS = int(os.getenv('PAYMENT_EVENTS_RETRY_SECONDS', 5))
+    PAYMENT_EVENTS_MAX_ATTEMPTS = int(os.getenv('PAYMENT_EVENTS_MAX_ATTEMPTS', 8))
+    PAYMENT_EVENTS_LEASE_SECONDS = int(os.getenv('PAYMENT_EVENTS_LEASE_SECONDS', 60))
+
+    # Reconciliation of gateway payments still pending after N minutes (VNPAY querydr / MoMo query API)
+    PAYMENT_RECONCILE_AFTER_MINUTES = int(os.getenv('PAYMENT_RECONCILE_AFTER_MINUTES', 15))
+    PAYMENT_RECONCILE_RECHECK_MINUTES = int(os.getenv('PAYMENT_RECONCILE_RECHECK_MINUTES', 10))
+    # Orders whose reservation expired are still asked about for this long (a late payment still wins)
+    PAYMENT_RECONCILE_EXPIRED_HOURS = int(os.getenv('PAYMENT_RECONCILE_EXPIRED_HOURS', 24))
+    PAYMENT_RECONCILE_INTERVAL_SECONDS = int(os.getenv('PAYMENT_RECONCILE_INTERVAL_SECONDS', 300))
+    PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv('PAYMENT_RECONCILE_CONCURRENCY', 4))
+    PAYMENT_RECONCILE_RATE_PER_SECOND = float(os.getenv('PAYMENT_RECONCILE_RATE_PER_SECOND', 5))
+
+    # Payment audit log: buffered in memory, flushed in batches to 'mongo' (payment_logs) or 'jsonl'
+    PAYMENT_LOG_SINK = os.getenv('PAYMENT_LOG_SINK', 'mongo').lower()
+    PAYMENT_LOG_PATH = os.getenv('PAYMENT_LOG_PATH', 'logs/payments.jsonl')
+    PAYMENT_LOG_MAX_BYTES = int(os.getenv('PAYMENT_LOG_MAX_BYTES', 10 * 1024 * 1024))
+    PAYMENT_LOG_BACKUPS = int(os.getenv('PAYMENT_LOG_BACKUPS', 5))
+    PAYMENT_LOG_BATCH_SIZE = int(os.getenv('PAYMENT_LOG_BATCH_SIZE', 200))
+    PAYMENT_LOG_FLUSH_SECONDS = float(os.getenv('PAYMENT_LOG_FLUSH_SECONDS', 1.0))
+    PAYMENT_LOG_QUEUE_SIZE = int(os.getenv('PAYMENT_LOG_QUEUE_SIZE', 10000))
+    PAYMENT_LOG_TTL_DAYS = int(os.getenv('PAYMENT_LOG_TTL_DAYS', 90))
+
+    # Daily revenue rollups (revenue_daily): how often the outbox consumer folds new order events in
+    REVENUE_ROLLUP_INTERVAL_SECONDS = int(os.getenv('REVENUE_ROLLUP_INTERVAL_SECONDS', 15))
+
+    # Admin dashboard summary tiles are cached this long and shared by concurrent requests (0 = always recompute)
+    DASHBOARD_SUMMARY_TTL_SECONDS = float(os.getenv('DASHBOARD_SUMMARY_TTL_SECONDS', 30))
+
+    # Best sellers (product_sales): refresh interval of the materialised view and cache of /api/products/featured
+    PRODUCT_SALES_REFRESH_SECONDS = int(os.getenv('PRODUCT_SALES_REFRESH_SECONDS', 600))
+    FEATURED_PRODUCTS_CACHE_SECONDS = float(os.getenv('FEATURED_PRODUCTS_CACHE_SECONDS', 60))
+
+    # Payment status push (GET /api/orders/<id>/payment-events): long-poll wait, SSE lifetime,
+    # cross-process recheck interval and the cap on connections held per process
+    PAYMENT_STREAM_TIMEOUT_SECONDS = float(os.getenv('PAYMENT_STREAM_TIMEOUT_SECONDS', 30))
+    PAYMENT_STREAM_MAX_SECONDS = float(os.getenv('PAYMENT_STREAM_MAX_SECONDS', 300))
+    PAYMENT_STREAM_RECHECK_SECONDS = float(os.getenv('PAYMENT_STREAM_RECHECK_SECONDS', 2))
+    PAYMENT_STREAM_HEARTBEAT_SECONDS = float(os.getenv('PAYMENT_STREAM_HEARTBEAT_SECONDS', 15))
+    PAYMENT_STREAM_MAX_WAITERS = int(os.getenv('PAYMENT_STREAM_MAX_WAITERS', 200))
+
+    # Background jobs (reservation sweeper, ...) run inside the API process unless disabled
+    RUN_BACKGROUND_WORKERS = os.getenv('RUN_BACKGROUND_WORKERS', 'True').lower() in {'true', '1', 'yes'}
+
     # VNPAY configuration
     VNP_TMN_CODE = os.getenv('VNP_TMN_CODE')
     VNP_HASH_SECRET = os.getenv('VNP_HASH_SECRET')
     VNP_PAY_URL = os.getenv('VNP_PAY_URL', 'https://sandbox.vnpayment.vn/paymentv2/vpcpay.html')
     VNP_RETURN_URL = os.getenv('VNP_RETURN_URL', 'http://localhost:5000/vnpay_return')
+    VNP_QUERY_URL = os.getenv('VNP_QUERY_URL', 'https://sandbox.vnpayment.vn/merchant_webapi/api/transaction')
     VNP_VERSION = '2.1.0'
     VNP_COMMAND = 'pay'
 
@@ -50,6 +137,7 @@ class Config:
 
     # MoMo configuration
     MOMO_ENDPOINT = os.getenv('MOMO_ENDPOINT', 'https://test-payment.momo.vn/v2/gateway/api/create')
+    MOMO_QUERY_ENDPOINT = os.getenv('MOMO_QUERY_ENDPOINT', 'https://test-payment.momo.vn/v2/gateway/api/query')
     MOMO_PARTNER_CODE = os.getenv('MOMO_PARTNER_CODE', 'MOMO')
     MOMO_ACCESS_KEY = os.getenv('MOMO_ACCESS_KEY', 'F8BBA842ECF85')
     MOMO_SECRET_KEY = os.getenv('MOMO_SECRET_KEY', 'K951B6PE1waDMi640xX08PD3vg6EkVlz')
@@ -2,28 +2,36 @@
 
 from __future__ import annotations
 
-import hashlib
-import hmac
 import json
 import uuid
-from typing import Dict
+from typing import Any, Dict
 from datetime import datetime
 
-import requests
-
 from config import Config
+from services import http_client, payment_log
+from services.signing import hmac_hex, signatures_match
 
 
 def hmac_sha256(key: str, data: str) -> str:
     """Return the hexadecimal SHA256 HMAC for the given data."""
-    return hmac.new(key.encode('utf-8'), data.encode('utf-8'), hashlib.sha256).hexdigest()
+    return hmac_hex(key, data, 'sha256')
+
+
+def momo_canonical(fields: Dict[str, Any]) -> str:
+    """
+    Raw string MoMo signs: ``key=value`` pairs sorted by key (a-z), joined by ``&``, values not encoded.
+
+    Used for every MoMo signature (create, query, IPN) on both the signing and verifying side.
+    """
+    return '&'.join(f"{key}={'' if value is None else value}" for key, value in sorted(fields.items()))
 
 
-def create_momo_payment(order: dict) -> dict:
+def create_momo_payment(db, order: dict) -> dict:
     """
     Create MoMo payment request.
     
     Args:
+        db: The application's database handle (shares the app connection pool)
         order: Order document from MongoDB with:
             - _id: order ID
             - total_usd: total in USD (float)
@@ -53,9 +61,6 @@ def create_momo_payment(order: dict) -> dict:
             usd_total = 0
         order_total_vnd = int(round(usd_total * Config.EXCHANGE_RATE))
         # Persist computed VND total back to order document
-        from pymongo import MongoClient
-        client = MongoClient(Config.MONGODB_URI)
-        db = client[Config.DATABASE_NAME]
         db.orders.update_one({'_id': order['_id']}, {'$set': {'totalVnd': order_total_vnd}})
         print(f"💾 Saved computed totalVnd={order_total_vnd} to order {order['_id']}")
 
@@ -69,18 +74,18 @@ def create_momo_payment(order: dict) -> dict:
     
     # Build raw signature for HMAC SHA256
     # Format: accessKey=<key>&amount=<amount>&extraData=<data>&ipnUrl=<url>&orderId=<id>&orderInfo=<info>&partnerCode=<code>&redirectUrl=<url>&requestId=<reqId>&requestType=<type>
-    raw_signature = (
-        f"accessKey={Config.MOMO_ACCESS_KEY}"
-        f"&amount={amount}"
-        f"&extraData="
-        f"&ipnUrl={Config.MOMO_IPN_URL}"
-        f"&orderId={order_id}"
-        f"&orderInfo={order_info}"
-        f"&partnerCode={Config.MOMO_PARTNER_CODE}"
-        f"&redirectUrl={Config.MOMO_REDIRECT_URL}"
-        f"&requestId={request_id}"
-        f"&requestType={Config.MOMO_REQUEST_TYPE}"
-    )
+    raw_signature = momo_canonical({
+        'accessKey': Config.MOMO_ACCESS_KEY,
+        'amount': amount,
+        'extraData': '',
+        'ipnUrl': Config.MOMO_IPN_URL,
+        'orderId': order_id,
+        'orderInfo': order_info,
+        'partnerCode': Config.MOMO_PARTNER_CODE,
+        'redirectUrl': Config.MOMO_REDIRECT_URL,
+        'requestId': request_id,
+        'requestType': Config.MOMO_REQUEST_TYPE,
+    })
     
     # Generate HMAC SHA256 signature
     signature = hmac_sha256(Config.MOMO_SECRET_KEY, raw_signature)
@@ -102,20 +107,21 @@ def create_momo_payment(order: dict) -> dict:
         'signature': signature
     }
     
-    print(f"📤 MoMo Request - orderId={order_id}, amount_vnd={amount}, requestId={request_id}")
-    
     try:
-        response = requests.post(
+        response = http_client.post(
+            'momo',
             Config.MOMO_ENDPOINT,
             data=json.dumps(payload),
             headers={'Content-Type': 'application/json'},
-            timeout=10
         )
         result = response.json()
-        print(f"📥 MoMo Response - resultCode={result.get('resultCode')}, payUrl exists={bool(result.get('payUrl'))}")
+        payment_log.record(
+            'create_requested', 'momo', order_id,
+            requestId=request_id, amountVnd=amount, resultCode=result.get('resultCode'), message=result.get('message'),
+        )
         return result
     except Exception as e:
-        print(f"❌ MoMo API Error: {str(e)}")
+        payment_log.record('create_error', 'momo', order_id, level='error', requestId=request_id, amountVnd=amount, error=str(e))
         return {
             'success': False,
             'message': str(e),
@@ -123,6 +129,42 @@ def create_momo_payment(order: dict) -> dict:
         }
 
 
+def query_momo_payment(order_id: str) -> dict:
+    """
+    Query MoMo for the current status of a payment.
+
+    Args:
+        order_id: orderId the payment was created with (the order's _id)
+
+    Returns:
+        MoMo query API response dict (resultCode, amount, transId, ...).
+        Network errors are raised to the caller. Runs under the separate
+        ``momo-query`` breaker, so failing queries never block checkout.
+    """
+    request_id = str(uuid.uuid4())
+    raw_signature = momo_canonical({
+        'accessKey': Config.MOMO_ACCESS_KEY,
+        'orderId': order_id,
+        'partnerCode': Config.MOMO_PARTNER_CODE,
+        'requestId': request_id,
+    })
+    payload = {
+        'partnerCode': Config.MOMO_PARTNER_CODE,
+        'requestId': request_id,
+        'orderId': order_id,
+        'lang': 'vi',
+        'signature': hmac_sha256(Config.MOMO_SECRET_KEY, raw_signature),
+    }
+    response = http_client.post(
+        'momo-query',
+        Config.MOMO_QUERY_ENDPOINT,
+        data=json.dumps(payload),
+        headers={'Content-Type': 'application/json'},
+    )
+    response.raise_for_status()
+    return response.json()
+
+
 def verify_momo_signature(data: Dict[str, str]) -> bool:
     """
     Verify MoMo IPN signature.
@@ -143,35 +185,29 @@ def verify_momo_signature(data: Dict[str, str]) -> bool:
     
     momo_signature = data.get('signature')
     if not momo_signature:
-        print("⚠️ Missing signature in MoMo IPN")
         return False
     
     # MoMo IPN signature is built from: accessKey, amount, extraData, ipnUrl, orderId, orderInfo, partnerCode, redirectUrl, requestId, requestType, transId, transTime
     # For verification, we typically use: accessKey + amount + orderId + partnerCode + requestId + requestType + transId + transTime
     # Refer to MoMo documentation for exact fields in IPN
     
-    access_key = Config.MOMO_ACCESS_KEY
-    
     # Build raw data for signature verification (based on MoMo's IPN format)
-    raw_data = (
-        f"accessKey={access_key}"
-        f"&amount={data.get('amount', '')}"
-        f"&extraData={data.get('extraData', '')}"
-        f"&ipnUrl={Config.MOMO_IPN_URL}"
-        f"&orderId={data.get('orderId', '')}"
-        f"&orderInfo={data.get('orderInfo', '')}"
-        f"&partnerCode={data.get('partnerCode', '')}"
-        f"&redirectUrl={Config.MOMO_REDIRECT_URL}"
-        f"&requestId={data.get('requestId', '')}"
-        f"&requestType={data.get('requestType', '')}"
-        f"&transId={data.get('transId', '')}"
-        f"&transTime={data.get('transTime', '')}"
-    )
+    raw_data = momo_canonical({
+        'accessKey': Config.MOMO_ACCESS_KEY,
+        'amount': data.get('amount', ''),
+        'extraData': data.get('extraData', ''),
+        'ipnUrl': Config.MOMO_IPN_URL,
+        'orderId': data.get('orderId', ''),
+        'orderInfo': data.get('orderInfo', ''),
+        'partnerCode': data.get('partnerCode', ''),
+        'redirectUrl': Config.MOMO_REDIRECT_URL,
+        'requestId': data.get('requestId', ''),
+        'requestType': data.get('requestType', ''),
+        'transId': data.get('transId', ''),
+        'transTime': data.get('transTime', ''),
+    })
     
     calculated_signature = hmac_sha256(Config.MOMO_SECRET_KEY, raw_data)
     
-    is_valid = calculated_signature.lower() == momo_signature.lower()
-    if not is_valid:
-        print(f"⚠️ MoMo signature mismatch. Expected={calculated_signature}, Got={momo_signature}")
-    
-    return is_valid
+    # Constant-time comparison; callers record rejected payloads in the payment audit log
+    return signatures_match(calculated_signature, momo_signature)
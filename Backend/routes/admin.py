@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 from datetime import datetime
+import os
 import random
 import string
 from typing import Any
@@ -10,8 +11,12 @@ import bcrypt
 from bson import ObjectId
 from bson.errors import InvalidId
 from flask import Blueprint, current_app, jsonify, request
+from pymongo import ReturnDocument
 
 from constants.categories import ALLOWED_CATEGORY_SLUGS
+from services import http_client
+from services.inventory_ledger import ADMIN_ADJUST, INITIAL_STOCK, movement, record_movements
+from services.order_archive import find_orders
 from utils.auth import admin_required, token_required
 from utils.helpers import (
     build_paginated_response,
@@ -195,7 +200,7 @@ def get_product(current_user, product_id):  # pylint: disable=unused-argument
 @admin_bp.route("/products", methods=["POST"])
 @token_required
 @admin_required
-def create_product(current_user):  # pylint: disable=unused-argument
+def create_product(current_user):
     db = _get_db()
     data = request.get_json(force=True, silent=True) or {}
     errors, payload = _validate_product_payload(data)
@@ -228,6 +233,9 @@ def create_product(current_user):  # pylint: disable=unused-argument
 
     result = db.products.insert_one(product_doc)
     product_doc["_id"] = result.inserted_id
+    record_movements(
+        db, [movement(result.inserted_id, product_doc["stock"], INITIAL_STOCK, actor=current_user.get("_id"))]
+    )
 
     return (
         jsonify({"message": "Product created", "product": _serialize_product(product_doc)}),
@@ -238,7 +246,7 @@ def create_product(current_user):  # pylint: disable=unused-argument
 @admin_bp.route("/products/<product_id>", methods=["PUT", "PATCH"])  # allow PATCH for admin updates
 @token_required
 @admin_required
-def update_product(current_user, product_id):  # pylint: disable=unused-argument
+def update_product(current_user, product_id):
     db = _get_db()
     object_id = _parse_object_id(product_id)
     if not object_id:
@@ -272,7 +280,15 @@ def update_product(current_user, product_id):  # pylint: disable=unused-argument
         update_fields["specifications"] = payload.get("specifications", [])
     update_fields["updatedAt"] = datetime.utcnow()
 
-    db.products.update_one({"_id": object_id}, {"$set": update_fields})
+    # Read the pre-update stock atomically so concurrent checkouts cannot skew the ledger delta.
+    previous = db.products.find_one_and_update(
+        {"_id": object_id}, {"$set": update_fields}, projection={"stock": 1}, return_document=ReturnDocument.BEFORE
+    )
+    if previous is None:
+        return jsonify({"error": "Product not found"}), 404
+    if "stock" in update_fields:
+        delta = int(update_fields["stock"]) - int(previous.get("stock") or 0)
+        record_movements(db, [movement(object_id, delta, ADMIN_ADJUST, actor=current_user.get("_id"))])
     updated = db.products.find_one({"_id": object_id})
     return jsonify({"message": "Product updated", "product": _serialize_product(updated)})
 
@@ -347,8 +363,7 @@ def get_user(current_user, user_id):
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    orders_cursor = db.orders.find({"userId": str(user["_id"])})
-    orders = list(orders_cursor)
+    orders = find_orders(db, {"userId": str(user["_id"])}, projection={"total": 1, "createdAt": 1})
     total_spent = sum(order.get("total", 0) or 0 for order in orders)
 
     user.pop("password", None)
@@ -466,3 +481,12 @@ def update_user_role(current_user, user_id):
     updated = db.users.find_one({"_id": object_id})
     updated.pop("password", None)
     return jsonify({"message": "Role updated", "user": serialize_doc(updated)})
+
+
+@admin_bp.route("/system/http", methods=["GET"])
+@token_required
+@admin_required
+def outbound_http_metrics(current_user):  # pylint: disable=unused-argument
+    """Latency, error counts and circuit state of outbound services (this process only)."""
+
+    return jsonify({"pid": os.getpid(), "services": http_client.metrics()})
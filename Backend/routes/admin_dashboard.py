@@ -8,6 +8,8 @@ from bson.decimal128 import Decimal128
 from bson.errors import InvalidId
 from flask import Blueprint, current_app, jsonify, request
 
+from services.dashboard_summary import dashboard_summary
+from services.revenue_rollup import revenue_series
 from utils.auth import admin_required, token_required
 
 
@@ -52,44 +54,17 @@ dashboard_bp = Blueprint(
 def get_summary(current_user):  # pylint: disable=unused-argument
     """Return aggregated metrics for the admin overview."""
 
-    db = _get_db()
-
-    total_users = db.users.count_documents({})
-    total_orders = db.orders.count_documents({})
-    active_products = db.products.count_documents(
-        {"$or": [{"is_active": True}, {"stock": {"$gt": 0}}]}
-    )
-
-    revenue_pipeline = [
-        {
-            "$match": {
-                "$expr": {
-                    "$in": [
-                        {"$toLower": {"$ifNull": ["$status", ""]}},
-                        list(STATUSES_FOR_REVENUE),
-                    ]
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": None,
-                "total_revenue": {"$sum": {"$ifNull": ["$total", 0]}},
-            }
-        },
-    ]
-
-    revenue_result = list(db.orders.aggregate(revenue_pipeline))
-    total_revenue = (
-        _to_float(revenue_result[0].get("total_revenue")) if revenue_result else 0.0
+    summary, age = dashboard_summary(
+        _get_db(), STATUSES_FOR_REVENUE, {"$or": [{"is_active": True}, {"stock": {"$gt": 0}}]}
     )
-
     return jsonify(
         {
-            "total_revenue": total_revenue,
-            "total_orders": total_orders,
-            "total_users": total_users,
-            "active_products": active_products,
+            "total_revenue": summary["revenue"],
+            "total_orders": summary["orders"],
+            "total_users": summary["users"],
+            "active_products": summary["activeProducts"],
+            "computed_at": _isoformat(summary["computedAt"]),
+            "cache_age_seconds": round(age, 1),
         }
     )
 
@@ -215,43 +190,10 @@ def get_revenue_series(current_user):  # pylint: disable=unused-argument
 
     start_date = datetime.utcnow() - timedelta(days=days - 1)
 
-    pipeline = [
-        {
-            "$match": {
-                "$and": [
-                    {
-                        "$expr": {
-                            "$in": [
-                                {"$toLower": {"$ifNull": ["$status", ""]}},
-                                list(STATUSES_FOR_REVENUE),
-                            ]
-                        }
-                    },
-                    {"createdAt": {"$gte": start_date}},
-                ]
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}
-                },
-                "revenue": {"$sum": {"$ifNull": ["$total", 0]}},
-                "orders": {"$sum": 1},
-            }
-        },
-        {"$sort": {"_id": 1}},
-    ]
-
-    buckets = list(db.orders.aggregate(pipeline))
-
+    # One revenue_daily document per day (kept current from the order outbox)
     series = [
-        {
-            "date": bucket.get("_id"),
-            "revenue": _to_float(bucket.get("revenue")),
-            "orders": int(bucket.get("orders", 0)),
-        }
-        for bucket in buckets
+        {"date": row["date"], "revenue": row["revenue"], "orders": row["orders"]}
+        for row in revenue_series(db, start_date, statuses=STATUSES_FOR_REVENUE)
     ]
 
     return jsonify(series)
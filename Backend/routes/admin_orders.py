@@ -9,6 +9,12 @@ from bson import ObjectId
 from bson.errors import InvalidId
 from flask import Blueprint, current_app, jsonify, request
 
+from services.order_activity import add_activity, list_activity, migrate_order, record_activity
+from services.order_archive import can_be_archived, count_orders, find_orders
+from services.order_lookup import find_order
+from services import outbox
+from services.reservations import release_reservation
+from services.status_keys import status_key, status_key_match
 from utils.auth import admin_required, token_required
 from utils.helpers import safe_float, serialize_doc
 
@@ -139,10 +145,10 @@ def _serialise_activity(entries: Iterable[dict[str, Any]] | None) -> list[dict[s
                 "status": _canonical_status(entry.get("status")) if entry.get("status") else None,
                 "message": entry.get("message") or entry.get("note"),
                 "actor": entry.get("actor"),
+                "fields": entry.get("fields"),
                 "timestamp": _to_iso(entry.get("timestamp")),
             }
         )
-    serialised.sort(key=lambda item: item.get("timestamp") or "")
     return serialised
 
 
@@ -207,17 +213,22 @@ def _serialise_order(order: dict[str, Any], user: dict[str, Any] | None) -> dict
         "notes": order.get("notes") or "",
         "created_at": _to_iso(order.get("createdAt")),
         "updated_at": _to_iso(order.get("updatedAt")),
-        "activity_log": _serialise_activity(order.get("activityLog")),
+        "activity_log": sorted(
+            _serialise_activity(order.get("activityLog")), key=lambda item: item.get("timestamp") or ""
+        ),
     }
 
 
 def _find_order(db, identifier: str) -> dict[str, Any] | None:
-    object_id = _parse_object_id(identifier)
-    if object_id:
-        order = db.orders.find_one({"_id": object_id})
-        if order:
-            return order
-    return db.orders.find_one({"orderId": identifier})
+    return find_order(db, identifier, include_archive=True)
+
+
+def _migrate_activity(db, order: dict[str, Any]) -> None:
+    migrate_order(db, order, db.orders_archive if order.get("archivedAt") else None)
+
+
+def _archived_response(order: dict[str, Any]):
+    return jsonify({"error": "Archived orders are read-only", "archivedAt": _to_iso(order.get("archivedAt"))}), 409
 
 
 def _prepare_shipping_updates(payload: dict[str, Any]) -> tuple[dict[str, Any], list[str]]:
@@ -326,7 +337,7 @@ def list_orders(current_user):  # pylint: disable=unused-argument
         canonical_status = _canonical_status(status_param)
         if canonical_status not in VALID_STATUSES:
             return jsonify({"error": "Invalid status filter"}), 400
-        query["status"] = {"$regex": f"^{canonical_status}$", "$options": "i"}
+        query.update(status_key_match(db, [status_key(canonical_status)]))
 
     if q:
         or_conditions: list[dict[str, Any]] = []
@@ -365,14 +376,17 @@ def list_orders(current_user):  # pylint: disable=unused-argument
     sort_key = sort_param.lstrip("+-").lower()
     sort_field = SORT_FIELD_MAP.get(sort_key, "createdAt")
 
-    total = db.orders.count_documents(query)
-    cursor = (
-        db.orders.find(query)
-        .sort(sort_field, sort_direction)
-        .skip((page - 1) * limit)
-        .limit(limit)
+    include_archive = can_be_archived(canonical_status if status_param else None)
+    total = count_orders(db, query, include_archive=include_archive)
+    orders = find_orders(
+        db,
+        query,
+        sort_field,
+        sort_direction,
+        skip=(page - 1) * limit,
+        limit=limit,
+        include_archive=include_archive,
     )
-    orders = list(cursor)
 
     users_map = _collect_user_map(db, orders)
     items = [_serialise_order_summary(order, users_map.get(order.get("userId"))) for order in orders]
@@ -394,6 +408,30 @@ def get_order(current_user, order_id):  # pylint: disable=unused-argument
     return jsonify(_serialise_order(order, user))
 
 
+@admin_orders_bp.route("/<order_id>/activity", methods=["GET"])
+@token_required
+@admin_required
+def get_order_activity(current_user, order_id):  # pylint: disable=unused-argument
+    db = _get_db()
+    order = _find_order(db, order_id)
+    if not order:
+        return jsonify({"error": "Order not found"}), 404
+
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except (TypeError, ValueError):
+        page = 1
+    try:
+        limit = int(request.args.get("limit", 20))
+    except (TypeError, ValueError):
+        limit = 20
+    limit = min(max(limit, 1), 100)
+
+    _migrate_activity(db, order)
+    entries, total = list_activity(db, order["_id"], page, limit)
+    return jsonify({"items": _serialise_activity(entries), "total": total, "page": page, "limit": limit})
+
+
 @admin_orders_bp.route("/<order_id>/status", methods=["PATCH"])  # allow PATCH for admin updates
 @token_required
 @admin_required
@@ -402,6 +440,8 @@ def update_order_status(current_user, order_id):
     order = _find_order(db, order_id)
     if not order:
         return jsonify({"error": "Order not found"}), 404
+    if order.get("archivedAt"):
+        return _archived_response(order)
 
     payload = request.get_json(force=True, silent=True) or {}
     new_status = _canonical_status(payload.get("status"))
@@ -437,13 +477,16 @@ def update_order_status(current_user, order_id):
         message=payload.get("message") or f"Status changed to {new_status}",
     )
 
-    update_doc: dict[str, Any] = {
-        "$set": {"status": new_status, "updatedAt": datetime.utcnow()},
-        "$push": {"activityLog": activity_entry},
-    }
+    update_doc: dict[str, Any] = {"$set": {"status": new_status, "updatedAt": datetime.utcnow()}}
+    add_activity(update_doc, activity_entry)
 
-    db.orders.update_one({"_id": order["_id"]}, update_doc)
-    updated = db.orders.find_one({"_id": order["_id"]})
+    _migrate_activity(db, order)
+    updated = outbox.update_order(db, order, update_doc, actor=actor)
+    if updated is None:
+        return jsonify({"error": "Order not found"}), 404
+    record_activity(db, order, activity_entry)
+    if new_status == "Cancelled":
+        release_reservation(db, order["_id"], "cancelled")
 
     users_map = _collect_user_map(db, [updated])
     return jsonify(_serialise_order(updated, users_map.get(updated.get("userId"))))
@@ -457,6 +500,8 @@ def update_order(current_user, order_id):
     order = _find_order(db, order_id)
     if not order:
         return jsonify({"error": "Order not found"}), 404
+    if order.get("archivedAt"):
+        return _archived_response(order)
 
     payload = request.get_json(force=True, silent=True) or {}
 
@@ -510,10 +555,14 @@ def update_order(current_user, order_id):
             message="Updated order details",
             fields=changed_fields,
         )
-        update_doc.setdefault("$push", {})["activityLog"] = activity_entry
+        add_activity(update_doc, activity_entry)
+        _migrate_activity(db, order)
 
-    db.orders.update_one({"_id": order["_id"]}, update_doc)
-    updated = db.orders.find_one({"_id": order["_id"]})
+    updated = outbox.update_order(db, order, update_doc, actor=actor)
+    if updated is None:
+        return jsonify({"error": "Order not found"}), 404
+    if changed_fields:
+        record_activity(db, order, activity_entry)
 
     users_map = _collect_user_map(db, [updated])
     return jsonify(_serialise_order(updated, users_map.get(updated.get("userId"))))
@@ -522,11 +571,22 @@ def update_order(current_user, order_id):
 @admin_orders_bp.route("/<order_id>", methods=["DELETE"])
 @token_required
 @admin_required
-def delete_order(current_user, order_id):  # pylint: disable=unused-argument
+def delete_order(current_user, order_id):
     db = _get_db()
     order = _find_order(db, order_id)
     if not order:
         return jsonify({"error": "Order not found"}), 404
+    if order.get("archivedAt"):
+        return _archived_response(order)
 
-    db.orders.delete_one({"_id": order["_id"]})
+    # Units of an order that never shipped go back on the shelf, as on cancel
+    if status_key(order.get("status")) != "delivered":
+        release_reservation(db, order["_id"], "deleted")
+    actor = {
+        "id": str(current_user.get("_id")),
+        "name": current_user.get("name") or current_user.get("email"),
+    }
+    if not outbox.delete_order(db, order, actor=actor):
+        return jsonify({"error": "Order not found"}), 404
+    db.order_activity.delete_many({"orderId": order["_id"]})
     return "", 204
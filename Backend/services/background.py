@@ -0,0 +1,62 @@
+"""In-process periodic background jobs.
+
+Jobs run on daemon threads next to the Flask app. Every job must be safe to
+run concurrently from several processes (gunicorn workers, the debug
+reloader), so they claim work with conditional updates rather than relying on
+being the only runner.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Callable
+
+_workers: dict[str, "PeriodicWorker"] = {}
+_lock = threading.Lock()
+
+
+class PeriodicWorker(threading.Thread):
+    """Call ``job`` every ``interval`` seconds until stopped."""
+
+    def __init__(self, name: str, job: Callable[[], object], interval: float, run_immediately: bool = True):
+        super().__init__(name=name, daemon=True)
+        self.job = job
+        self.interval = max(float(interval), 0.1)
+        self.run_immediately = run_immediately
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        if self.run_immediately:
+            self._run_once()
+        while not self._stop_event.wait(self.interval):
+            self._run_once()
+
+    def _run_once(self) -> None:
+        try:
+            self.job()
+        except Exception as exc:  # pragma: no cover - keep the worker alive
+            print(f"Warning: background job {self.name} failed: {exc}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def start_periodic(name: str, job: Callable[[], object], interval: float, run_immediately: bool = True) -> PeriodicWorker:
+    """Start ``job`` on a named daemon thread once per process."""
+
+    with _lock:
+        worker = _workers.get(name)
+        if worker is None or not worker.is_alive():
+            worker = PeriodicWorker(name, job, interval, run_immediately)
+            _workers[name] = worker
+            worker.start()
+        return worker
+
+
+def stop_all() -> None:
+    with _lock:
+        for worker in _workers.values():
+            worker.stop()
+        _workers.clear()
+
+
+__all__ = ["PeriodicWorker", "start_periodic", "stop_all"]
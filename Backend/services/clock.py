@@ -0,0 +1,106 @@
+"""Clock-skew estimate against public time sources.
+
+VNPAY rejects payment URLs whose ``vnp_CreateDate`` is far from its own clock,
+so we correct for a skewed host clock. The offset between a remote UTC
+reading and the local clock is measured in the background (at startup and
+every ``Config.CLOCK_SYNC_INTERVAL_SECONDS``) and cached; ``utc_now`` and
+``now_gmt7`` only add the cached offset and never touch the network.
+
+Without network access every probe fails, the offset stays at zero and the
+system clock is used unchanged.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable
+
+from config import Config
+from services import http_client
+
+GMT7 = timedelta(hours=7)
+
+_lock = threading.Lock()
+_offset = timedelta(0)
+_measured_at: datetime | None = None
+
+
+def _worldtimeapi(timeout: float) -> datetime:
+    resp = http_client.get("clock", "https://worldtimeapi.org/api/timezone/Asia/Ho_Chi_Minh", timeout=timeout)
+    resp.raise_for_status()
+    return datetime.fromisoformat(resp.json()["datetime"]).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _timeapi(timeout: float) -> datetime:
+    resp = http_client.get("clock", "https://timeapi.io/api/Time/current/zone?timeZone=UTC", timeout=timeout)
+    resp.raise_for_status()
+    data = resp.json()
+    return datetime(data["year"], data["month"], data["day"], data["hour"], data["minute"], int(data["seconds"]))
+
+
+def _http_date(timeout: float) -> datetime:
+    # Only second resolution, hence the last resort.
+    resp = http_client.head("clock", "https://www.google.com", timeout=timeout)
+    return parsedate_to_datetime(resp.headers["Date"]).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+SOURCES: list[tuple[str, Callable[[float], datetime]]] = [
+    ("worldtimeapi.org", _worldtimeapi),
+    ("timeapi.io", _timeapi),
+    ("http-date", _http_date),
+]
+
+
+def measure_offset(timeout: float | None = None) -> tuple[timedelta, str] | None:
+    """Probe the sources in order; return ``(remote - local, source)`` from the first that answers."""
+
+    timeout = Config.CLOCK_SYNC_TIMEOUT_SECONDS if timeout is None else timeout
+    for name, fetch in SOURCES:
+        started = time.monotonic()
+        local_before = datetime.utcnow()
+        try:
+            remote = fetch(timeout)
+        except Exception:
+            continue
+        # Assume the remote reading was taken half way through the round trip.
+        local = local_before + timedelta(seconds=(time.monotonic() - started) / 2)
+        return remote - local, name
+    return None
+
+
+def refresh_offset() -> bool:
+    """Re-measure the skew; the previous estimate is kept when no source answers."""
+
+    global _offset, _measured_at
+    measured = measure_offset()
+    if measured is None:
+        return False
+    offset, source = measured
+    with _lock:
+        _offset, _measured_at = offset, datetime.utcnow()
+    if abs(offset) > timedelta(seconds=5):
+        print(f"Warning: local clock is off by {offset.total_seconds():.1f}s (per {source})")
+    return True
+
+
+def utc_now() -> datetime:
+    """Naive UTC now, corrected by the cached offset."""
+
+    return datetime.utcnow() + _offset
+
+
+def now_gmt7() -> datetime:
+    """Naive GMT+7 (Asia/Ho_Chi_Minh) now, corrected by the cached offset."""
+
+    return utc_now() + GMT7
+
+
+__all__ = [
+    "GMT7",
+    "measure_offset",
+    "now_gmt7",
+    "refresh_offset",
+    "utc_now",
+]
@@ -0,0 +1,123 @@
+"""Admin dashboard summary tiles, computed concurrently and cached briefly.
+
+The overview tiles (revenue, orders, users, active products) come from four
+independent collections, so they are queried in parallel: the summary costs
+one round trip of the slowest query instead of the sum of all of them.
+
+Dashboards auto-refresh, often from several admins at once, so the result is
+kept for ``Config.DASHBOARD_SUMMARY_TTL_SECONDS``. Requests arriving while a
+summary is being computed wait for that computation instead of starting their
+own (request coalescing), and every response reports how old its numbers are.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Iterable
+
+from bson.decimal128 import Decimal128
+
+from config import Config
+from services.order_archive import archived_order_stats
+from services.status_keys import status_key, status_key_match, status_keys
+
+
+class _SummaryCache:
+    """Per-key TTL cache where concurrent misses share a single computation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[Any, tuple[float, dict[str, Any]]] = {}
+        self._pending: dict[Any, threading.Event] = {}
+
+    def get(self, key: Any, ttl: float, compute: Callable[[], dict[str, Any]]) -> tuple[dict[str, Any], float]:
+        """Return ``(value, age_seconds)``, computing ``value`` when the cached one is older than ``ttl``."""
+
+        asked_at = time.monotonic()
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                # A result finished while we waited is fresh enough for us, even with ttl=0.
+                if entry and (time.monotonic() - entry[0] < ttl or entry[0] >= asked_at):
+                    return entry[1], time.monotonic() - entry[0]
+                pending = self._pending.get(key)
+                leader = pending is None
+                if leader:
+                    pending = self._pending[key] = threading.Event()
+            if not leader:
+                pending.wait()
+                continue  # the leader may have failed; re-check and take over if so
+            try:
+                value = compute()
+                with self._lock:
+                    self._entries[key] = (time.monotonic(), value)
+                return value, 0.0
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+                pending.set()
+
+
+_cache = _SummaryCache()
+
+
+def _number(value: Any) -> float:
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    return float(value or 0)
+
+
+def _revenue(db, keys: list[str]) -> float:
+    rows = list(
+        db.orders.aggregate(
+            [
+                {"$match": status_key_match(db, keys)},
+                {"$group": {"_id": None, "revenue": {"$sum": {"$ifNull": ["$total", 0]}}}},
+            ]
+        )
+    )
+    return _number(rows[0].get("revenue")) if rows else 0.0
+
+
+def compute_summary(db, revenue_statuses: Iterable[str], active_products: dict[str, Any]) -> dict[str, Any]:
+    """Query every tile in parallel; archived orders count through their rollups."""
+
+    keys = status_keys(revenue_statuses)
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        revenue = pool.submit(_revenue, db, keys)
+        orders = pool.submit(db.orders.estimated_document_count)
+        users = pool.submit(db.users.estimated_document_count)
+        products = pool.submit(db.products.count_documents, active_products)
+        archived = pool.submit(archived_order_stats, db, None, None, "status")
+
+        archived_rows = archived.result()
+        archived_orders = sum(int(row.get("count") or 0) for row in archived_rows)
+        archived_revenue = sum(
+            _number(row.get("revenue")) for row in archived_rows if status_key(row.get("_id")) in keys
+        )
+        return {
+            "revenue": revenue.result() + archived_revenue,
+            "orders": orders.result() + archived_orders,
+            "users": users.result(),
+            "activeProducts": products.result(),
+            "computedAt": datetime.utcnow(),
+        }
+
+
+def dashboard_summary(
+    db, revenue_statuses: Iterable[str], active_products: dict[str, Any], ttl: float | None = None
+) -> tuple[dict[str, Any], float]:
+    """Return ``(summary, age_seconds)`` from the shared cache (``ttl`` defaults to the configured one)."""
+
+    revenue_statuses = status_keys(revenue_statuses)
+    ttl = Config.DASHBOARD_SUMMARY_TTL_SECONDS if ttl is None else ttl
+    key = (db.name, tuple(revenue_statuses), repr(active_products))
+    return _cache.get(key, ttl, lambda: compute_summary(db, revenue_statuses, active_products))
+
+
+__all__ = [
+    "compute_summary",
+    "dashboard_summary",
+]
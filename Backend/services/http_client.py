@@ -0,0 +1,258 @@
+"""Shared outbound HTTP client.
+
+Every call to a third party (MoMo, VNPAY, reCAPTCHA, time sources, OpenAI) goes
+through here so that:
+
+* each service has its own ``requests.Session`` with a keep-alive pool, so a
+  payment initiation reuses the TLS connection to the gateway;
+* timeouts and retry budgets are set per service in ``POLICIES``. Non-idempotent
+  requests (POST) are only retried when the connection could not be
+  established, never after the request may have reached the server;
+* a per-service circuit breaker fails fast (``CircuitOpenError``) after
+  repeated failures instead of making every caller wait for the timeout;
+* latency and error counters per service are kept in memory (``metrics``).
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Any, Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import Config
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised without calling out while a service's breaker is open."""
+
+
+class ServicePolicy:
+    def __init__(
+        self,
+        connect_timeout: float,
+        read_timeout: float,
+        retries: int = 0,
+        backoff: float = 0.3,
+        retry_statuses: tuple[int, ...] = (502, 503, 504),
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_statuses = retry_statuses
+
+    def retry(self) -> Retry:
+        return Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=self.retry_statuses,
+            # Read errors and retryable statuses only for idempotent methods;
+            # connect errors are retried for every method.
+            allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+            raise_on_status=False,
+        )
+
+
+POLICIES: dict[str, ServicePolicy] = {
+    "momo": ServicePolicy(connect_timeout=3, read_timeout=10, retries=2),
+    # Reconciliation queries get their own pool and breaker: a burst of them must not trip checkout's
+    "momo-query": ServicePolicy(connect_timeout=3, read_timeout=10, retries=1),
+    "vnpay": ServicePolicy(connect_timeout=3, read_timeout=10, retries=2),
+    "recaptcha": ServicePolicy(connect_timeout=2, read_timeout=5, retries=2),
+    "clock": ServicePolicy(Config.CLOCK_SYNC_TIMEOUT_SECONDS, Config.CLOCK_SYNC_TIMEOUT_SECONDS, retries=0),
+    "openai": ServicePolicy(connect_timeout=5, read_timeout=30, retries=0),
+}
+DEFAULT_POLICY = ServicePolicy(connect_timeout=3, read_timeout=10, retries=1)
+
+
+def _policy(service: str) -> ServicePolicy:
+    return POLICIES.get(service, DEFAULT_POLICY)
+
+
+class CircuitBreaker:
+    """Open after ``threshold`` consecutive failures; let one trial call through after ``reset_seconds``."""
+
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class _Metrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_error: str | None = None
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "avgMs": round(self.total_ms / self.calls, 1) if self.calls else None,
+            "maxMs": round(self.max_ms, 1),
+            "lastError": self.last_error,
+        }
+
+
+_lock = threading.Lock()
+_sessions: dict[str, tuple[int, requests.Session]] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+_metrics: dict[str, _Metrics] = {}
+
+
+def session(service: str) -> requests.Session:
+    """Return the pooled session for ``service`` (one per process)."""
+
+    pid = os.getpid()
+    with _lock:
+        entry = _sessions.get(service)
+        # Sockets must not be shared with a forked parent.
+        if entry is None or entry[0] != pid:
+            policy = _policy(service)
+            sess = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+                max_retries=policy.retry(),
+            )
+            sess.mount("https://", adapter)
+            sess.mount("http://", adapter)
+            entry = (pid, sess)
+            _sessions[service] = entry
+        return entry[1]
+
+
+def _breaker(service: str) -> CircuitBreaker:
+    with _lock:
+        breaker = _breakers.get(service)
+        if breaker is None:
+            breaker = CircuitBreaker(Config.HTTP_BREAKER_FAILURES, Config.HTTP_BREAKER_RESET_SECONDS)
+            _breakers[service] = breaker
+        return breaker
+
+
+def _record(service: str, elapsed_ms: float, error: str | None = None, rejected: bool = False) -> None:
+    with _lock:
+        stats = _metrics.setdefault(service, _Metrics())
+        if rejected:
+            stats.rejected += 1
+            return
+        stats.calls += 1
+        stats.total_ms += elapsed_ms
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        if error is not None:
+            stats.errors += 1
+            stats.last_error = error
+
+
+def call(service: str, fn: Callable[..., Any], *args: Any, is_failure: Callable[[Any], bool] | None = None, **kwargs: Any) -> Any:
+    """Run ``fn`` under ``service``'s circuit breaker and metrics (for SDK clients)."""
+
+    breaker = _breaker(service)
+    if not breaker.allow():
+        _record(service, 0.0, rejected=True)
+        raise CircuitOpenError(f"{service} is temporarily unavailable (circuit open)")
+    started = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as exc:
+        breaker.record(False)
+        _record(service, (time.perf_counter() - started) * 1000, error=f"{type(exc).__name__}: {exc}")
+        raise
+    failed = bool(is_failure and is_failure(result))
+    breaker.record(not failed)
+    _record(service, (time.perf_counter() - started) * 1000, error="server error" if failed else None)
+    return result
+
+
+def _server_error(response: requests.Response) -> bool:
+    return response.status_code >= 500
+
+
+def request(service: str, method: str, url: str, **kwargs: Any) -> requests.Response:
+    """Send a request with ``service``'s pool, timeout, retries and breaker."""
+
+    kwargs.setdefault("timeout", _policy(service).timeout)
+    return call(service, session(service).request, method, url, is_failure=_server_error, **kwargs)
+
+
+def get(service: str, url: str, **kwargs: Any) -> requests.Response:
+    return request(service, "GET", url, **kwargs)
+
+
+def post(service: str, url: str, **kwargs: Any) -> requests.Response:
+    return request(service, "POST", url, **kwargs)
+
+
+def head(service: str, url: str, **kwargs: Any) -> requests.Response:
+    return request(service, "HEAD", url, **kwargs)
+
+
+def timeout_for(service: str) -> tuple[float, float]:
+    return _policy(service).timeout
+
+
+def metrics() -> dict[str, dict[str, Any]]:
+    """Per-service counters and breaker state for this process."""
+
+    with _lock:
+        snapshot = {service: stats.as_dict() for service, stats in _metrics.items()}
+        breakers = dict(_breakers)
+    for service, breaker in breakers.items():
+        snapshot.setdefault(service, _Metrics().as_dict())["circuit"] = breaker.state
+    return snapshot
+
+
+__all__ = [
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "POLICIES",
+    "ServicePolicy",
+    "call",
+    "get",
+    "head",
+    "metrics",
+    "post",
+    "request",
+    "session",
+    "timeout_for",
+]
@@ -0,0 +1,179 @@
+"""Append-only ledger of stock movements.
+
+Every change to ``products.stock`` appends one document per product to
+``inventory_movements`` (written with a single ``insert_many`` per operation,
+never one round trip per line). Old movements are periodically folded into
+per-product ``inventory_snapshots`` so the ledger stays small, and
+``reconcile_inventory`` checks ``products.stock`` against
+snapshot + remaining movements to explain or detect drift.
+
+Snapshots carry a ``through`` ObjectId: movements with a smaller ``_id`` are
+already included in the snapshot balance, and compaction only ever adds the
+movements between ``through`` and its cutoff. That makes it idempotent even
+if it is interrupted between updating a snapshot and deleting the movements
+it absorbed, and even when the next run uses a later cutoff.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+# Reasons recorded on movements
+ORDER = "order"
+ROLLBACK = "rollback"
+ADMIN_ADJUST = "admin_adjust"
+INITIAL_STOCK = "initial_stock"
+RESERVATION_RELEASE = "reservation_release"
+RESERVATION_RETAKE = "reservation_retake"
+RECONCILE_ADJUST = "reconcile_adjust"
+
+_ZERO_ID = ObjectId("0" * 24)
+
+
+def ensure_ledger_indexes(db) -> None:
+    try:
+        db.inventory_movements.create_index([("productId", 1), ("_id", 1)])
+        db.inventory_movements.create_index([("orderId", 1)], sparse=True)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure inventory ledger indexes: {exc}")
+
+
+def movement(product_id: Any, delta: int, reason: str, **refs: Any) -> dict[str, Any]:
+    """Build a movement document; ``refs`` carries context such as ``orderId`` or ``actor``."""
+
+    doc = {"productId": product_id, "delta": int(delta), "reason": reason, "createdAt": datetime.utcnow()}
+    doc.update({key: value for key, value in refs.items() if value is not None})
+    return doc
+
+
+def record_movements(db, movements: Iterable[dict[str, Any]], session=None) -> None:
+    """Append movements in one round trip.
+
+    Outside a transaction a failed ledger write must not undo a stock change
+    that already happened, so it is reported instead; ``reconcile`` will
+    surface the gap.
+    """
+
+    docs = [doc for doc in movements if doc.get("delta")]
+    if not docs:
+        return
+    if session is not None:
+        db.inventory_movements.insert_many(docs, ordered=False, session=session)
+        return
+    try:
+        db.inventory_movements.insert_many(docs, ordered=False)
+    except Exception as exc:  # pragma: no cover - depends on server state
+        print(f"Warning: failed to record {len(docs)} inventory movements: {exc}")
+
+
+def compact_movements(db, older_than_days: int = 30, now: datetime | None = None) -> int:
+    """Fold movements older than ``older_than_days`` into snapshots; return how many were removed.
+
+    Only movements between a snapshot's ``through`` and the new cutoff are
+    added to its balance, and the snapshot update is conditional on the
+    ``through`` it was read with, so a run interrupted before its deletes (or
+    a concurrent run) never folds the same movement in twice.
+    """
+
+    now = now or datetime.utcnow()
+    cutoff = ObjectId.from_datetime(now - timedelta(days=older_than_days))
+    product_ids = [
+        row["_id"]
+        for row in db.inventory_movements.aggregate(
+            [{"$match": {"_id": {"$lt": cutoff}}}, {"$group": {"_id": "$productId"}}]
+        )
+    ]
+    snapshots = {
+        doc["_id"]: doc.get("through")
+        for doc in db.inventory_snapshots.find({"_id": {"$in": product_ids}}, {"through": 1})
+    }
+
+    removed = 0
+    for product_id in product_ids:
+        through = snapshots.get(product_id)
+        if through is None or through < cutoff:
+            totals = list(
+                db.inventory_movements.aggregate(
+                    [
+                        {"$match": {"productId": product_id, "_id": {"$gte": through or _ZERO_ID, "$lt": cutoff}}},
+                        {"$group": {"_id": None, "delta": {"$sum": "$delta"}, "count": {"$sum": 1}}},
+                    ]
+                )
+            )
+            delta, count = (int(totals[0]["delta"]), int(totals[0]["count"])) if totals else (0, 0)
+            current = {"$exists": False} if through is None else through
+            try:
+                folded = db.inventory_snapshots.update_one(
+                    {"_id": product_id, "through": current},
+                    {
+                        "$inc": {"balance": delta, "movementCount": count},
+                        "$set": {"through": cutoff, "updatedAt": datetime.utcnow()},
+                    },
+                    upsert=through is None,
+                )
+            except DuplicateKeyError:
+                continue  # another run created the snapshot first; leave its movements to it
+            if not (folded.modified_count or folded.upserted_id is not None):
+                continue  # another run moved ``through`` since we read it
+        removed += db.inventory_movements.delete_many({"productId": product_id, "_id": {"$lt": cutoff}}).deleted_count
+    return removed
+
+
+def reconcile_inventory(db, product_ids: list[ObjectId] | None = None, record_adjustments: bool = False) -> list[dict[str, Any]]:
+    """Compare ``products.stock`` with the ledger and return one entry per drifting product.
+
+    With ``record_adjustments`` the drift is written back as ``reconcile_adjust``
+    movements, which is also how products that predate the ledger get their
+    opening balance.
+    """
+
+    product_filter: dict[str, Any] = {"_id": {"$in": product_ids}} if product_ids else {}
+    snapshots = {doc["_id"]: doc for doc in db.inventory_snapshots.find(product_filter)}
+
+    ledger: dict[Any, int] = defaultdict(int)
+    movement_filter: dict[str, Any] = {"productId": {"$in": product_ids}} if product_ids else {}
+    for doc in db.inventory_movements.find(movement_filter, {"productId": 1, "delta": 1}):
+        snapshot = snapshots.get(doc["productId"])
+        if snapshot and doc["_id"] < (snapshot.get("through") or _ZERO_ID):
+            continue  # already folded into the snapshot balance
+        ledger[doc["productId"]] += int(doc.get("delta") or 0)
+
+    drift: list[dict[str, Any]] = []
+    for product in db.products.find(product_filter, {"name": 1, "stock": 1}):
+        product_id = product["_id"]
+        expected = int((snapshots.get(product_id) or {}).get("balance") or 0) + ledger.get(product_id, 0)
+        actual = int(product.get("stock") or 0)
+        if expected != actual:
+            drift.append(
+                {
+                    "productId": product_id,
+                    "name": product.get("name"),
+                    "stock": actual,
+                    "ledger": expected,
+                    "drift": actual - expected,
+                }
+            )
+
+    if record_adjustments and drift:
+        record_movements(db, [movement(entry["productId"], entry["drift"], RECONCILE_ADJUST) for entry in drift])
+    return drift
+
+
+__all__ = [
+    "ADMIN_ADJUST",
+    "INITIAL_STOCK",
+    "ORDER",
+    "RECONCILE_ADJUST",
+    "RESERVATION_RELEASE",
+    "RESERVATION_RETAKE",
+    "ROLLBACK",
+    "compact_movements",
+    "ensure_ledger_indexes",
+    "movement",
+    "reconcile_inventory",
+    "record_movements",
+]
@@ -0,0 +1,102 @@
+"""Product category snapshotted onto order items.
+
+``create_order`` copies the product's ``category`` into every item, so sales
+per category are one ``$group`` over the orders of a period: no lookup into
+``products`` and no lost revenue when a product is later deleted or moved to
+another category. Archived sales keep the category on
+``orders_archive_item_rollups``.
+
+``backfill_item_categories`` (``flask orders backfill-item-categories``)
+fills in orders and rollups written before the snapshot existed, from the
+products that still exist; items of products deleted since then keep
+``category: None``. The category is part of the archive rollup key; a legacy
+rollup row whose category already has a row of its own is merged into it.
+"""
+from __future__ import annotations
+
+from typing import Any, Iterable
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+from services.transactions import run_in_transaction
+
+
+def _product_categories(db, product_ids: Iterable[Any]) -> dict[str, Any]:
+    object_ids = []
+    for product_id in {str(value) for value in product_ids if value is not None}:
+        try:
+            object_ids.append(ObjectId(product_id))
+        except (InvalidId, TypeError):
+            continue
+    if not object_ids:
+        return {}
+    return {str(doc["_id"]): doc.get("category") for doc in db.products.find({"_id": {"$in": object_ids}}, {"category": 1})}
+
+
+def _backfill_orders(db, collection, batch_size: int) -> int:
+    updated = 0
+    query = {"items": {"$elemMatch": {"category": {"$exists": False}}}}
+    while True:
+        batch = list(collection.find(query, {"items": 1}).limit(batch_size))
+        if not batch:
+            return updated
+        categories = _product_categories(db, (item.get("productId") for order in batch for item in order["items"]))
+        ops = []
+        for order in batch:
+            items = [
+                item if "category" in item else {**item, "category": categories.get(str(item.get("productId")))}
+                for item in order["items"]
+            ]
+            ops.append(UpdateOne({"_id": order["_id"]}, {"$set": {"items": items}}))
+        collection.bulk_write(ops, ordered=False)
+        updated += len(batch)
+
+
+def _backfill_rollups(db, batch_size: int) -> int:
+    """Give legacy rollup rows their product's category.
+
+    The category is part of the rollup key, so a row archived after the
+    snapshot existed may already hold the same day/status/product under that
+    category; the legacy row is then folded into it.
+    """
+
+    rollups = db.orders_archive_item_rollups
+    updated = 0
+    query = {"category": {"$exists": False}}
+    while True:
+        batch = list(rollups.find(query).limit(batch_size))
+        if not batch:
+            return updated
+        categories = _product_categories(db, (row.get("productId") for row in batch))
+
+        def _write(session, batch=batch, categories=categories):
+            for row in batch:
+                category = categories.get(str(row.get("productId")))
+                key = {"day": row.get("day"), "status": row.get("status"), "productId": row.get("productId"), "category": category}
+                if category is None or rollups.find_one(key, {"_id": 1}, session=session) is None:
+                    rollups.update_one({"_id": row["_id"]}, {"$set": {"category": category}}, session=session)
+                    continue
+                rollups.update_one(
+                    key, {"$inc": {"quantity": row.get("quantity") or 0, "revenue": row.get("revenue") or 0}}, session=session
+                )
+                rollups.delete_one({"_id": row["_id"]}, session=session)
+
+        run_in_transaction(db, _write)
+        updated += len(batch)
+
+
+def backfill_item_categories(db, batch_size: int = 500) -> dict[str, int]:
+    """Snapshot categories onto old hot/archived order items and archive item rollups; return counts."""
+
+    return {
+        "orders": _backfill_orders(db, db.orders, batch_size),
+        "archived": _backfill_orders(db, db.orders_archive, batch_size),
+        "rollups": _backfill_rollups(db, batch_size),
+    }
+
+
+__all__ = [
+    "backfill_item_categories",
+]
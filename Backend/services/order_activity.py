@@ -0,0 +1,117 @@
+"""Order activity history stored outside the order document.
+
+Every entry goes to ``order_activity`` (indexed by ``(orderId, timestamp)``,
+where ``orderId`` is the order's ``_id``). The order itself only keeps the
+latest ``Config.ORDER_ACTIVITY_PREVIEW_SIZE`` entries in ``activityLog`` via
+``$push`` + ``$slice`` so detail pages can render a preview without a second
+query, and busy orders no longer grow without bound.
+
+Orders written before this split still carry their full ``activityLog``;
+``migrate_order`` copies it to the collection (idempotently) before the first
+trimming push, and ``migrate_activity_logs`` does the same in bulk.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from pymongo import DESCENDING, UpdateOne
+
+from config import Config
+
+MIGRATED_FLAG = "activityExternal"
+
+
+def ensure_activity_indexes(db) -> None:
+    try:
+        db.order_activity.create_index([("orderId", 1), ("timestamp", DESCENDING)])
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure order_activity index: {exc}")
+
+
+def _copy_ops(order_id, entries: list[dict[str, Any]]) -> list[UpdateOne]:
+    # Keyed on (order, timestamp, type) so re-running a migration never duplicates entries.
+    return [
+        UpdateOne(
+            {"orderId": order_id, "timestamp": entry.get("timestamp"), "type": entry.get("type")},
+            {"$setOnInsert": {**entry, "orderId": order_id}},
+            upsert=True,
+        )
+        for entry in entries
+        if isinstance(entry, dict)
+    ]
+
+
+def migrate_order(db, order: dict[str, Any], collection=None) -> None:
+    """Copy a legacy embedded ``activityLog`` to ``order_activity`` and trim it."""
+
+    if order.get(MIGRATED_FLAG):
+        return
+    ops = _copy_ops(order["_id"], order.get("activityLog") or [])
+    if ops:
+        db.order_activity.bulk_write(ops, ordered=False)
+    # An empty $each with $slice trims in place without racing concurrent pushes.
+    (collection if collection is not None else db.orders).update_one(
+        {"_id": order["_id"]},
+        {
+            "$set": {MIGRATED_FLAG: True},
+            "$push": {"activityLog": {"$each": [], "$slice": -Config.ORDER_ACTIVITY_PREVIEW_SIZE}},
+        },
+    )
+    order[MIGRATED_FLAG] = True
+
+
+def add_activity(update: dict[str, Any], entry: dict[str, Any]) -> dict[str, Any]:
+    """Extend an order update so ``entry`` lands in the capped ``activityLog`` preview."""
+
+    update.setdefault("$push", {})["activityLog"] = {"$each": [entry], "$slice": -Config.ORDER_ACTIVITY_PREVIEW_SIZE}
+    update.setdefault("$set", {})[MIGRATED_FLAG] = True
+    return update
+
+
+def record_activity(db, order: dict[str, Any], entry: dict[str, Any]) -> None:
+    """Append ``entry`` to the order's full history."""
+
+    try:
+        db.order_activity.insert_one({**entry, "orderId": order["_id"]})
+    except Exception as exc:  # pragma: no cover - the preview on the order still has it
+        print(f"Warning: failed to record activity for order {order.get('_id')}: {exc}")
+
+
+def list_activity(db, order_id, page: int = 1, limit: int = 20) -> tuple[list[dict[str, Any]], int]:
+    """Return one page of entries, newest first, and the total count."""
+
+    query = {"orderId": order_id}
+    total = db.order_activity.count_documents(query)
+    entries = list(
+        db.order_activity.find(query, {"orderId": 0})
+        .sort("timestamp", DESCENDING)
+        .skip((page - 1) * limit)
+        .limit(limit)
+    )
+    return entries, total
+
+
+def migrate_activity_logs(db, batch_size: int = 200) -> int:
+    """Move every legacy embedded ``activityLog`` out of hot and archived orders; return orders migrated."""
+
+    migrated = 0
+    query = {MIGRATED_FLAG: {"$ne": True}, "activityLog.0": {"$exists": True}}
+    for collection in (db.orders, db.orders_archive):
+        while True:
+            batch = list(collection.find(query, {"activityLog": 1}).limit(batch_size))
+            if not batch:
+                break
+            for order in batch:
+                migrate_order(db, order, collection)
+            migrated += len(batch)
+    return migrated
+
+
+__all__ = [
+    "add_activity",
+    "ensure_activity_indexes",
+    "list_activity",
+    "migrate_activity_logs",
+    "migrate_order",
+    "record_activity",
+]
@@ -0,0 +1,355 @@
+"""Hot/cold partitioning of orders.
+
+Finished orders (delivered, cancelled, failed, expired) older than
+``Config.ORDER_ARCHIVE_AFTER_DAYS`` are moved from ``orders`` to
+``orders_archive`` in batches, so the hot collection only holds orders that
+can still change. Archived orders are read-only.
+
+While moving a batch we also fold it into two rollup collections so analytics
+never need to scan the archive:
+
+* ``orders_archive_rollups`` -- per day / status / payment method: count, revenue
+* ``orders_archive_item_rollups`` -- per day / status / product / category (as
+  snapshotted on the order items): quantity, revenue
+
+Orders are selected on the indexed ``statusKey``. Each hot order is only
+deleted while its ``updatedAt`` is still the one copied; an order changed in
+the meantime (a late payment, an admin edit) stays hot, its copy is
+withdrawn from the archive and the rollups, and a later run copies the new
+version if it is still finished.
+
+With transactions the copy, rollup and delete of a batch are atomic. On a
+standalone server the copies are written first with ``rolledUp: false`` and a
+per-batch ``rollupToken``; every rollup row the batch touches records that
+token in the same update (``archiveBatches``), and the copies are only marked
+``rolledUp`` once all rows are written. Withdrawals work the same way with
+copies flagged ``withdrawn``, which count negatively and are deleted at the
+end. A run interrupted anywhere in between is finished by the next one, which
+re-folds the whole token's orders into the rows that lack the token, so no
+order is lost from or counted twice in the rollups.
+"""
+from __future__ import annotations
+
+import heapq
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+from pymongo import UpdateOne
+
+from services.status_keys import status_key_match
+from services.transactions import run_in_transaction
+
+FINAL_STATUSES = ("delivered", "cancelled", "canceled", "payment failed", "failed", "expired")
+
+# Tokens of the archive batches already folded into a rollup row (removed once the batch is done)
+ROLLUP_TOKENS = "archiveBatches"
+ORDER_ROLLUP_KEY = ("day", "status", "method")
+ITEM_ROLLUP_KEY = ("day", "status", "productId", "category")
+
+
+def ensure_archive_indexes(db) -> None:
+    try:
+        db.orders_archive.create_index([("userId", 1), ("createdAt", -1)])
+        db.orders_archive.create_index([("createdAt", -1)])
+        db.orders_archive.create_index("orderId", unique=True, sparse=True)
+        db.orders_archive_rollups.create_index([("day", 1), ("status", 1), ("method", 1)], unique=True)
+        item_rollups = db.orders_archive_item_rollups
+        # The category joined the key; the old unique index would reject a product's second category
+        if "day_1_status_1_productId_1" in item_rollups.index_information():
+            item_rollups.drop_index("day_1_status_1_productId_1")
+        item_rollups.create_index([("day", 1), ("status", 1), ("productId", 1), ("category", 1)], unique=True)
+        db.orders_archive.create_index("rollupToken", sparse=True)
+        for collection in (db.orders_archive_rollups, db.orders_archive_item_rollups):
+            collection.create_index(ROLLUP_TOKENS, sparse=True)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure order archive indexes: {exc}")
+
+
+def _day(value: Any) -> str:
+    return value.strftime("%Y-%m-%d") if isinstance(value, datetime) else "unknown"
+
+
+def _number(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) else 0.0
+
+
+def _rollup_updates(orders: list[dict[str, Any]]) -> tuple[list[tuple[dict, dict]], list[tuple[dict, dict]]]:
+    """``(filter, update)`` pairs for the order and item rollup rows of ``orders``."""
+
+    order_totals: dict[tuple, list[float]] = defaultdict(lambda: [0, 0.0])
+    item_totals: dict[tuple, list[float]] = defaultdict(lambda: [0, 0.0])
+    for order in orders:
+        # A withdrawn copy takes back what it added
+        sign = -1 if order.get("withdrawn") else 1
+        day = _day(order.get("createdAt"))
+        status = str(order.get("status") or "").lower()
+        method = str((order.get("payment") or {}).get("method") or "").lower()
+        entry = order_totals[(day, status, method)]
+        entry[0] += sign
+        entry[1] += sign * _number(order.get("total"))
+        for item in order.get("items") or []:
+            if item.get("productId") is None:
+                continue
+            quantity = _number(item.get("quantity"))
+            subtotal = item.get("subtotal")
+            revenue = _number(subtotal) if isinstance(subtotal, (int, float)) else _number(item.get("price")) * quantity
+            entry = item_totals[(day, status, str(item["productId"]), item.get("category"))]
+            entry[0] += sign * quantity
+            entry[1] += sign * revenue
+
+    def _day_start(day: str):
+        return datetime.strptime(day, "%Y-%m-%d") if day != "unknown" else None
+
+    order_updates = [
+        (
+            {"day": day, "status": status, "method": method},
+            {"$inc": {"count": count, "revenue": revenue}, "$setOnInsert": {"dayStart": _day_start(day)}},
+        )
+        for (day, status, method), (count, revenue) in order_totals.items()
+    ]
+    item_updates = [
+        (
+            {"day": day, "status": status, "productId": product_id, "category": category},
+            {"$inc": {"quantity": quantity, "revenue": revenue}, "$setOnInsert": {"dayStart": _day_start(day)}},
+        )
+        for (day, status, product_id, category), (quantity, revenue) in item_totals.items()
+    ]
+    return order_updates, item_updates
+
+
+def _apply_rollup(collection, updates: list[tuple[dict, dict]], key: tuple[str, ...], token: str, session=None) -> None:
+    """Upsert ``updates`` into the rows that do not carry ``token`` yet, tagging each with it."""
+
+    done = {
+        tuple(doc.get(field) for field in key)
+        for doc in collection.find({ROLLUP_TOKENS: token}, dict.fromkeys(key, 1), session=session)
+    }
+    ops = [
+        UpdateOne({**row, ROLLUP_TOKENS: {"$ne": token}}, {**update, "$push": {ROLLUP_TOKENS: token}}, upsert=True)
+        for row, update in updates
+        if tuple(row[field] for field in key) not in done
+    ]
+    if ops:
+        collection.bulk_write(ops, ordered=False, session=session)
+
+
+def _roll_up(db, token: str, session=None) -> None:
+    """Fold every copy archived or withdrawn under ``token`` into the rollups, then mark the copies done."""
+
+    orders = list(db.orders_archive.find({"rollupToken": token, "rolledUp": False}, session=session))
+    order_updates, item_updates = _rollup_updates(orders)
+    _apply_rollup(db.orders_archive_rollups, order_updates, ORDER_ROLLUP_KEY, token, session)
+    _apply_rollup(db.orders_archive_item_rollups, item_updates, ITEM_ROLLUP_KEY, token, session)
+    db.orders_archive.delete_many({"rollupToken": token, "withdrawn": True}, session=session)
+    db.orders_archive.update_many(
+        {"rollupToken": token}, {"$set": {"rolledUp": True}, "$unset": {"rollupToken": ""}}, session=session
+    )
+    for collection in (db.orders_archive_rollups, db.orders_archive_item_rollups):
+        collection.update_many({ROLLUP_TOKENS: token}, {"$pull": {ROLLUP_TOKENS: token}}, session=session)
+
+
+def _archive_batch(db, batch: list[dict[str, Any]], session=None) -> None:
+    ids = [order["_id"] for order in batch]
+    archived = {
+        doc["_id"]: doc
+        for doc in db.orders_archive.find({"_id": {"$in": ids}}, {"rolledUp": 1, "rollupToken": 1}, session=session)
+    }
+    # Copies left behind by an interrupted run (legacy copies without the flag were rolled up on insert)
+    tokens = {doc["rollupToken"] for doc in archived.values() if doc.get("rolledUp") is False}
+    fresh = [order for order in batch if order["_id"] not in archived]
+    if fresh:
+        token = uuid.uuid4().hex
+        archived_at = datetime.utcnow()
+        db.orders_archive.insert_many(
+            [{**order, "archivedAt": archived_at, "rolledUp": False, "rollupToken": token} for order in fresh],
+            ordered=False,
+            session=session,
+        )
+        tokens.add(token)
+    for token in tokens:
+        _roll_up(db, token, session)
+
+    # Delete each order only as it was copied; one updated since keeps its hot version
+    copied = {
+        doc["_id"]: doc.get("updatedAt")
+        for doc in db.orders_archive.find({"_id": {"$in": ids}}, {"updatedAt": 1}, session=session)
+    }
+    changed = [
+        order_id
+        for order_id, updated_at in copied.items()
+        if not db.orders.delete_one({"_id": order_id, "updatedAt": updated_at}, session=session).deleted_count
+    ]
+    if changed:
+        token = uuid.uuid4().hex
+        db.orders_archive.update_many(
+            {"_id": {"$in": changed}},
+            {"$set": {"rolledUp": False, "rollupToken": token, "withdrawn": True}},
+            session=session,
+        )
+        _roll_up(db, token, session)
+
+
+def archive_orders(db, older_than_days: int, batch_size: int = 500, now: datetime | None = None) -> int:
+    """Move finished orders untouched for ``older_than_days`` to the archive; return how many moved."""
+
+    cutoff = (now or datetime.utcnow()) - timedelta(days=older_than_days)
+    query = {
+        **status_key_match(db, FINAL_STATUSES),
+        "createdAt": {"$lt": cutoff},
+        "$or": [{"updatedAt": {"$lt": cutoff}}, {"updatedAt": {"$exists": False}}],
+    }
+    # Finish batches an interrupted standalone run left behind (withdrawn orders may no longer match)
+    for token in db.orders_archive.distinct("rollupToken", {"rolledUp": False}):
+        _roll_up(db, token)
+    moved = 0
+    while True:
+        batch = list(db.orders.find(query).limit(batch_size))
+        if not batch:
+            return moved
+        run_in_transaction(db, lambda session, batch=batch: _archive_batch(db, batch, session))
+        moved += len(batch)
+        if len(batch) < batch_size:
+            return moved
+
+
+# ---------------------------------------------------------------------------
+# Reads spanning hot and archived orders
+# ---------------------------------------------------------------------------
+
+def can_be_archived(status_query: Any) -> bool:
+    """False when an exact status filter can only match hot orders."""
+
+    if isinstance(status_query, str):
+        return status_query.lower() in FINAL_STATUSES
+    return True
+
+
+def _sort_key(value: Any) -> tuple:
+    # Mirror MongoDB's cross-type ordering closely enough for merging pages.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value)
+    return (4, str(value))
+
+
+def find_orders(
+    db,
+    query: dict[str, Any],
+    sort_field: str = "createdAt",
+    direction: int = -1,
+    skip: int = 0,
+    limit: int | None = None,
+    projection: dict[str, Any] | None = None,
+    include_archive: bool = True,
+) -> list[dict[str, Any]]:
+    """Return one sorted page drawn from ``orders`` and ``orders_archive``.
+
+    Each collection is read with its own index-backed sort limited to
+    ``skip + limit`` documents and the two streams are merged in Python.
+    """
+
+    def _cursor(collection):
+        cursor = collection.find(query, projection).sort(sort_field, direction)
+        if limit is not None:
+            cursor = cursor.limit(skip + limit)
+        return cursor
+
+    if not include_archive:
+        cursor = db.orders.find(query, projection).sort(sort_field, direction).skip(skip)
+        return list(cursor.limit(limit) if limit is not None else cursor)
+
+    merged = heapq.merge(
+        _cursor(db.orders),
+        _cursor(db.orders_archive),
+        key=lambda doc: _sort_key(doc.get(sort_field)),
+        reverse=direction < 0,
+    )
+    page = []
+    for index, doc in enumerate(merged):
+        if index < skip:
+            continue
+        if limit is not None and len(page) >= limit:
+            break
+        page.append(doc)
+    return page
+
+
+def count_orders(db, query: dict[str, Any], include_archive: bool = True) -> int:
+    total = db.orders.count_documents(query)
+    if include_archive:
+        total += db.orders_archive.count_documents(query)
+    return total
+
+
+def archived_order_stats(
+    db, statuses: Iterable[str] | None = None, since: datetime | None = None, group_by: str | None = None
+) -> list[dict[str, Any]]:
+    """Sum archived ``count``/``revenue``, optionally grouped by ``day``, ``status`` or ``method``."""
+
+    match: dict[str, Any] = {}
+    if statuses is not None:
+        match["status"] = {"$in": [status.lower() for status in statuses]}
+    if since is not None:
+        match["dayStart"] = {"$gte": datetime(since.year, since.month, since.day)}
+    return list(
+        db.orders_archive_rollups.aggregate(
+            [
+                {"$match": match},
+                {"$group": {
+                    "_id": f"${group_by}" if group_by else None,
+                    "count": {"$sum": "$count"},
+                    "revenue": {"$sum": "$revenue"},
+                }},
+            ]
+        )
+    )
+
+
+def archived_item_stats(db, statuses: Iterable[str], since: datetime | None = None) -> dict[str, dict[str, float]]:
+    """Return ``{productId: {"quantity", "revenue"}}`` for archived orders in ``statuses``."""
+
+    match: dict[str, Any] = {"status": {"$in": [status.lower() for status in statuses]}}
+    if since is not None:
+        match["dayStart"] = {"$gte": datetime(since.year, since.month, since.day)}
+    rows = db.orders_archive_item_rollups.aggregate(
+        [
+            {"$match": match},
+            {"$group": {"_id": "$productId", "quantity": {"$sum": "$quantity"}, "revenue": {"$sum": "$revenue"}}},
+        ]
+    )
+    return {row["_id"]: {"quantity": row["quantity"], "revenue": row["revenue"]} for row in rows}
+
+
+def archived_category_stats(db, statuses: Iterable[str], since: datetime | None = None) -> dict[Any, dict[str, float]]:
+    """Return ``{category: {"quantity", "revenue"}}`` for archived orders in ``statuses`` (None: unknown)."""
+
+    match: dict[str, Any] = {"status": {"$in": [status.lower() for status in statuses]}}
+    if since is not None:
+        match["dayStart"] = {"$gte": datetime(since.year, since.month, since.day)}
+    rows = db.orders_archive_item_rollups.aggregate(
+        [
+            {"$match": match},
+            {"$group": {"_id": "$category", "quantity": {"$sum": "$quantity"}, "revenue": {"$sum": "$revenue"}}},
+        ]
+    )
+    return {row["_id"]: {"quantity": row["quantity"], "revenue": row["revenue"]} for row in rows}
+
+
+__all__ = [
+    "FINAL_STATUSES",
+    "archive_orders",
+    "archived_category_stats",
+    "archived_item_stats",
+    "archived_order_stats",
+    "can_be_archived",
+    "count_orders",
+    "ensure_archive_indexes",
+    "find_orders",
+]
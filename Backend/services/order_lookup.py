@@ -0,0 +1,106 @@
+"""Resolve an order from whatever identifier a client or gateway hands us.
+
+Orders are addressed either by Mongo ``_id`` (24 hex chars) or by the
+friendly ``orderId`` (``ORD...``). The identifier is classified up front so
+every lookup is exactly one indexed query:
+
+* ``ObjectId`` instances -> ``{"_id": ...}``
+* 24-hex strings -> ``{"$or": [{"_id": ...}, {"orderId": ...}]}`` (both clauses
+  hit an index; an ``orderId`` that happens to be hex still resolves)
+* anything else -> ``{"orderId": ...}``
+
+Identifier -> ``_id`` mappings never change, so resolved pairs are kept in a
+small process-wide LRU and repeat lookups (payment return + IPN + result page
+polling) go straight to ``_id``.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from bson import ObjectId
+
+DEFAULT_CACHE_SIZE = 2048
+
+
+class _IdCache:
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict[tuple[str, str], ObjectId] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[str, str]) -> ObjectId | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple[str, str], value: ObjectId) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_id_cache = _IdCache()
+
+
+def identifier_filter(identifier: Any) -> dict[str, Any] | None:
+    """Return the single query that matches ``identifier``, or None when it is empty."""
+
+    if isinstance(identifier, ObjectId):
+        return {"_id": identifier}
+    if identifier is None:
+        return None
+    text = str(identifier).strip()
+    if not text:
+        return None
+    if len(text) == 24 and ObjectId.is_valid(text):
+        return {"$or": [{"_id": ObjectId(text)}, {"orderId": text}]}
+    return {"orderId": text}
+
+
+def find_order(
+    db,
+    identifier: Any,
+    extra_filter: dict[str, Any] | None = None,
+    projection: dict[str, Any] | None = None,
+    use_cache: bool = True,
+    include_archive: bool = False,
+) -> dict[str, Any] | None:
+    """Fetch the order addressed by ``identifier`` with one query.
+
+    ``extra_filter`` narrows the match (e.g. ``{"userId": ...}`` for ownership
+    checks); ``projection`` is passed straight to ``find_one``. Read-only
+    callers pass ``include_archive`` to fall back to ``orders_archive`` (a
+    second query, only when the order is not hot).
+    """
+
+    cache_key = (db.name, str(identifier).strip()) if identifier is not None else None
+    cached_id = _id_cache.get(cache_key) if use_cache and cache_key else None
+    query = {"_id": cached_id} if cached_id is not None else identifier_filter(identifier)
+    if query is None:
+        return None
+    if extra_filter:
+        query = {**query, **extra_filter} if "$or" not in extra_filter else {"$and": [query, extra_filter]}
+
+    order = db.orders.find_one(query, projection)
+    if order is None and include_archive:
+        order = db.orders_archive.find_one(query, projection)
+    if order is not None and use_cache and cached_id is None and isinstance(order.get("_id"), ObjectId):
+        _id_cache.put(cache_key, order["_id"])
+    return order
+
+
+def clear_cache() -> None:
+    _id_cache.clear()
+
+
+__all__ = ["clear_cache", "find_order", "identifier_filter"]
@@ -0,0 +1,74 @@
+"""Collision-free ``orderId`` generation backed by a Mongo counter.
+
+Each process reserves a block of sequence numbers with a single atomic
+``$inc`` on the ``counters`` collection and hands them out from memory, so
+most order numbers need no round trip at all. Blocks never overlap between
+processes (or forked workers), which keeps ids unique at any request rate.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class OrderNumberGenerator:
+    """Hand out ``ORD<yyyymmdd><sequence>`` identifiers from reserved counter blocks."""
+
+    def __init__(self, db, block_size: int = 100, counter_name: str = "orderId", prefix: str = "ORD"):
+        self._db = db
+        self._block_size = max(int(block_size), 1)
+        self._counter_name = counter_name
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0
+        self._pid = os.getpid()
+
+    def _reserve_block(self) -> None:
+        try:
+            counter = self._db.counters.find_one_and_update(
+                {"_id": self._counter_name},
+                {"$inc": {"seq": self._block_size}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Two processes raced to create the counter; the document exists now.
+            counter = self._db.counters.find_one_and_update(
+                {"_id": self._counter_name},
+                {"$inc": {"seq": self._block_size}},
+                return_document=ReturnDocument.AFTER,
+            )
+        self._limit = int(counter["seq"])
+        self._next = self._limit - self._block_size + 1
+
+    def next_sequence(self) -> int:
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: the inherited block also lives in the parent.
+                self._pid = os.getpid()
+                self._next = self._limit = 0
+            if self._next == 0 or self._next > self._limit:
+                self._reserve_block()
+            sequence = self._next
+            self._next += 1
+            return sequence
+
+    def next(self) -> str:
+        return f"{self._prefix}{datetime.utcnow():%Y%m%d}{self.next_sequence():07d}"
+
+
+def ensure_order_id_index(db) -> None:
+    """Create the unique ``orderId`` index; duplicates left by the old generator are reported."""
+
+    try:
+        db.orders.create_index("orderId", unique=True, sparse=True)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure unique index on orders.orderId: {exc}")
+
+
+__all__ = ["OrderNumberGenerator", "ensure_order_id_index"]
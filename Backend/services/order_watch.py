@@ -0,0 +1,79 @@
+"""In-process wake-ups for requests waiting on an order to change.
+
+``GET /api/orders/<id>/payment-events`` holds the connection until the
+order's payment state moves. Writers call ``notify_orders`` after their
+change is committed (``services.outbox.update_order``, the reservation
+sweeper, payment reconciliation), which sets the events of the requests
+subscribed to those orders. Changes committed by another process do not
+reach this one, so waiters also re-read the order every
+``Config.PAYMENT_STREAM_RECHECK_SECONDS``.
+
+Subscribe *before* reading the order: a change between the read and the
+wait then still sets the event instead of being missed.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Any, Iterable
+
+
+class OrderWatch:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: dict[str, set[threading.Event]] = {}
+
+    def subscribe(self, order_ref: Any) -> threading.Event:
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(str(order_ref), set()).add(event)
+        return event
+
+    def unsubscribe(self, order_ref: Any, event: threading.Event) -> None:
+        key = str(order_ref)
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if waiters is None:
+                return
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[key]
+
+    def notify(self, order_refs: Iterable[Any]) -> None:
+        with self._lock:
+            events = [event for ref in order_refs for event in self._waiters.get(str(ref), ())]
+        for event in events:
+            event.set()
+
+    def waiting(self) -> int:
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+_watch = OrderWatch()
+
+
+def subscribe(order_ref: Any) -> threading.Event:
+    return _watch.subscribe(order_ref)
+
+
+def unsubscribe(order_ref: Any, event: threading.Event) -> None:
+    _watch.unsubscribe(order_ref, event)
+
+
+def notify_orders(order_refs: Iterable[Any]) -> None:
+    """Wake the requests waiting on any of ``order_refs`` (order ``_id`` values)."""
+
+    _watch.notify(order_refs)
+
+
+def waiting() -> int:
+    return _watch.waiting()
+
+
+__all__ = [
+    "OrderWatch",
+    "notify_orders",
+    "subscribe",
+    "unsubscribe",
+    "waiting",
+]
@@ -0,0 +1,560 @@
+"""Transactional outbox for order lifecycle events.
+
+Whenever an order is created, deleted or its status / payment status changes,
+a compact event is appended to ``order_events`` together with the order write
+(inside a transaction when the deployment supports one). Consumers tail the
+collection in ``seq`` order from a checkpoint stored in ``outbox_checkpoints``
+and keep their projections up to date incrementally instead of rescanning
+``orders``.
+
+Writers only insert their events; they never touch a shared document, so
+concurrent checkouts do not queue behind one another. ``seq`` is handed out
+afterwards by ``number_events``, which the consumers run before reading: it
+numbers the committed events still flagged ``unnumbered`` (oldest ``_id``
+first) from the ``counters`` collection, one batch per transaction. Only one
+process numbers at a time (a lease in ``outbox_checkpoints``), so ``seq``
+follows the order in which events became visible and a consumer never passes
+an event that is still being written. Without transactions a sequencer can
+die between taking numbers and writing them, so the consumer waits at a hole
+in the sequence (see ``OutboxConsumer``).
+
+A change stream, when available, is only used as a wake-up signal; events are
+always read through the ``seq`` cursor.
+"""
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Iterable, Iterator
+
+from bson.decimal128 import Decimal128
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from config import Config
+from services.order_watch import notify_orders
+from services.status_keys import status_key, with_status_keys
+from services.transactions import run_in_transaction, supports_transactions
+
+ORDER_CREATED = "order.created"
+ORDER_UPDATED = "order.updated"
+ORDER_DELETED = "order.deleted"
+
+# counters document holding the last event sequence number handed out
+SEQUENCE_ID = "order_events"
+# outbox_checkpoints lease held by the process numbering events
+SEQUENCER = "order-events-sequencer"
+
+# handler(db, events, session): apply a batch to the projection
+EventHandler = Callable[[Any, list[dict[str, Any]], Any], None]
+# rebuild(db, session): recompute the projection; ``session`` is a read-only snapshot (or None)
+Rebuild = Callable[[Any, Any], int]
+
+
+class LeaseLostError(RuntimeError):
+    """Another process took over the consumer while this one was applying a batch."""
+
+
+def ensure_outbox_indexes(db, ttl_days: int) -> None:
+    try:
+        db.order_events.create_index([("createdAt", 1)], expireAfterSeconds=ttl_days * 86400)
+        db.order_events.create_index([("orderRef", 1), ("_id", 1)])
+        db.order_events.create_index([("seq", 1)], unique=True, partialFilterExpression={"seq": {"$exists": True}})
+        db.order_events.create_index(
+            [("unnumbered", 1), ("_id", 1)], name="unnumbered_events", partialFilterExpression={"unnumbered": True}
+        )
+        # Created up front: events are usually numbered inside a transaction
+        db.counters.update_one({"_id": SEQUENCE_ID}, {"$setOnInsert": {"seq": 0}}, upsert=True)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure order_events indexes: {exc}")
+
+
+def _payment_status(order: dict[str, Any] | None) -> str | None:
+    return ((order or {}).get("payment") or {}).get("status")
+
+
+def build_event(order: dict[str, Any], event_type: str, previous: dict[str, Any] | None = None, **context: Any) -> dict[str, Any] | None:
+    """Return the event for ``order``, or None when nothing a consumer tracks has changed."""
+
+    status = order.get("status")
+    payment_status = _payment_status(order)
+    if previous is not None and event_type == ORDER_UPDATED:
+        if previous.get("status") == status and _payment_status(previous) == payment_status:
+            return None
+
+    payment = order.get("payment") or {}
+    event = {
+        "type": event_type,
+        "orderRef": order.get("_id"),
+        "orderId": order.get("orderId"),
+        "userId": order.get("userId"),
+        "status": status,
+        "paymentStatus": payment_status,
+        "paymentMethod": payment.get("method"),
+        "total": order.get("total"),
+        "orderCreatedAt": order.get("createdAt"),
+        "createdAt": datetime.utcnow(),
+    }
+    if previous is not None:
+        event["previousStatus"] = previous.get("status")
+        event["previousPaymentStatus"] = _payment_status(previous)
+        previous_method = (previous.get("payment") or {}).get("method")
+        if previous_method != payment.get("method"):
+            event["previousPaymentMethod"] = previous_method
+    event.update({key: value for key, value in context.items() if value is not None})
+    return event
+
+
+def _last_seq(db, session=None) -> int:
+    counter = db.counters.find_one({"_id": SEQUENCE_ID}, {"seq": 1}, session=session)
+    return int((counter or {}).get("seq") or 0)
+
+
+def record_events(db, events: Iterable[dict[str, Any] | None], session=None) -> None:
+    """Insert ``events`` (in ``session``'s transaction); ``number_events`` gives them their ``seq`` later."""
+
+    docs = [{**event, "unnumbered": True} for event in events if event]
+    if docs:
+        db.order_events.insert_many(docs, ordered=False, session=session)
+
+
+def _take_lease(db, name: str, owner: str, lease: timedelta) -> dict[str, Any] | None:
+    now = datetime.utcnow()
+    try:
+        return db.outbox_checkpoints.find_one_and_update(
+            {"_id": name, "$or": [{"leaseUntil": {"$not": {"$gt": now}}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "leaseUntil": now + lease}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        return None  # held by another process
+
+
+_sequencer_owner = f"{socket.gethostname()}:{os.getpid()}"
+_sequencer_lock = threading.Lock()
+
+
+def number_events(db, batch_size: int = 500, lease_seconds: float | None = None) -> int:
+    """Give committed ``unnumbered`` events the next ``seq`` values, oldest first; return how many.
+
+    Does nothing while another process holds the sequencer lease.
+    """
+
+    lease = timedelta(seconds=Config.OUTBOX_LEASE_SECONDS if lease_seconds is None else lease_seconds)
+    numbered = 0
+    with _sequencer_lock:
+        while _take_lease(db, SEQUENCER, _sequencer_owner, lease) is not None:
+            pending = [
+                doc["_id"]
+                for doc in db.order_events.find({"unnumbered": True}, {"_id": 1}).sort("_id", 1).limit(batch_size)
+            ]
+            if not pending:
+                break
+
+            def _write(session):
+                fenced = db.outbox_checkpoints.update_one(
+                    {"_id": SEQUENCER, "owner": _sequencer_owner},
+                    {"$set": {"leaseUntil": datetime.utcnow() + lease}},
+                    session=session,
+                )
+                if not fenced.matched_count:
+                    raise LeaseLostError("order event sequencer lost its lease")
+                counter = db.counters.find_one_and_update(
+                    {"_id": SEQUENCE_ID},
+                    {"$inc": {"seq": len(pending)}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                    session=session,
+                )
+                first = counter["seq"] - len(pending) + 1
+                db.order_events.bulk_write(
+                    [
+                        UpdateOne({"_id": event_id, "unnumbered": True}, {"$set": {"seq": first + offset}, "$unset": {"unnumbered": ""}})
+                        for offset, event_id in enumerate(pending)
+                    ],
+                    session=session,
+                )
+
+            run_in_transaction(db, _write)
+            numbered += len(pending)
+            if len(pending) < batch_size:
+                break
+    return numbered
+
+
+def update_order(
+    db, order: dict[str, Any], update: dict[str, Any], condition: dict[str, Any] | None = None, **context: Any
+) -> dict[str, Any] | None:
+    """Apply ``update`` to ``order`` and append its event in the same transaction.
+
+    ``order`` is the document as the caller last read it (used for the
+    previous status). ``condition`` further restricts the match, making the
+    update a conditional transition. Returns the updated order, or None if it
+    vanished or no longer matched ``condition``. ``statusKey`` /
+    ``paymentStatusKey`` follow any status the update sets. Requests waiting
+    on the order (``services.order_watch``) are woken once the write is
+    committed.
+    """
+
+    def _write(session):
+        updated = db.orders.find_one_and_update(
+            {**(condition or {}), "_id": order["_id"]}, with_status_keys(update), return_document=ReturnDocument.AFTER, session=session
+        )
+        if updated is not None:
+            record_events(db, [build_event(updated, ORDER_UPDATED, previous=order, **context)], session=session)
+        return updated
+
+    updated = run_in_transaction(db, _write)
+    if updated is not None:
+        notify_orders([updated["_id"]])
+    return updated
+
+
+def delete_order(db, order: dict[str, Any], **context: Any) -> bool:
+    """Delete ``order`` and append its ``order.deleted`` event in the same transaction.
+
+    The event describes the order as it was deleted, so consumers take it
+    out of the projections it was counted in. Returns False if it was already
+    gone.
+    """
+
+    def _write(session):
+        deleted = db.orders.find_one_and_delete({"_id": order["_id"]}, session=session)
+        if deleted is not None:
+            record_events(db, [build_event(deleted, ORDER_DELETED, **context)], session=session)
+        return deleted is not None
+
+    deleted = run_in_transaction(db, _write)
+    if deleted:
+        notify_orders([order["_id"]])
+    return deleted
+
+
+@contextmanager
+def _read_snapshot(db) -> Iterator[Any]:
+    """Session whose reads all see one point in time, where the deployment supports it."""
+
+    if not supports_transactions(db):
+        yield None
+        return
+    with db.client.start_session(snapshot=True) as session:
+        yield session
+
+
+def fold_increments(collection, increments: dict[Any, list[tuple[int, dict[str, float]]]], session=None) -> None:
+    """``$inc`` projection documents by event, skipping events a document already reflects.
+
+    ``increments`` maps a document ``_id`` to ``(seq, {field: delta})`` pairs.
+    Each document records the last ``seq`` folded into it (``lastSeq``) in the
+    same update, and the update only applies while ``lastSeq`` is still what
+    was read, so a batch replayed after a crash adds nothing twice.
+    """
+
+    if not increments:
+        return
+    applied = {
+        doc["_id"]: doc.get("lastSeq")
+        for doc in collection.find({"_id": {"$in": list(increments)}}, {"lastSeq": 1}, session=session)
+    }
+    now = datetime.utcnow()
+    ops = []
+    for doc_id, entries in increments.items():
+        last_seq = applied.get(doc_id)
+        fresh = [(seq, fields) for seq, fields in entries if last_seq is None or seq > last_seq]
+        if not fresh:
+            continue
+        inc: dict[str, float] = {}
+        for _, fields in fresh:
+            for field, delta in fields.items():
+                inc[field] = inc.get(field, 0) + delta
+        update: dict[str, Any] = {"$set": {"lastSeq": max(seq for seq, _ in fresh), "updatedAt": now}}
+        inc = {field: delta for field, delta in inc.items() if delta}
+        if inc:
+            update["$inc"] = inc
+        # A concurrent writer makes the upsert collide on _id and fails the batch instead of double-counting
+        current = {"$exists": False} if last_seq is None else last_seq
+        ops.append(UpdateOne({"_id": doc_id, "lastSeq": current}, update, upsert=True))
+    if ops:
+        collection.bulk_write(ops, ordered=False, session=session)
+
+
+def consumer_ready(db, name: str) -> bool:
+    """True once consumer ``name`` has built its projection (readers fall back to raw orders before)."""
+
+    checkpoint = db.outbox_checkpoints.find_one({"_id": name}, {"lastSeq": 1, "rebuildRequested": 1})
+    return bool(checkpoint) and checkpoint.get("lastSeq") is not None and not checkpoint.get("rebuildRequested")
+
+
+class OutboxConsumer:
+    """Feed ``order_events`` to ``handler`` in ``seq`` order, resuming from a stored checkpoint.
+
+    Only one process runs a consumer at a time: ``run_once`` first takes (or
+    renews) a lease on the checkpoint document (``owner``, ``leaseUntil``) and
+    does nothing while another process holds it. The handler's writes and the
+    checkpoint are committed in one transaction where the deployment supports
+    it, and the checkpoint is only written while the lease is still ours.
+    Without transactions a crash between the two replays the batch, so
+    handlers fold through ``fold_increments``, which skips events already
+    applied.
+
+    Without transactions the sequencer may also have taken a number it has
+    not written yet; the consumer stops in front of such a hole and only skips it
+    once it has stayed open for ``gap_timeout`` seconds (the writer died, or
+    the event expired before it was read).
+
+    A consumer with a ``rebuild`` function recomputes its projection from the
+    orders when it has no checkpoint yet (first start, or after
+    ``request_rebuild``), so a fresh deployment needs no manual step. Events
+    that were committed but not numbered when the rebuild read the orders are
+    remembered in ``skipEvents`` and not applied a second time.
+    """
+
+    def __init__(
+        self,
+        db,
+        name: str,
+        handler: EventHandler,
+        batch_size: int = 200,
+        rebuild: Rebuild | None = None,
+        lease_seconds: float | None = None,
+        gap_timeout: float = 30.0,
+    ):
+        self.db = db
+        self.name = name
+        self.handler = handler
+        self.batch_size = batch_size
+        self.rebuild = rebuild
+        self.lease = timedelta(seconds=Config.OUTBOX_LEASE_SECONDS if lease_seconds is None else lease_seconds)
+        self.gap_timeout = gap_timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self._gap: tuple[int, float] | None = None  # (missing seq, monotonic time first seen)
+
+    def acquire(self) -> dict[str, Any] | None:
+        """Take or renew the lease; return the checkpoint document, or None when another process holds it."""
+
+        return _take_lease(self.db, self.name, self.owner, self.lease)
+
+    def release(self) -> None:
+        self.db.outbox_checkpoints.update_one(
+            {"_id": self.name, "owner": self.owner}, {"$set": {"leaseUntil": datetime.utcnow()}}
+        )
+
+    def _save_checkpoint(self, fields: dict[str, Any], processed: int = 0, session=None) -> None:
+        now = datetime.utcnow()
+        update: dict[str, Any] = {"$set": {**fields, "updatedAt": now, "leaseUntil": now + self.lease}}
+        if processed:
+            update["$inc"] = {"processed": processed}
+        saved = self.db.outbox_checkpoints.update_one({"_id": self.name, "owner": self.owner}, update, session=session)
+        if not saved.matched_count:
+            raise LeaseLostError(f"outbox consumer '{self.name}' lost its lease")
+
+    def request_rebuild(self) -> None:
+        """Have whichever process holds the lease rebuild the projection on its next run."""
+
+        self.db.outbox_checkpoints.update_one({"_id": self.name}, {"$set": {"rebuildRequested": True}}, upsert=True)
+
+    def rebuild_projection(self) -> int:
+        """Recompute the projection (the lease must be held); return the ``seq`` it is current up to."""
+
+        # Readers fall back to the orders until the new checkpoint is written
+        self._save_checkpoint({"lastSeq": None, "rebuildRequested": False})
+        with _read_snapshot(self.db) as session:
+            last_seq = _last_seq(self.db, session)
+            # Already committed, so already in the rebuilt projection, but numbered after ``last_seq``
+            skip = [doc["_id"] for doc in self.db.order_events.find({"unnumbered": True}, {"_id": 1}, session=session)]
+            self.rebuild(self.db, session)
+        self._save_checkpoint({"lastSeq": last_seq, "skipEvents": skip})
+        return last_seq
+
+    def _gap_expired(self, missing: int) -> bool:
+        now = time.monotonic()
+        if self._gap is None or self._gap[0] != missing:
+            self._gap = (missing, now)
+        return now - self._gap[1] >= self.gap_timeout
+
+    def _contiguous(self, batch: list[dict[str, Any]], last_seq: int) -> list[dict[str, Any]]:
+        """Cut ``batch`` at the first hole in the sequence that is not yet old enough to skip."""
+
+        expected = last_seq + 1
+        for index, event in enumerate(batch):
+            if event["seq"] != expected and not self._gap_expired(expected):
+                return batch[:index]
+            expected = event["seq"] + 1
+        return batch
+
+    def _apply(self, batch: list[dict[str, Any]], skip: set[Any]) -> None:
+        fields: dict[str, Any] = {"lastSeq": batch[-1]["seq"]}
+        events = batch
+        if skip:
+            events = [event for event in batch if event["_id"] not in skip]
+            skip.difference_update(event["_id"] for event in batch)
+            fields["skipEvents"] = list(skip)
+
+        def _write(session):
+            if events:
+                self.handler(self.db, events, session)
+            self._save_checkpoint(fields, len(events), session=session)
+
+        run_in_transaction(self.db, _write)
+
+    def run_once(self) -> int:
+        """Process every event after the checkpoint, if this process holds the lease; return how many."""
+
+        checkpoint = self.acquire()
+        if checkpoint is None:
+            return 0
+        if self.rebuild is not None and (checkpoint.get("lastSeq") is None or checkpoint.get("rebuildRequested")):
+            self.rebuild_projection()
+            checkpoint = self.acquire()
+            if checkpoint is None:
+                return 0
+        last_seq = checkpoint.get("lastSeq") or 0
+        skip = set(checkpoint.get("skipEvents") or [])
+        number_events(self.db, lease_seconds=self.lease.total_seconds())
+
+        handled = 0
+        while True:
+            events = list(self.db.order_events.find({"seq": {"$gt": last_seq}}).sort("seq", 1).limit(self.batch_size))
+            batch = self._contiguous(events, last_seq)
+            if not batch:
+                return handled
+            self._apply(batch, skip)
+            last_seq = batch[-1]["seq"]
+            handled += len(batch)
+            if len(batch) < self.batch_size:
+                return handled
+
+    def _wait_for_events(self, timeout: float) -> None:
+        """Block until an event is inserted (change stream) or ``timeout`` elapses."""
+
+        try:
+            with self.db.order_events.watch([{"$match": {"operationType": "insert"}}], max_await_time_ms=int(timeout * 1000)) as stream:
+                stream.try_next()
+                return
+        except PyMongoError:
+            # Standalone server (no change streams): plain polling.
+            time.sleep(timeout)
+
+    def run_forever(self, poll_interval: float = 5.0, stop: threading.Event | None = None) -> None:
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                self.run_once()
+            except Exception as exc:  # pragma: no cover - keep the consumer alive
+                print(f"Warning: outbox consumer '{self.name}' failed: {exc}")
+                stop.wait(poll_interval)
+                continue
+            self._wait_for_events(poll_interval)
+
+
+# ---------------------------------------------------------------------------
+# Built-in projection: order count and revenue per status
+# ---------------------------------------------------------------------------
+
+STATUS_TOTALS = "status-totals"
+
+
+def _amount(value: Any) -> float:
+    # Totals may be stored as Decimal128 or numeric strings; an unreadable one counts as 0
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def apply_status_totals(db, events: list[dict[str, Any]], session=None) -> None:
+    """Keep ``order_status_totals`` (count and summed total per status key) current."""
+
+    increments: dict[str, list[tuple[int, dict[str, float]]]] = {}
+
+    def _add(seq: int, status: Any, count: int, amount: float) -> None:
+        increments.setdefault(status_key(status), []).append((seq, {"count": count, "revenue": amount}))
+
+    for event in events:
+        amount = _amount(event.get("total"))
+        if event.get("type") == ORDER_CREATED:
+            _add(event["seq"], event.get("status"), 1, amount)
+        elif event.get("type") == ORDER_UPDATED and status_key(event.get("previousStatus")) != status_key(event.get("status")):
+            _add(event["seq"], event.get("previousStatus"), -1, -amount)
+            _add(event["seq"], event.get("status"), 1, amount)
+        elif event.get("type") == ORDER_DELETED:
+            _add(event["seq"], event.get("status"), -1, -amount)
+    fold_increments(db.order_status_totals, increments, session=session)
+
+
+def rebuild_status_totals(db, session=None) -> int:
+    """Recompute ``order_status_totals`` from ``orders`` and the archive rollups; return the number of statuses."""
+
+    totals: dict[str, dict[str, Any]] = {}
+    rows = list(
+        db.orders.aggregate(
+            [{"$group": {"_id": "$status", "count": {"$sum": 1}, "revenue": {"$sum": {"$ifNull": ["$total", 0]}}}}],
+            session=session,
+        )
+    )
+    # Archiving emits no events, so archived orders keep counting under their final status
+    rows += list(
+        db.orders_archive_rollups.aggregate(
+            [{"$group": {"_id": "$status", "count": {"$sum": "$count"}, "revenue": {"$sum": "$revenue"}}}],
+            session=session,
+        )
+    )
+    for row in rows:
+        entry = totals.setdefault(status_key(row["_id"]), {"count": 0, "revenue": 0.0})
+        entry["count"] += row.get("count") or 0
+        entry["revenue"] += _amount(row.get("revenue"))
+
+    db.order_status_totals.delete_many({})
+    if totals:
+        db.order_status_totals.insert_many([{"_id": status, **entry} for status, entry in totals.items()])
+    return len(totals)
+
+
+def status_totals(db) -> dict[str, int] | None:
+    """Order count per status key (hot and archived), or None until the projection is built."""
+
+    if not consumer_ready(db, STATUS_TOTALS):
+        return None
+    return {doc["_id"]: int(doc.get("count") or 0) for doc in db.order_status_totals.find({}, {"count": 1})}
+
+
+# name -> (handler, rebuild) for ``flask outbox consume`` and the background jobs
+CONSUMERS: dict[str, tuple[EventHandler, Rebuild | None]] = {
+    STATUS_TOTALS: (apply_status_totals, rebuild_status_totals),
+}
+
+
+def make_consumer(db, name: str, **options: Any) -> OutboxConsumer:
+    handler, rebuild = CONSUMERS[name]
+    return OutboxConsumer(db, name, handler, rebuild=rebuild, **options)
+
+
+__all__ = [
+    "CONSUMERS",
+    "LeaseLostError",
+    "ORDER_CREATED",
+    "ORDER_DELETED",
+    "ORDER_UPDATED",
+    "OutboxConsumer",
+    "SEQUENCE_ID",
+    "STATUS_TOTALS",
+    "apply_status_totals",
+    "build_event",
+    "consumer_ready",
+    "delete_order",
+    "ensure_outbox_indexes",
+    "fold_increments",
+    "make_consumer",
+    "number_events",
+    "rebuild_status_totals",
+    "record_events",
+    "status_totals",
+    "update_order",
+]
@@ -0,0 +1,300 @@
+"""Idempotent handling of payment gateway callbacks.
+
+Gateways retry notifications aggressively and VNPAY delivers the same result
+twice (browser return URL plus server IPN). Every processed callback is
+recorded once in ``payment_callbacks`` under a unique ``(gateway, key)``
+index, where ``key`` is the gateway transaction id (or, for callbacks without
+one such as cancelled VNPAY payments, the callback signature). A duplicate is
+answered from that record, or from a small per-process LRU in front of it,
+before the order is loaded.
+
+Payment state changes are conditional, so concurrent or out-of-order
+deliveries cannot undo each other:
+
+* ``Failed`` is only applied to an order whose payment is still pending and
+  that was not cancelled meanwhile;
+* ``Paid`` is applied to such an order or to one whose reservation expired
+  (a late payment still wins, see ``commit_reservation``), never over a
+  ``Paid`` or ``Failed`` result or an order the customer or an admin
+  cancelled.
+
+Side effects (stock commit/release) run only when the transition actually
+matched. ``process_vnpay_callback`` and ``process_momo_ipn`` hold the full
+verification + transition logic shared by the synchronous return URL and the
+queued IPN worker (``services.payment_events``); signatures are checked by the
+endpoints before that. ``vnpay_outcome`` / ``momo_outcome`` map a gateway
+result to the payment fields and are also used for the status query answers
+in ``services.payment_reconciliation``.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any
+
+from pymongo.errors import DuplicateKeyError
+
+from config import Config
+from services.order_lookup import find_order
+from services.outbox import update_order
+from services.reservations import PENDING_PAYMENT_STATUSES, commit_reservation, release_reservation
+from vnpay_helpers import VNPAYHelper
+
+PAID = "paid"
+FAILED = "failed"
+AMOUNT_MISMATCH = "amount_mismatch"
+
+_PENDING = PENDING_PAYMENT_STATUSES
+CANCELLED_STATUSES = ["cancelled", "Cancelled", "CANCELLED", "canceled", "Canceled", "CANCELED"]
+# Open order: payment pending and not cancelled by the customer or an admin
+_OPEN = {"payment.status": {"$in": _PENDING}, "status": {"$nin": CANCELLED_STATUSES}}
+# Expired by the reservation sweeper (which also sets ``Cancelled``)
+_EXPIRED = {"payment.status": {"$in": ["Expired", "expired"]}}
+TRANSITION_FROM = {
+    PAID: {"$or": [_OPEN, _EXPIRED]},
+    FAILED: _OPEN,
+    AMOUNT_MISMATCH: _OPEN,
+}
+
+ACK_CACHE_SIZE = 4096
+
+
+class _AckCache:
+    def __init__(self, maxsize: int = ACK_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict[tuple[str, str], dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[str, str]) -> dict[str, Any] | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple[str, str], value: dict[str, Any]) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_acks = _AckCache()
+
+
+def ensure_callback_indexes(db) -> None:
+    try:
+        db.payment_callbacks.create_index([("gateway", 1), ("key", 1)], unique=True)
+        db.payment_callbacks.create_index([("orderRef", 1)])
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure payment_callbacks indexes: {exc}")
+
+
+def callback_key(transaction_id: Any, signature: str | None) -> str | None:
+    """Dedupe key: the gateway transaction id, or the signature when the gateway sent none."""
+
+    text = str(transaction_id or "").strip()
+    if text and text != "0":
+        return text
+    return f"sig:{signature}" if signature else None
+
+
+def seen_callback(db, gateway: str, key: str | None) -> dict[str, Any] | None:
+    """Return the stored outcome for an already processed callback, or None."""
+
+    if not key:
+        return None
+    cached = _acks.get((gateway, key))
+    if cached is not None:
+        return cached
+    record = db.payment_callbacks.find_one({"gateway": gateway, "key": key}, {"_id": 0})
+    if record is not None:
+        _acks.put((gateway, key), record)
+    return record
+
+
+def remember_callback(db, gateway: str, key: str | None, order: dict[str, Any], outcome: str, **details: Any) -> dict[str, Any]:
+    """Record the outcome of a processed callback; the first writer wins."""
+
+    record = {
+        "gateway": gateway,
+        "key": key,
+        "orderRef": order.get("_id"),
+        "outcome": outcome,
+        **details,
+        "createdAt": datetime.utcnow(),
+    }
+    if not key:
+        return record
+    try:
+        db.payment_callbacks.insert_one(dict(record))
+    except DuplicateKeyError:
+        record = db.payment_callbacks.find_one({"gateway": gateway, "key": key}, {"_id": 0}) or record
+    _acks.put((gateway, key), record)
+    return record
+
+
+def transition_payment(db, order: dict[str, Any], outcome: str, update: dict[str, Any], **context: Any) -> dict[str, Any] | None:
+    """Apply ``update`` only if the order's payment may move to ``outcome``; return the updated order or None."""
+
+    return update_order(
+        db, order, update,
+        condition=TRANSITION_FROM[outcome],
+        **context,
+    )
+
+
+def _expected_amounts(order: dict[str, Any]) -> tuple[float, int]:
+    total_usd = float(order.get("total") or order.get("totalUsd") or 0)
+    return total_usd, int(order.get("totalVnd") or round(total_usd * Config.EXCHANGE_RATE))
+
+
+def _settle(db, order: dict[str, Any], outcome: str, update: dict[str, Any]) -> dict[str, Any] | None:
+    updated = transition_payment(db, order, outcome, update)
+    if updated and outcome == PAID:
+        commit_reservation(db, order["_id"])
+    elif updated:
+        release_reservation(db, order["_id"], "payment_failed")
+    return updated
+
+
+def vnpay_outcome(order: dict[str, Any], params: dict[str, Any], now: datetime | None = None) -> tuple[str, dict[str, Any]]:
+    """Map a VNPAY result (callback or ``querydr`` answer) to ``(outcome, fields to $set)``."""
+
+    now = now or datetime.utcnow()
+    response_code = params.get("vnp_ResponseCode")
+    transaction_status = params.get("vnp_TransactionStatus")
+    paid_vnd = int(params.get("vnp_Amount") or 0) // 100
+    _, expected_vnd = _expected_amounts(order)
+
+    if paid_vnd != expected_vnd:
+        outcome = AMOUNT_MISMATCH
+        fields = {
+            "payment.status": "Failed",
+            "payment.note": f"Amount mismatch: paid {paid_vnd} VND vs expected {expected_vnd} VND",
+            "payment.expectedAmount": expected_vnd,
+            "payment.receivedAmount": paid_vnd,
+            "status": "Payment Failed",
+        }
+    elif response_code == "00" and transaction_status in (None, "00"):
+        outcome = PAID
+        fields = {
+            "payment.method": "VNPAY",
+            "payment.status": "Paid",
+            "payment.transactionId": params.get("vnp_TransactionNo"),
+            "payment.bankCode": params.get("vnp_BankCode"),
+            "payment.payDate": params.get("vnp_PayDate"),
+            "status": "Paid",
+            "paidAt": now,
+        }
+    else:
+        outcome = FAILED
+        fields = {
+            "payment.method": "VNPAY",
+            "payment.status": "Failed",
+            "payment.transactionId": params.get("vnp_TransactionNo"),
+            "payment.responseCode": response_code,
+            "payment.failReason": (
+                VNPAYHelper.get_transaction_status_description(transaction_status)
+                if response_code == "00"
+                else VNPAYHelper.get_response_description(response_code)
+            ),
+            "status": "Payment Failed",
+        }
+    return outcome, {key: value for key, value in fields.items() if value is not None}
+
+
+def momo_outcome(order: dict[str, Any], data: dict[str, Any]) -> tuple[str, dict[str, Any]]:
+    """Map a MoMo result (IPN or query API answer) to ``(outcome, fields to $set)``."""
+
+    try:
+        result_code = int(data.get("resultCode", -1))
+    except (TypeError, ValueError):
+        result_code = -1
+    try:
+        paid_vnd = int(data.get("amount") or 0)
+    except (TypeError, ValueError):
+        paid_vnd = 0
+    _, expected_vnd = _expected_amounts(order)
+
+    fields: dict[str, Any] = {
+        "payment.method": "MOMO",
+        "payment.transactionId": data.get("transId"),
+        "payment.resultCode": result_code,
+    }
+    # Amount mismatch is always a failure, regardless of resultCode
+    if paid_vnd != expected_vnd:
+        outcome = AMOUNT_MISMATCH
+        fields["payment.note"] = f"Amount mismatch: paid {paid_vnd} VND vs expected {expected_vnd} VND"
+    else:
+        outcome = PAID if result_code == 0 else FAILED
+    fields["payment.status"] = "Paid" if outcome == PAID else "Failed"
+    fields["status"] = "Paid" if outcome == PAID else "Payment Failed"
+    return outcome, fields
+
+
+def process_vnpay_callback(db, params: dict[str, str]) -> dict[str, Any] | None:
+    """Apply a signature-checked VNPAY result; return its callback record, or None if the order is unknown."""
+
+    callback_id = callback_key(params.get("vnp_TransactionNo"), params.get("vnp_SecureHash"))
+    seen = seen_callback(db, "vnpay", callback_id)
+    if seen:
+        return seen
+    order = find_order(db, params.get("vnp_TxnRef"))
+    if not order:
+        return None
+
+    now = datetime.utcnow()
+    outcome, fields = vnpay_outcome(order, params, now)
+    updated = _settle(db, order, outcome, {"$set": {**fields, "updatedAt": now}})
+    return remember_callback(
+        db, "vnpay", callback_id, order, outcome,
+        applied=bool(updated), amountUsd=_expected_amounts(order)[0], responseCode=params.get("vnp_ResponseCode"),
+    )
+
+
+def process_momo_ipn(db, data: dict[str, Any]) -> dict[str, Any] | None:
+    """Apply a signature-checked MoMo IPN; return its callback record, or None if the order is unknown."""
+
+    callback_id = callback_key(data.get("transId"), data.get("signature"))
+    seen = seen_callback(db, "momo", callback_id)
+    if seen:
+        return seen
+    order = find_order(db, data.get("orderId"))
+    if not order:
+        return None
+
+    outcome, fields = momo_outcome(order, data)
+    updated = _settle(db, order, outcome, {"$set": {**fields, "updatedAt": datetime.utcnow()}})
+    return remember_callback(
+        db, "momo", callback_id, order, outcome,
+        applied=bool(updated), amountUsd=_expected_amounts(order)[0], resultCode=fields["payment.resultCode"],
+    )
+
+
+def clear_cache() -> None:
+    _acks.clear()
+
+
+__all__ = [
+    "AMOUNT_MISMATCH",
+    "FAILED",
+    "PAID",
+    "TRANSITION_FROM",
+    "callback_key",
+    "clear_cache",
+    "ensure_callback_indexes",
+    "momo_outcome",
+    "process_momo_ipn",
+    "process_vnpay_callback",
+    "remember_callback",
+    "seen_callback",
+    "transition_payment",
+    "vnpay_outcome",
+]
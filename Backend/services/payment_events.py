@@ -0,0 +1,223 @@
+"""Durable ingestion queue for payment gateway notifications (IPNs).
+
+IPN endpoints only verify the signature, append the raw payload to
+``payment_events`` and acknowledge, so a slow database never turns into
+gateway timeouts and retry storms. ``PaymentEventWorker`` processes the queue
+with a thread pool:
+
+* events of one order are handled strictly in arrival (``_id``) order. A
+  worker first takes a short lease on the order key in
+  ``payment_event_leases``, so several processes can run workers safely;
+* a failing event is retried with exponential backoff and blocks the later
+  events of the same order until it succeeds or is dead-lettered
+  (``status: "dead"``) after ``Config.PAYMENT_EVENTS_MAX_ATTEMPTS`` attempts;
+* ``replay_events`` puts stored events (dead ones, or any selection) back in
+  the queue. Processing is idempotent (``services.payment_callbacks``), so
+  replaying an event that already took effect changes nothing.
+
+Event states: ``pending`` -> ``done`` | ``dead``.
+"""
+from __future__ import annotations
+
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from config import Config
+from services import payment_log
+from services.payment_callbacks import process_momo_ipn, process_vnpay_callback
+
+EventHandler = Callable[[Any, dict[str, Any]], Any]
+
+
+class UnknownOrderError(LookupError):
+    """The event refers to an order we do not have (yet)."""
+
+
+def _require(record, event: dict[str, Any]):
+    if record is None:
+        raise UnknownOrderError(f"Order {event.get('orderKey')} not found")
+    return record
+
+
+HANDLERS: dict[str, EventHandler] = {
+    "vnpay": lambda db, event: _require(process_vnpay_callback(db, event["payload"]), event),
+    "momo": lambda db, event: _require(process_momo_ipn(db, event["payload"]), event),
+}
+
+
+def ensure_payment_event_indexes(db) -> None:
+    try:
+        db.payment_events.create_index([("status", 1), ("nextAttemptAt", 1)])
+        db.payment_events.create_index([("orderKey", 1), ("_id", 1)])
+        db.payment_event_leases.create_index([("expiresAt", 1)], expireAfterSeconds=3600)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure payment_events indexes: {exc}")
+
+
+def enqueue_event(db, gateway: str, order_key: Any, payload: dict[str, Any]) -> Any:
+    """Durably store a verified notification; returns the event id."""
+
+    now = datetime.utcnow()
+    return db.payment_events.insert_one(
+        {
+            "gateway": gateway,
+            "orderKey": str(order_key or ""),
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "receivedAt": now,
+            "nextAttemptAt": now,
+        }
+    ).inserted_id
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(Config.PAYMENT_EVENTS_RETRY_SECONDS * 2 ** (attempts - 1), 3600))
+
+
+class PaymentEventWorker:
+    """Drain due ``payment_events`` with ``workers`` threads, one order at a time per thread."""
+
+    def __init__(self, db, handlers: dict[str, EventHandler] | None = None, workers: int | None = None):
+        self.db = db
+        self.handlers = handlers or HANDLERS
+        self.workers = workers or Config.PAYMENT_EVENTS_WORKERS
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self.lease = timedelta(seconds=Config.PAYMENT_EVENTS_LEASE_SECONDS)
+
+    def _due_keys(self, now: datetime, limit: int) -> list[str]:
+        rows = self.db.payment_events.aggregate(
+            [
+                {"$match": {"status": "pending", "nextAttemptAt": {"$lte": now}}},
+                {"$group": {"_id": "$orderKey", "first": {"$min": "$_id"}}},
+                {"$sort": {"first": 1}},
+                {"$limit": limit},
+            ]
+        )
+        return [row["_id"] for row in rows]
+
+    def _acquire(self, key: str, now: datetime) -> bool:
+        try:
+            lease = self.db.payment_event_leases.find_one_and_update(
+                {"_id": key, "$or": [{"expiresAt": {"$lte": now}}, {"owner": self.owner}]},
+                {"$set": {"owner": self.owner, "expiresAt": now + self.lease}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return False  # held by another worker
+        return lease is not None
+
+    def _release(self, key: str) -> None:
+        self.db.payment_event_leases.delete_one({"_id": key, "owner": self.owner})
+
+    def _handle(self, event: dict[str, Any]) -> bool:
+        """Process one event; False when it must be retried later (blocks the order)."""
+
+        attempts = event.get("attempts", 0) + 1
+        try:
+            handler = self.handlers[event["gateway"]]
+            record = handler(self.db, event)
+        except Exception as exc:
+            now = datetime.utcnow()
+            dead = attempts >= Config.PAYMENT_EVENTS_MAX_ATTEMPTS
+            update: dict[str, Any] = {
+                "attempts": attempts,
+                "lastError": f"{type(exc).__name__}: {exc}",
+                "nextAttemptAt": now + _backoff(attempts),
+            }
+            if dead:
+                update.update({"status": "dead", "deadAt": now})
+                print(f"Warning: payment event {event['_id']} dead-lettered after {attempts} attempts: {exc}")
+            self.db.payment_events.update_one({"_id": event["_id"]}, {"$set": update})
+            payment_log.record(
+                "event_dead" if dead else "event_failed",
+                event.get("gateway"),
+                event.get("orderKey"),
+                level="error" if dead else "warning",
+                eventId=event["_id"],
+                attempts=attempts,
+                error=update["lastError"],
+            )
+            return dead
+        self.db.payment_events.update_one(
+            {"_id": event["_id"]},
+            {"$set": {"status": "done", "attempts": attempts, "processedAt": datetime.utcnow()}, "$unset": {"lastError": ""}},
+        )
+        outcome = record.get("outcome") if isinstance(record, dict) else None
+        payment_log.record("event_processed", event.get("gateway"), event.get("orderKey"), eventId=event["_id"], attempts=attempts, outcome=outcome)
+        return True
+
+    def process_key(self, key: str) -> int:
+        """Drain the due events of one order, in order; return how many were settled."""
+
+        now = datetime.utcnow()
+        if not self._acquire(key, now):
+            return 0
+        settled = 0
+        try:
+            for event in self.db.payment_events.find({"orderKey": key, "status": "pending"}).sort("_id", 1):
+                if event["nextAttemptAt"] > now or not self._handle(event):
+                    break  # keep later events of this order behind the one waiting to retry
+                settled += 1
+        finally:
+            self._release(key)
+        return settled
+
+    def run_once(self, batch_size: int = 100) -> int:
+        """Process every order with due events; return the number of events settled."""
+
+        settled = 0
+        while True:
+            keys = self._due_keys(datetime.utcnow(), batch_size)
+            if not keys:
+                return settled
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="payment-events") as pool:
+                done = sum(pool.map(self.process_key, keys))
+            settled += done
+            if len(keys) < batch_size or not done:
+                return settled
+
+
+def replay_events(
+    db,
+    event_ids: list[Any] | None = None,
+    order_key: str | None = None,
+    status: str | None = "dead",
+    since: datetime | None = None,
+) -> int:
+    """Queue stored events again with a fresh retry budget; return how many were reset."""
+
+    query: dict[str, Any] = {}
+    if event_ids:
+        query["_id"] = {"$in": event_ids}
+    if order_key:
+        query["orderKey"] = order_key
+    if status:
+        query["status"] = status
+    if since is not None:
+        query["receivedAt"] = {"$gte": since}
+    result = db.payment_events.update_many(
+        query,
+        {
+            "$set": {"status": "pending", "attempts": 0, "nextAttemptAt": datetime.utcnow(), "replayedAt": datetime.utcnow()},
+            "$unset": {"deadAt": "", "lastError": ""},
+        },
+    )
+    return result.modified_count
+
+
+__all__ = [
+    "HANDLERS",
+    "PaymentEventWorker",
+    "UnknownOrderError",
+    "enqueue_event",
+    "ensure_payment_event_indexes",
+    "replay_events",
+]
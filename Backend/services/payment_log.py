@@ -0,0 +1,244 @@
+"""Buffered, structured audit log of payment gateway traffic.
+
+Payment handlers call ``record(event, gateway, order_ref, **fields)``. The
+event is masked and appended to a bounded in-memory queue; nothing is written
+on the request thread. A daemon thread flushes batches of up to
+``Config.PAYMENT_LOG_BATCH_SIZE`` events at least every
+``Config.PAYMENT_LOG_FLUSH_SECONDS`` to the configured sink:
+
+* ``mongo`` (default): ``insert_many`` into ``payment_logs``, expired after
+  ``Config.PAYMENT_LOG_TTL_DAYS``;
+* ``jsonl``: JSON lines appended to ``Config.PAYMENT_LOG_PATH``, rotated at
+  ``Config.PAYMENT_LOG_MAX_BYTES`` keeping ``Config.PAYMENT_LOG_BACKUPS`` files.
+
+A full queue drops (and counts) new events rather than blocking a callback.
+Signatures, secrets and tokens are masked to their last four characters
+before they are queued.
+"""
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any
+
+from config import Config
+
+SENSITIVE_KEYS = frozenset(
+    {
+        "vnp_securehash",
+        "signature",
+        "accesskey",
+        "secretkey",
+        "hashsecret",
+        "password",
+        "token",
+        "authorization",
+        "cardnumber",
+        "vnp_cardnumber",
+    }
+)
+
+
+def _mask_value(value: Any) -> str:
+    text = str(value)
+    return f"****{text[-4:]}" if len(text) > 8 else "****"
+
+
+def mask(data: Any) -> Any:
+    """Copy of ``data`` with sensitive values masked, at any nesting depth."""
+
+    if isinstance(data, dict):
+        return {
+            key: _mask_value(value) if str(key).lower() in SENSITIVE_KEYS and value not in (None, "") else mask(value)
+            for key, value in data.items()
+        }
+    if isinstance(data, (list, tuple)):
+        return [mask(item) for item in data]
+    return data
+
+
+def ensure_payment_log_indexes(db) -> None:
+    try:
+        db.payment_logs.create_index([("orderRef", 1), ("ts", -1)])
+        db.payment_logs.create_index([("ts", 1)], expireAfterSeconds=Config.PAYMENT_LOG_TTL_DAYS * 86400)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure payment_logs indexes: {exc}")
+
+
+class MongoSink:
+    def __init__(self, db):
+        self.db = db
+
+    def write(self, events: list[dict[str, Any]]) -> None:
+        self.db.payment_logs.insert_many(events, ordered=False)
+
+
+class JsonlSink:
+    """Append-only JSON lines file with size-based rotation (``payments.jsonl.1`` is the newest backup)."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _rotate(self) -> None:
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, events: list[dict[str, Any]]) -> None:
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+        lines = "".join(json.dumps(event, default=str, ensure_ascii=False) + "\n" for event in events)
+        with open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(lines)
+
+
+class PaymentAuditLog:
+    def __init__(self, queue_size: int, batch_size: int, flush_seconds: float):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue: queue.Queue[dict[str, Any]] = queue.Queue(maxsize=queue_size)
+        self._sink: MongoSink | JsonlSink | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.stats = {"written": 0, "dropped": 0, "failed": 0}
+        self._host = socket.gethostname()
+
+    def configure(self, sink: MongoSink | JsonlSink) -> None:
+        self._sink = sink
+        self._ensure_flusher()
+
+    def _ensure_flusher(self) -> None:
+        # A forked worker inherits the queue but not the thread.
+        if self._sink is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="payment-log", daemon=True).start()
+
+    def record(self, event: str, gateway: str, order_ref: Any = None, level: str = "info", **fields: Any) -> None:
+        entry = {
+            "ts": datetime.utcnow(),
+            "event": event,
+            "gateway": gateway,
+            "orderRef": None if order_ref is None else str(order_ref),
+            "level": level,
+            "host": self._host,
+            "pid": os.getpid(),
+            **mask(fields),
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.stats["dropped"] += 1
+        self._ensure_flusher()
+
+    def _take_batch(self, wait: bool) -> list[dict[str, Any]]:
+        batch: list[dict[str, Any]] = []
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if wait and not batch:
+                    batch.append(self._queue.get())
+                elif wait and timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list[dict[str, Any]]) -> None:
+        if not batch or self._sink is None:
+            return
+        with self._write_lock:
+            try:
+                self._sink.write(batch)
+                self.stats["written"] += len(batch)
+            except Exception as exc:
+                self.stats["failed"] += len(batch)
+                print(f"Warning: failed to write {len(batch)} payment log events: {exc}")
+
+    def _run(self) -> None:
+        while True:
+            self._write(self._take_batch(wait=True))
+
+    def flush(self) -> None:
+        """Write everything queued so far (shutdown, CLI commands)."""
+
+        while True:
+            batch = self._take_batch(wait=False)
+            if not batch:
+                return
+            self._write(batch)
+
+
+_log = PaymentAuditLog(Config.PAYMENT_LOG_QUEUE_SIZE, Config.PAYMENT_LOG_BATCH_SIZE, Config.PAYMENT_LOG_FLUSH_SECONDS)
+atexit.register(_log.flush)
+
+
+def init_payment_log(db) -> None:
+    """Attach the sink selected by ``Config.PAYMENT_LOG_SINK`` and start flushing."""
+
+    if Config.PAYMENT_LOG_SINK == "jsonl":
+        _log.configure(JsonlSink(Config.PAYMENT_LOG_PATH, Config.PAYMENT_LOG_MAX_BYTES, Config.PAYMENT_LOG_BACKUPS))
+    else:
+        ensure_payment_log_indexes(db)
+        _log.configure(MongoSink(db))
+
+
+def record(event: str, gateway: str, order_ref: Any = None, level: str = "info", **fields: Any) -> None:
+    """Queue one audit event; never blocks and never raises for a full queue."""
+
+    _log.record(event, gateway, order_ref, level=level, **fields)
+
+
+def flush() -> None:
+    _log.flush()
+
+
+def stats() -> dict[str, int]:
+    return {**_log.stats, "queued": _log._queue.qsize()}
+
+
+def order_log(db, order_ref: Any, since_days: int = 30) -> list[dict[str, Any]]:
+    """Audit events of one order, oldest first (``mongo`` sink only)."""
+
+    return list(
+        db.payment_logs.find(
+            {"orderRef": str(order_ref), "ts": {"$gte": datetime.utcnow() - timedelta(days=since_days)}},
+            {"_id": 0},
+        ).sort("ts", 1)
+    )
+
+
+__all__ = [
+    "JsonlSink",
+    "MongoSink",
+    "PaymentAuditLog",
+    "ensure_payment_log_indexes",
+    "flush",
+    "init_payment_log",
+    "mask",
+    "order_log",
+    "record",
+    "stats",
+]
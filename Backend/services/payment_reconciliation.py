@@ -0,0 +1,255 @@
+"""Reconcile gateway payments whose notification never arrived.
+
+An order paid through VNPAY or MoMo stays ``Pending`` when the IPN / return
+URL is lost (customer closed the tab, gateway outage, our endpoint down), and
+once its reservation runs out the sweeper marks the payment ``Expired``.
+``reconcile_pending_payments`` periodically:
+
+* selects gateway orders still pending ``Config.PAYMENT_RECONCILE_AFTER_MINUTES``
+  after creation, plus those whose reservation expired in the last
+  ``Config.PAYMENT_RECONCILE_EXPIRED_HOURS`` (one partial index each),
+  skipping those checked in the last ``Config.PAYMENT_RECONCILE_RECHECK_MINUTES``;
+* asks the gateway query API (VNPAY ``querydr``, MoMo ``/query``) for each,
+  with ``Config.PAYMENT_RECONCILE_CONCURRENCY`` threads and at most
+  ``Config.PAYMENT_RECONCILE_RATE_PER_SECOND`` requests per gateway;
+* maps the answers with the same ``vnpay_outcome`` / ``momo_outcome`` as the
+  callbacks and applies them in one ``bulk_write`` of conditional updates
+  (``TRANSITION_FROM``), so a callback processed meanwhile always wins. Order
+  events, stock commit/release and the ``payment_callbacks`` record follow
+  for the orders that actually transitioned.
+
+Answers that are not final yet (customer still on the payment page, gateway
+processing, transaction unknown) only stamp ``payment.reconciledAt``; the
+reservation sweeper expires those orders as usual. For an expired order only
+a successful payment changes anything (the stock is taken again, see
+``commit_reservation``); any other answer is just stamped.
+
+For offline testing point ``VNP_QUERY_URL`` / ``MOMO_QUERY_ENDPOINT`` at the
+stand-in gateways in ``simulators.gateways``.
+"""
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from pymongo import UpdateOne
+
+from config import Config
+from momo_service import query_momo_payment
+from services.order_watch import notify_orders
+from services.outbox import ORDER_UPDATED, build_event, record_events
+from services.payment_callbacks import (
+    PAID,
+    TRANSITION_FROM,
+    callback_key,
+    momo_outcome,
+    remember_callback,
+    vnpay_outcome,
+)
+from services.reservations import commit_reservation, release_reservation
+from services.status_keys import with_status_keys
+from services.transactions import run_in_transaction
+from vnpay_utils import query_transaction
+
+GATEWAYS = ("VNPAY", "MOMO")
+# Payment statuses a gateway answer can still settle
+RECONCILED_STATUSES = ["Pending", "Expired"]
+
+# VNPAY vnp_TransactionStatus values that settle a payment either way
+VNPAY_FINAL_STATUSES = {"00", "02"}
+# MoMo resultCodes that mean the customer did not (and will not) pay
+MOMO_FINAL_FAILURES = {1001, 1002, 1003, 1004, 1005, 1006, 1007, 1017, 1026, 2019, 4001, 4010, 4011, 4015, 4100}
+
+Outcome = tuple[str, dict[str, Any], Any]  # (outcome, fields to $set, gateway transaction id)
+
+
+def ensure_reconciliation_indexes(db) -> None:
+    try:
+        db.orders.create_index(
+            [("payment.status", 1), ("payment.method", 1), ("createdAt", 1)],
+            name="pending_payments",
+            partialFilterExpression={"payment.status": "Pending"},
+        )
+        db.orders.create_index(
+            [("payment.status", 1), ("payment.method", 1), ("reservation.releasedAt", 1)],
+            name="expired_payments",
+            partialFilterExpression={"payment.status": "Expired"},
+        )
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure payment reconciliation index: {exc}")
+
+
+class _RateLimiter:
+    """Space calls at least ``1 / rate`` seconds apart, across threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _vnpay_transaction_date(order: dict[str, Any]) -> str:
+    payment = order.get("payment") or {}
+    if payment.get("vnpCreateDate"):
+        return payment["vnpCreateDate"]
+    # Orders paid before vnpCreateDate was stored: creation time is the best guess.
+    return ((order.get("createdAt") or datetime.utcnow()) + timedelta(hours=7)).strftime("%Y%m%d%H%M%S")
+
+
+def _query_vnpay(order: dict[str, Any]) -> Outcome | None:
+    result = query_transaction(str(order["_id"]), _vnpay_transaction_date(order))
+    if result.get("vnp_ResponseCode") != "00" or result.get("vnp_TransactionStatus") not in VNPAY_FINAL_STATUSES:
+        return None  # unknown to VNPAY, still open, or needs a human (reversal, fraud check)
+    outcome, fields = vnpay_outcome(order, result)
+    return outcome, fields, result.get("vnp_TransactionNo")
+
+
+def _query_momo(order: dict[str, Any]) -> Outcome | None:
+    result = query_momo_payment(str(order["_id"]))
+    try:
+        result_code = int(result.get("resultCode", -1))
+    except (TypeError, ValueError):
+        return None
+    if result_code != 0 and result_code not in MOMO_FINAL_FAILURES:
+        return None  # initiated, processing, authorised only, or a request error
+    outcome, fields = momo_outcome(order, result)
+    return outcome, fields, result.get("transId")
+
+
+QUERIES: dict[str, Callable[[dict[str, Any]], Outcome | None]] = {
+    "VNPAY": _query_vnpay,
+    "MOMO": _query_momo,
+}
+
+
+def _expired(order: dict[str, Any]) -> bool:
+    return (order.get("payment") or {}).get("status") == "Expired"
+
+
+def _candidates(db, now: datetime, limit: int) -> list[dict[str, Any]]:
+    return list(
+        db.orders.find(
+            {
+                "$or": [
+                    {
+                        "payment.status": "Pending",
+                        "createdAt": {"$lte": now - timedelta(minutes=Config.PAYMENT_RECONCILE_AFTER_MINUTES)},
+                    },
+                    {
+                        "payment.status": "Expired",
+                        "reservation.releasedAt": {"$gte": now - timedelta(hours=Config.PAYMENT_RECONCILE_EXPIRED_HOURS)},
+                    },
+                ],
+                "payment.method": {"$in": list(GATEWAYS)},
+                "payment.reconciledAt": {"$not": {"$gt": now - timedelta(minutes=Config.PAYMENT_RECONCILE_RECHECK_MINUTES)}},
+            }
+        )
+        .sort("createdAt", 1)
+        .limit(limit)
+    )
+
+
+def _apply(db, checked: list[tuple[dict[str, Any], Outcome | None]], now: datetime) -> list[tuple[dict[str, Any], Outcome]]:
+    """Write every answer in one bulk write; return the orders that transitioned."""
+
+    batch = uuid.uuid4().hex
+    ops = []
+    for order, result in checked:
+        if result is None:
+            ops.append(
+                UpdateOne(
+                    {"_id": order["_id"], "payment.status": {"$in": RECONCILED_STATUSES}},
+                    {"$set": {"payment.reconciledAt": now}, "$inc": {"payment.reconcileChecks": 1}},
+                )
+            )
+            continue
+        outcome, fields, _ = result
+        ops.append(
+            UpdateOne(
+                {"_id": order["_id"], **TRANSITION_FROM[outcome]},
+                with_status_keys(
+                    {"$set": {**fields, "updatedAt": now, "payment.reconciledAt": now, "payment.reconcileBatch": batch}}
+                ),
+            )
+        )
+    settled = {order["_id"]: (order, result) for order, result in checked if result is not None}
+
+    def _write(session):
+        db.orders.bulk_write(ops, ordered=False, session=session)
+        if not settled:
+            return []
+        updated = list(
+            db.orders.find({"_id": {"$in": list(settled)}, "payment.reconcileBatch": batch}, session=session)
+        )
+        record_events(
+            db,
+            [build_event(doc, ORDER_UPDATED, previous=settled[doc["_id"]][0], reason="payment_reconciled") for doc in updated],
+            session=session,
+        )
+        return [settled[doc["_id"]] for doc in updated]
+
+    transitioned = run_in_transaction(db, _write)
+    notify_orders(order["_id"] for order, _ in transitioned)
+    return transitioned
+
+
+def reconcile_pending_payments(db, batch_size: int = 200, now: datetime | None = None) -> dict[str, int]:
+    """Query the gateways about stale pending or recently expired payments and apply final answers; return counters."""
+
+    now = now or datetime.utcnow()
+    orders = _candidates(db, now, batch_size)
+    stats = {"checked": 0, "paid": 0, "failed": 0, "pending": 0, "errors": 0}
+    if not orders:
+        return stats
+
+    limiters = {gateway: _RateLimiter(Config.PAYMENT_RECONCILE_RATE_PER_SECOND) for gateway in GATEWAYS}
+
+    def _check(order: dict[str, Any]) -> tuple[dict[str, Any], Outcome | None] | None:
+        gateway = str((order.get("payment") or {}).get("method") or "").upper()
+        limiters[gateway].wait()
+        try:
+            return order, QUERIES[gateway](order)
+        except Exception as exc:
+            print(f"Warning: {gateway} status query failed for order {order['_id']}: {exc}")
+            return None  # retried on the next run
+
+    with ThreadPoolExecutor(max_workers=Config.PAYMENT_RECONCILE_CONCURRENCY, thread_name_prefix="payment-reconcile") as pool:
+        answers = list(pool.map(_check, orders))
+    checked = [answer for answer in answers if answer is not None]
+    # Only a payment can still change an expired order; anything else is just stamped
+    checked = [(order, None if result and result[0] != PAID and _expired(order) else result) for order, result in checked]
+    stats["errors"] = len(answers) - len(checked)
+    stats["checked"] = len(checked)
+    stats["pending"] = sum(1 for _, result in checked if result is None)
+    if not checked:
+        return stats
+
+    for order, (outcome, _, transaction_id) in _apply(db, checked, now):
+        if outcome == PAID:
+            commit_reservation(db, order["_id"])
+            stats["paid"] += 1
+        else:
+            release_reservation(db, order["_id"], "payment_failed")
+            stats["failed"] += 1
+        gateway = str(order["payment"]["method"]).lower()
+        remember_callback(db, gateway, callback_key(transaction_id, None), order, outcome, applied=True, source="reconciliation")
+    return stats
+
+
+__all__ = [
+    "QUERIES",
+    "ensure_reconciliation_indexes",
+    "reconcile_pending_payments",
+]
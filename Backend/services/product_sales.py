@@ -0,0 +1,199 @@
+"""Best-seller view: per-product sales materialised in ``product_sales``.
+
+One document per product that has ever sold in a paid status::
+
+    {"_id": "<productId>", "totalSold": 42, "revenue": 310.5,
+     "sold7d": 3, "revenue7d": 21.0, "sold30d": 11, "revenue30d": 80.0,
+     "refreshedAt": ...}
+
+``refresh_product_sales`` rebuilds it on a schedule with one grouped pass
+over the paid orders (``statusKey`` index) plus the archive item rollups, and
+upserts the result in place, so readers never see an empty collection. The 7/30-day
+windows slide with time, which an event-driven update could not express
+without a second decay job; a periodic refresh keeps both simple.
+
+``featured_products`` serves the homepage best sellers from it, behind a short
+in-process cache, instead of unwinding every paid order per page view.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import DESCENDING, UpdateOne
+
+from services.order_archive import archived_item_stats
+from services.status_keys import status_key_match, status_keys
+
+SALES_STATUSES = frozenset({"paid", "completed", "delivered", "payment success", "payment successful", "shipped"})
+
+FIELDS = ("totalSold", "revenue", "sold30d", "revenue30d", "sold7d", "revenue7d")
+
+# ?window= values accepted by featured_products -> sort field
+WINDOWS = {"all": "totalSold", "30d": "sold30d", "7d": "sold7d"}
+
+
+def ensure_product_sales_indexes(db) -> None:
+    try:
+        for field in WINDOWS.values():
+            db.product_sales.create_index([(field, DESCENDING), ("_id", 1)])
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure product_sales indexes: {exc}")
+
+
+def _number(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) else 0.0
+
+
+def _since(field: str, start: datetime) -> dict[str, Any]:
+    return {"$gte": [f"${field}", start]}
+
+
+def _windowed_sum(value: Any, in_window: dict[str, Any]) -> dict[str, Any]:
+    return {"$sum": {"$cond": [in_window, value, 0]}}
+
+
+def refresh_product_sales(db, statuses: Iterable[str] = SALES_STATUSES, now: datetime | None = None) -> int:
+    """Recompute ``product_sales`` from paid hot orders and archive rollups; return the number of products."""
+
+    now = now or datetime.utcnow()
+    since_7d, since_30d = now - timedelta(days=7), now - timedelta(days=30)
+    statuses = list(statuses)
+    quantity = {"$cond": [{"$isNumber": "$items.quantity"}, "$items.quantity", 0]}
+    revenue = {
+        "$cond": [
+            {"$isNumber": "$items.subtotal"},
+            "$items.subtotal",
+            {"$multiply": [{"$cond": [{"$isNumber": "$items.price"}, "$items.price", 0]}, quantity]},
+        ]
+    }
+    rows = db.orders.aggregate(
+        [
+            {"$match": status_key_match(db, status_keys(statuses))},
+            {"$project": {"createdAt": 1, "items.productId": 1, "items.quantity": 1, "items.price": 1, "items.subtotal": 1}},
+            {"$unwind": "$items"},
+            {"$match": {"items.productId": {"$ne": None}}},
+            {"$group": {
+                "_id": "$items.productId",
+                "totalSold": {"$sum": quantity},
+                "revenue": {"$sum": revenue},
+                "sold7d": _windowed_sum(quantity, _since("createdAt", since_7d)),
+                "revenue7d": _windowed_sum(revenue, _since("createdAt", since_7d)),
+                "sold30d": _windowed_sum(quantity, _since("createdAt", since_30d)),
+                "revenue30d": _windowed_sum(revenue, _since("createdAt", since_30d)),
+            }},
+        ]
+    )
+    windows = ((None, "totalSold", "revenue"), (since_30d, "sold30d", "revenue30d"), (since_7d, "sold7d", "revenue7d"))
+    sales: dict[str, dict[str, float]] = {}
+
+    def _entry(product_id: Any) -> dict[str, float]:
+        return sales.setdefault(str(product_id), dict.fromkeys(FIELDS, 0.0))
+
+    for row in rows:
+        entry = _entry(row["_id"])
+        for _, sold_field, revenue_field in windows:
+            entry[sold_field] += _number(row.get(sold_field))
+            entry[revenue_field] += _number(row.get(revenue_field))
+    # Archived orders are normally older than both windows, unless the archive cutoff is shorter
+    for since, sold_field, revenue_field in windows:
+        for product_id, stats in archived_item_stats(db, statuses, since).items():
+            entry = _entry(product_id)
+            entry[sold_field] += _number(stats.get("quantity"))
+            entry[revenue_field] += _number(stats.get("revenue"))
+
+    refreshed_at = datetime.utcnow()
+    ops = [
+        UpdateOne({"_id": product_id}, {"$set": {**stats, "refreshedAt": refreshed_at}}, upsert=True)
+        for product_id, stats in sales.items()
+    ]
+    if ops:
+        db.product_sales.bulk_write(ops, ordered=False)
+    # By id rather than by refreshedAt, so an overlapping refresh elsewhere cannot empty the view
+    db.product_sales.delete_many({"_id": {"$nin": list(sales)}})
+    return len(ops)
+
+
+class _FeaturedCache:
+    """Tiny TTL cache for the rendered featured list, keyed by (limit, window)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, tuple[float, list[dict[str, Any]]]] = {}
+
+    def get(self, key: tuple, ttl: float) -> list[dict[str, Any]] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < ttl:
+            return entry[1]
+        return None
+
+    def put(self, key: tuple, value: list[dict[str, Any]]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+
+
+_featured_cache = _FeaturedCache()
+
+
+def _object_id(value: str) -> ObjectId | None:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+def featured_products(db, limit: int, window: str = "all", ttl: float = 0) -> list[dict[str, Any]]:
+    """Top ``limit`` existing products by units sold in ``window`` (``all``, ``30d`` or ``7d``)."""
+
+    key = (limit, window)
+    cached = _featured_cache.get(key, ttl) if ttl > 0 else None
+    if cached is not None:
+        return cached
+
+    sort_field = WINDOWS[window]
+    featured: list[dict[str, Any]] = []
+    skip = 0
+    # Deleted products keep their sales rows; read past them
+    while len(featured) < limit:
+        batch = list(
+            db.product_sales.find({sort_field: {"$gt": 0}}, {sort_field: 1})
+            .sort([(sort_field, DESCENDING), ("_id", 1)])
+            .skip(skip)
+            .limit(limit)
+        )
+        if not batch:
+            break
+        skip += len(batch)
+        object_ids = [oid for oid in (_object_id(row["_id"]) for row in batch) if oid is not None]
+        products = {str(doc["_id"]): doc for doc in db.products.find({"_id": {"$in": object_ids}})}
+        for row in batch:
+            product = products.get(row["_id"])
+            if not product:
+                continue
+            featured.append({
+                "_id": row["_id"],
+                "name": product.get("name"),
+                "price": product.get("price"),
+                "imageUrl": product.get("image") or (product.get("images") or [None])[0],
+                "totalSold": int(row.get(sort_field) or 0),
+            })
+            if len(featured) == limit:
+                break
+
+    if ttl > 0:
+        _featured_cache.put(key, featured)
+    return featured
+
+
+__all__ = [
+    "SALES_STATUSES",
+    "WINDOWS",
+    "ensure_product_sales_indexes",
+    "featured_products",
+    "refresh_product_sales",
+]
@@ -0,0 +1,406 @@
+"""Stock reservations for orders paid through an external gateway.
+
+Stock is taken when the order is created. For VNPAY/MoMo orders the order
+document carries a ``reservation`` block with an expiry; a successful payment
+commits it, while a failed payment, a cancellation or the expiry sweeper
+releases it and puts the units back on the shelf. COD orders are committed
+immediately but are still restocked when cancelled.
+
+Reservation states: ``active`` -> ``committed`` | ``releasing`` -> ``released``
+(-> ``committed`` | ``short`` for a late payment).
+Every transition is a conditional update, so concurrent callers (return URL
+plus IPN, several sweepers) can never restock the same order twice. A
+release is claimed (``releasing``, with a per-release number) before any
+stock moves; each product's ``$inc`` is tagged with that release's token in
+the same atomic update, so when a process dies mid-release the sweeper picks
+the stale claim up again and only restocks the lines that were not done.
+
+A payment that succeeds while a release is running cannot take the stock
+yet; it leaves ``commitRequested`` on the reservation, and whoever finishes
+the release takes the units back right after (the sweeper catches requests
+left by a process that died in between). Units are only taken back while
+they are still in stock; when another order got them first, the reservation
+ends ``short`` and the order is flagged ``payment.refundRequired`` instead
+of overselling. The expiry only cancels an order
+whose payment is still pending when the release is recorded.
+"""
+from __future__ import annotations
+
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne
+
+from config import Config
+from services.inventory_ledger import RESERVATION_RELEASE, RESERVATION_RETAKE, movement, record_movements
+from services.order_watch import notify_orders
+from services.outbox import ORDER_UPDATED, build_event, record_events
+from services.status_keys import with_status_keys
+from services.transactions import run_in_transaction
+
+GATEWAY_METHODS = {"VNPAY", "MOMO"}
+PENDING_PAYMENT_STATUSES = [None, "Pending", "pending", "PENDING"]
+STALE_RELEASE_AFTER = timedelta(minutes=5)
+# Release tokens on products whose restock already happened (removed once the release is recorded)
+RESTOCK_TOKENS = "reservationReleases"
+
+
+def ensure_reservation_indexes(db) -> None:
+    try:
+        db.orders.create_index(
+            [("reservation.expiresAt", 1)],
+            name="reservation_expiry",
+            partialFilterExpression={"reservation.status": "active"},
+        )
+        db.orders.create_index(
+            [("reservation.claimedAt", 1)],
+            name="reservation_releasing",
+            partialFilterExpression={"reservation.status": "releasing"},
+        )
+        db.orders.create_index(
+            [("reservation.releasedAt", 1)],
+            name="reservation_commit_requested",
+            partialFilterExpression={"reservation.commitRequested": True},
+        )
+        db.orders.create_index(
+            [("updatedAt", 1)],
+            name="payment_refund_required",
+            partialFilterExpression={"payment.refundRequired": True},
+        )
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure reservation indexes on orders: {exc}")
+
+
+def new_reservation(payment_method: str, now: datetime | None = None) -> dict[str, Any]:
+    """Build the ``reservation`` block stored on a freshly created order."""
+
+    now = now or datetime.utcnow()
+    if str(payment_method or "").upper() in GATEWAY_METHODS:
+        return {
+            "status": "active",
+            "createdAt": now,
+            "expiresAt": now + timedelta(minutes=Config.STOCK_RESERVATION_TTL_MINUTES),
+        }
+    return {"status": "committed", "createdAt": now, "committedAt": now}
+
+
+def _stock_deltas(orders: Iterable[dict[str, Any]]) -> dict[Any, int]:
+    totals: dict[Any, int] = defaultdict(int)
+    for order in orders:
+        for item in order.get("items") or []:
+            try:
+                product_id = ObjectId(item.get("productId"))
+                quantity = int(item.get("quantity") or 0)
+            except (InvalidId, TypeError, ValueError):
+                continue
+            if quantity > 0:
+                totals[product_id] += quantity
+    return totals
+
+
+def _retake_stock(db, order: dict[str, Any]) -> list[dict[str, Any]]:
+    """Take a paid order's units again; return the lines that are no longer in stock.
+
+    Each line only takes units that are still on the shelf. If one cannot be
+    served, the lines already taken are put back and nothing is moved, so a
+    late payment never oversells.
+    """
+
+    taken = []
+    short = []
+    for product_id, quantity in _stock_deltas([order]).items():
+        result = db.products.update_one(
+            {"_id": product_id, "stock": {"$gte": quantity}}, {"$inc": {"stock": -quantity}}
+        )
+        if result.modified_count:
+            taken.append((product_id, quantity))
+        else:
+            short.append({"productId": product_id, "quantity": quantity})
+    if short:
+        if taken:
+            db.products.bulk_write(
+                [UpdateOne({"_id": product_id}, {"$inc": {"stock": quantity}}) for product_id, quantity in taken],
+                ordered=False,
+            )
+        return short
+    record_movements(
+        db,
+        [movement(product_id, -quantity, RESERVATION_RETAKE, orderId=order.get("orderId")) for product_id, quantity in taken],
+    )
+    return []
+
+
+def _release_token(order: dict[str, Any]) -> str:
+    return f"{order['_id']}:{(order.get('reservation') or {}).get('releases', 0)}"
+
+
+def _restock(db, orders: list[dict[str, Any]]) -> None:
+    """Give back the units of claimed releases, skipping lines a crashed attempt already restocked."""
+
+    lines = [
+        (product_id, quantity, _release_token(order), order)
+        for order in orders
+        for product_id, quantity in _stock_deltas([order]).items()
+    ]
+    if not lines:
+        return
+    tokens = sorted({token for _, _, token, _ in lines})
+    done = {
+        (doc["_id"], token)
+        for doc in db.products.find(
+            {"_id": {"$in": list({product_id for product_id, *_ in lines})}, RESTOCK_TOKENS: {"$in": tokens}},
+            {RESTOCK_TOKENS: 1},
+        )
+        for token in doc.get(RESTOCK_TOKENS) or []
+    }
+    pending = [line for line in lines if (line[0], line[2]) not in done]
+    if not pending:
+        return
+    db.products.bulk_write(
+        [
+            UpdateOne(
+                {"_id": product_id, RESTOCK_TOKENS: {"$ne": token}},
+                {"$inc": {"stock": quantity}, "$push": {RESTOCK_TOKENS: token}},
+            )
+            for product_id, quantity, token, _ in pending
+        ],
+        ordered=False,
+    )
+    record_movements(
+        db,
+        [
+            movement(product_id, quantity, RESERVATION_RELEASE, orderId=order.get("orderId"))
+            for product_id, quantity, _, order in pending
+        ],
+    )
+
+
+def _clear_restock_tokens(db, orders: list[dict[str, Any]]) -> None:
+    product_ids = list({product_id for order in orders for product_id in _stock_deltas([order])})
+    if product_ids:
+        db.products.update_many(
+            {"_id": {"$in": product_ids}},
+            {"$pull": {RESTOCK_TOKENS: {"$in": [_release_token(order) for order in orders]}}},
+        )
+
+
+def _releasing(order: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "_id": order["_id"],
+        "reservation.status": "releasing",
+        "reservation.releases": (order.get("reservation") or {}).get("releases"),
+    }
+
+
+def _mark_released(db, orders: list[dict[str, Any]], fields: dict[str, Any] | None = None, session=None) -> None:
+    if not orders:
+        return
+    now = datetime.utcnow()
+    db.orders.bulk_write(
+        [
+            UpdateOne(
+                _releasing(order),
+                with_status_keys({"$set": {"reservation.status": "released", "reservation.releasedAt": now, **(fields or {})}}),
+            )
+            for order in orders
+        ],
+        ordered=False,
+        session=session,
+    )
+
+
+def _finish_commits(db, order_ids: list[Any] | None = None) -> None:
+    """Take the stock back for orders paid while their release was running."""
+
+    query: dict[str, Any] = {"reservation.status": "released", "reservation.commitRequested": True}
+    if order_ids is not None:
+        query["_id"] = {"$in": order_ids}
+    for doc in db.orders.find(query, {"_id": 1}):
+        commit_reservation(db, doc["_id"])
+
+
+def commit_reservation(db, order_id: ObjectId) -> bool:
+    """Make the order's stock permanent after a successful payment.
+
+    If the reservation had already been released (the payment landed after
+    expiry or after a failed attempt), the units are taken again; while a
+    release is still running, the releaser does that once it has finished.
+    """
+
+    now = datetime.utcnow()
+    committed = db.orders.update_one(
+        {"_id": order_id, "reservation.status": "active"},
+        {"$set": {"reservation.status": "committed", "reservation.committedAt": now}},
+    )
+    if committed.modified_count:
+        return True
+
+    requested = db.orders.update_one(
+        {"_id": order_id, "reservation.status": "releasing"}, {"$set": {"reservation.commitRequested": True}}
+    )
+    if requested.matched_count:
+        return True
+
+    retaken = db.orders.find_one_and_update(
+        {"_id": order_id, "reservation.status": "released"},
+        {
+            "$set": {"reservation.status": "committed", "reservation.committedAt": now, "reservation.retakenAt": now},
+            "$unset": {"reservation.commitRequested": ""},
+        },
+        projection={"items": 1, "orderId": 1},
+    )
+    if not retaken:
+        return False
+    short = _retake_stock(db, retaken)
+    if not short:
+        return True
+    # Paid, but the units were sold again meanwhile: refund or fulfil by hand.
+    db.orders.update_one(
+        {"_id": order_id, "reservation.status": "committed"},
+        {
+            "$set": {"reservation.status": "short", "reservation.shortItems": short, "payment.refundRequired": True},
+            "$unset": {"reservation.committedAt": "", "reservation.retakenAt": ""},
+        },
+    )
+    print(f"Warning: order {order_id} was paid after its stock was sold again; flagged for refund")
+    return False
+
+
+def release_reservation(db, order_id: ObjectId, reason: str) -> bool:
+    """Return the order's units to stock once; legacy orders without a block are included."""
+
+    order = db.orders.find_one_and_update(
+        {"_id": order_id, "reservation.status": {"$nin": ["releasing", "released", "short"]}},
+        {
+            "$set": {"reservation.status": "releasing", "reservation.claimedAt": datetime.utcnow(), "reservation.reason": reason},
+            "$inc": {"reservation.releases": 1},
+        },
+        projection={"items": 1, "orderId": 1, "reservation": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not order:
+        return False
+    # A crash from here on leaves a stale ``releasing`` claim for the sweeper to finish.
+    _restock(db, [order])
+    _mark_released(db, [order])
+    _clear_restock_tokens(db, [order])
+    _finish_commits(db, [order["_id"]])
+    return True
+
+
+def release_expired_reservations(db, batch_size: int = 200, now: datetime | None = None) -> int:
+    """Release every active reservation past its expiry; return the number of orders released.
+
+    Also finishes releases whose process died after claiming them (stale
+    ``releasing``) and stock retakes requested during a release.
+    """
+
+    now = now or datetime.utcnow()
+    stale_before = now - STALE_RELEASE_AFTER
+    released = 0
+    # Payments whose releaser died before taking the stock back
+    _finish_commits(db)
+    while True:
+        # Two queries so each is served by its own partial index.
+        expired = [
+            doc["_id"]
+            for doc in db.orders.find(
+                {"reservation.status": "active", "reservation.expiresAt": {"$lte": now}}, {"_id": 1}
+            ).limit(batch_size)
+        ]
+        stale = [
+            doc["_id"]
+            for doc in db.orders.find(
+                {"reservation.status": "releasing", "reservation.claimedAt": {"$lte": stale_before}}, {"_id": 1}
+            ).limit(batch_size)
+        ]
+        if not expired and not stale:
+            return released
+
+        sweep_id = uuid.uuid4().hex
+        claimed_at = datetime.utcnow()
+        if expired:
+            db.orders.update_many(
+                {"_id": {"$in": expired}, "reservation.status": "active"},
+                {
+                    "$set": {
+                        "reservation.status": "releasing",
+                        "reservation.reason": "expired",
+                        "reservation.sweepId": sweep_id,
+                        "reservation.claimedAt": claimed_at,
+                    },
+                    "$inc": {"reservation.releases": 1},
+                },
+            )
+        if stale:
+            # Same release number, so lines the dead process already restocked are skipped.
+            db.orders.update_many(
+                {"_id": {"$in": stale}, "reservation.status": "releasing", "reservation.claimedAt": {"$lte": stale_before}},
+                {"$set": {"reservation.sweepId": sweep_id, "reservation.claimedAt": claimed_at}},
+            )
+        claimed = list(
+            db.orders.find(
+                {"reservation.sweepId": sweep_id, "reservation.status": "releasing"},
+                {"items": 1, "orderId": 1, "userId": 1, "status": 1, "payment": 1, "total": 1, "createdAt": 1, "reservation": 1},
+            )
+        )
+        if claimed:
+            _restock(db, claimed)
+            # Claims left by release_reservation already had their order status set by the caller.
+            expiring = [order for order in claimed if order["reservation"].get("reason") in (None, "expired")]
+
+            def _finish(session):
+                finished_at = datetime.utcnow()
+                cancelled = []
+                for order in expiring:
+                    # Only while the payment is still pending: one paid meanwhile keeps its order
+                    if db.orders.find_one_and_update(
+                        {**_releasing(order), "payment.status": {"$in": PENDING_PAYMENT_STATUSES}},
+                        with_status_keys({"$set": {
+                            "reservation.status": "released",
+                            "reservation.releasedAt": finished_at,
+                            "status": "Cancelled",
+                            "payment.status": "Expired",
+                            "updatedAt": finished_at,
+                        }}),
+                        projection={"_id": 1},
+                        session=session,
+                    ):
+                        cancelled.append(order)
+                record_events(
+                    db,
+                    [
+                        build_event(
+                            {**order, "status": "Cancelled", "payment": {**(order.get("payment") or {}), "status": "Expired"}},
+                            ORDER_UPDATED,
+                            previous=order,
+                            reason="reservation_expired",
+                        )
+                        for order in cancelled
+                    ],
+                    session=session,
+                )
+                # Releases of orders that are not being cancelled (already marked ones no longer match)
+                _mark_released(db, claimed, session=session)
+
+            run_in_transaction(db, _finish)
+            _clear_restock_tokens(db, claimed)
+            _finish_commits(db, [order["_id"] for order in claimed])
+            notify_orders(order["_id"] for order in claimed)
+            released += len(claimed)
+        if len(expired) < batch_size and len(stale) < batch_size:
+            return released
+
+
+__all__ = [
+    "PENDING_PAYMENT_STATUSES",
+    "commit_reservation",
+    "ensure_reservation_indexes",
+    "new_reservation",
+    "release_expired_reservations",
+    "release_reservation",
+]
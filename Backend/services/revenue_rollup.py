@@ -0,0 +1,228 @@
+"""Daily revenue rollups maintained from the order outbox.
+
+``revenue_daily`` holds one small document per order-creation day (UTC, the
+same bucketing as ``$dateToString``) for the orders currently in a revenue
+status::
+
+    {"_id": "2026-10-19", "orders": 12, "revenue": 310.5,
+     "byStatus": {"delivered": {"orders": 9, "revenue": 250.0}, ...},
+     "byMethod": {"vnpay": {"orders": 4, "revenue": 120.0}, ...}}
+
+``apply_revenue_daily`` is an outbox consumer (``revenue-daily``): an order
+entering a revenue status adds to its creation day, leaving one (or being
+deleted) subtracts.
+Dashboards that count a narrower set of statuses sum ``byStatus``, so a
+revenue chart reads one document per day of the range no matter how many
+orders there are. Archived orders keep their contribution (archiving does not
+emit events); ``rebuild_revenue_daily`` recomputes everything from ``orders``
+plus the archive rollups. The consumer runs that rebuild itself the first
+time it starts, and ``revenue_series`` aggregates the orders directly until
+it has, so a fresh deployment never shows an empty chart.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+from bson.decimal128 import Decimal128
+
+from services.outbox import CONSUMERS, ORDER_CREATED, ORDER_DELETED, ORDER_UPDATED, consumer_ready, fold_increments
+
+CONSUMER_NAME = "revenue-daily"
+
+# Union of the statuses the dashboards count as revenue (lower-cased)
+REVENUE_STATUSES = frozenset(
+    {"confirmed", "delivered", "paid", "completed", "shipped", "payment success", "payment successful"}
+)
+
+
+def _key(value: Any, default: str = "unknown") -> str:
+    # Keys become field names: no dots or leading dollars
+    text = str(value or "").strip().lower().replace(".", "_").replace("$", "_")
+    return text or default
+
+
+def _day(value: Any) -> str | None:
+    return value.strftime("%Y-%m-%d") if isinstance(value, datetime) else None
+
+
+def _number(value: Any) -> float:
+    # As the admin dashboard reads totals: Decimal128 and numeric strings count too
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# The same conversion inside an aggregation, for the rebuild
+_TOTAL = {"$convert": {"input": "$total", "to": "double", "onError": 0, "onNull": 0}}
+
+
+def _inc_doc(cells: dict[tuple[str, str], list[float]]) -> dict[str, float]:
+    inc: dict[str, float] = defaultdict(int)
+    for (status, method), (count, revenue) in cells.items():
+        for field in ("", f"byStatus.{status}.", f"byMethod.{method}."):
+            inc[f"{field}orders"] += count
+            inc[f"{field}revenue"] += revenue
+    return {field: value for field, value in inc.items() if value}
+
+
+def apply_revenue_daily(db, events: list[dict[str, Any]], session=None) -> None:
+    """Outbox handler: move orders in and out of their day's revenue buckets.
+
+    Each day document records the last event folded into it, so a replayed
+    batch only adds the events a day is missing.
+    """
+
+    increments: dict[str, list[tuple[int, dict[str, float]]]] = defaultdict(list)
+    for event in events:
+        day = _day(event.get("orderCreatedAt"))
+        if day is None:
+            continue
+        cells: dict[tuple[str, str], list[float]] = defaultdict(lambda: [0, 0.0])
+
+        def _add(status: str, method: str, sign: int, amount: float) -> None:
+            if status in REVENUE_STATUSES:
+                cell = cells[(status, method)]
+                cell[0] += sign
+                cell[1] += sign * amount
+
+        amount = _number(event.get("total"))
+        status = _key(event.get("status"), "pending")
+        method = _key(event.get("paymentMethod"))
+        if event.get("type") == ORDER_CREATED:
+            _add(status, method, 1, amount)
+        elif event.get("type") == ORDER_UPDATED:
+            previous_status = _key(event.get("previousStatus"), "pending")
+            previous_method = _key(event.get("previousPaymentMethod") or event.get("paymentMethod"))
+            if (previous_status, previous_method) == (status, method):
+                continue
+            _add(previous_status, previous_method, -1, amount)
+            _add(status, method, 1, amount)
+        elif event.get("type") == ORDER_DELETED:
+            _add(status, method, -1, amount)
+        inc = _inc_doc(cells)
+        if inc:
+            increments[day].append((event["seq"], inc))
+    fold_increments(db.revenue_daily, increments, session=session)
+
+
+def _daily_docs(db, since: str | None = None, until: str | None = None, session=None) -> list[dict[str, Any]]:
+    """``revenue_daily``-shaped documents computed from ``orders`` and the archive rollups.
+
+    ``since`` / ``until`` are inclusive ``YYYY-MM-DD`` bounds.
+    """
+
+    days: dict[str, dict[tuple[str, str], list[float]]] = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+    created: dict[str, Any] = {"$type": "date"}
+    day_range: dict[str, str] = {}
+    if since is not None:
+        created["$gte"] = datetime.strptime(since, "%Y-%m-%d")
+        day_range["$gte"] = since
+    if until is not None:
+        created["$lt"] = datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)
+        day_range["$lte"] = until
+    hot = db.orders.aggregate(
+        [
+            {"$match": {"createdAt": created}},
+            {"$group": {
+                "_id": {
+                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}},
+                    "status": {"$toLower": {"$ifNull": ["$status", "pending"]}},
+                    "method": {"$toLower": {"$ifNull": ["$payment.method", ""]}},
+                },
+                "count": {"$sum": 1},
+                "revenue": {"$sum": _TOTAL},
+            }},
+        ],
+        session=session,
+    )
+    rows = [{**row["_id"], "count": row["count"], "revenue": row["revenue"]} for row in hot]
+    archived: dict[str, Any] = {"status": {"$in": list(REVENUE_STATUSES)}}
+    if day_range:
+        archived["day"] = day_range
+    rows += list(db.orders_archive_rollups.find(archived, session=session))
+    for row in rows:
+        status, method = _key(row.get("status"), "pending"), _key(row.get("method"))
+        if status not in REVENUE_STATUSES or row.get("day") in (None, "unknown"):
+            continue
+        cell = days[row["day"]][(status, method)]
+        cell[0] += row.get("count") or 0
+        cell[1] += _number(row.get("revenue"))
+
+    now = datetime.utcnow()
+    docs = []
+    for day, cells in sorted(days.items()):
+        doc: dict[str, Any] = {"_id": day, "orders": 0, "revenue": 0.0, "byStatus": {}, "byMethod": {}, "updatedAt": now}
+        for (status, method), (count, revenue) in cells.items():
+            doc["orders"] += count
+            doc["revenue"] += revenue
+            for group, key in (("byStatus", status), ("byMethod", method)):
+                entry = doc[group].setdefault(key, {"orders": 0, "revenue": 0.0})
+                entry["orders"] += count
+                entry["revenue"] += revenue
+        docs.append(doc)
+    return docs
+
+
+def rebuild_revenue_daily(db, session=None) -> int:
+    """Recompute ``revenue_daily`` from ``orders`` and ``orders_archive_rollups``; return the number of days.
+
+    ``session`` is only used for the reads (a snapshot when the outbox consumer rebuilds).
+    """
+
+    docs = _daily_docs(db, session=session)
+    db.revenue_daily.delete_many({})
+    if docs:
+        db.revenue_daily.insert_many(docs)
+    return len(docs)
+
+
+def _totals(doc: dict[str, Any], statuses: Iterable[str] | None) -> tuple[int, float]:
+    if statuses is None:
+        return int(doc.get("orders") or 0), _number(doc.get("revenue"))
+    by_status = doc.get("byStatus") or {}
+    entries = [by_status.get(_key(status)) or {} for status in statuses]
+    return int(sum(entry.get("orders") or 0 for entry in entries)), sum(_number(entry.get("revenue")) for entry in entries)
+
+
+def revenue_series(
+    db, since: datetime, until: datetime | None = None, statuses: Iterable[str] | None = None
+) -> list[dict[str, Any]]:
+    """Per-day ``{"date", "orders", "revenue", "byMethod"}`` from ``since`` (inclusive day).
+
+    ``statuses`` restricts the totals to those revenue statuses (``byMethod``
+    always covers all of them); days without revenue are omitted.
+    """
+
+    day_range: dict[str, str] = {"$gte": since.strftime("%Y-%m-%d")}
+    if until is not None:
+        day_range["$lte"] = until.strftime("%Y-%m-%d")
+    if consumer_ready(db, CONSUMER_NAME):
+        docs = db.revenue_daily.find({"_id": day_range}).sort("_id", 1)
+    else:
+        # The rollup has not been built yet (first start): aggregate the range from the orders
+        docs = _daily_docs(db, day_range["$gte"], day_range.get("$lte"))
+    statuses = list(statuses) if statuses is not None else None
+    series = []
+    for doc in docs:
+        orders, revenue = _totals(doc, statuses)
+        if orders or revenue:
+            series.append({"date": doc["_id"], "orders": orders, "revenue": revenue, "byMethod": doc.get("byMethod") or {}})
+    return series
+
+
+# flask outbox consume revenue-daily; rebuilt automatically on the consumer's first run
+CONSUMERS[CONSUMER_NAME] = (apply_revenue_daily, rebuild_revenue_daily)
+
+
+__all__ = [
+    "CONSUMER_NAME",
+    "REVENUE_STATUSES",
+    "apply_revenue_daily",
+    "rebuild_revenue_daily",
+    "revenue_series",
+]
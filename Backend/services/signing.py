@@ -0,0 +1,40 @@
+"""Keyed HMAC signing shared by the payment gateway integrations.
+
+``hmac.new(key, ...)`` hashes the padded secret into fresh inner/outer digest
+states on every call. ``hmac_hex`` keys an HMAC once per ``(secret, digest)``
+and copies that pre-keyed prototype for each message, which leaves only the
+message itself to hash. The prototypes are never updated, so copying them
+from several threads is safe.
+
+``signatures_match`` compares hex signatures in constant time and treats a
+missing or malformed received signature as a mismatch.
+"""
+from __future__ import annotations
+
+import hmac
+from functools import lru_cache
+from typing import Any
+
+
+@lru_cache(maxsize=16)
+def _prototype(key: str, digest: str) -> hmac.HMAC:
+    return hmac.new(key.encode("utf-8"), digestmod=digest)
+
+
+def hmac_hex(key: str, data: str, digest: str) -> str:
+    """Hexadecimal HMAC of ``data`` (UTF-8) under ``key``; ``digest`` is a hashlib name."""
+
+    mac = _prototype(key, digest).copy()
+    mac.update(data.encode("utf-8"))
+    return mac.hexdigest()
+
+
+def signatures_match(expected: str, received: Any) -> bool:
+    """Constant-time, case-insensitive comparison of two hex signatures."""
+
+    if not isinstance(received, str) or not received:
+        return False
+    return hmac.compare_digest(expected.lower().encode("ascii"), received.lower().encode("utf-8"))
+
+
+__all__ = ["hmac_hex", "signatures_match"]
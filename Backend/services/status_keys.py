@@ -0,0 +1,157 @@
+"""Normalised, indexed status keys stored next to the display statuses.
+
+Orders keep ``status`` and ``payment.status`` exactly as the checkout,
+payment and admin flows write them ("Paid", "Payment Successful",
+"DELIVERED", ...). Every writer also stores the trimmed, lower-cased form as
+``statusKey`` / ``paymentStatusKey``, so dashboards and filters match with
+plain equality or ``$in`` on the ``(statusKey, createdAt)`` and
+``(paymentStatusKey, createdAt)`` indexes instead of projecting ``$toLower``
+over the whole collection.
+
+Orders written before the fields existed are filled in by
+``backfill_status_keys``, which the background workers run at startup (and
+``flask orders backfill-status-keys`` runs by hand). It records its
+completion in ``migrations``; until then ``status_key_match`` and
+``status_key_group`` also match orders without a key on their ``status``.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Iterable
+
+from pymongo import UpdateOne
+
+STATUS_KEY = "statusKey"
+PAYMENT_STATUS_KEY = "paymentStatusKey"
+# migrations document written once every order carries its keys
+BACKFILL_MARKER = "status-keys"
+
+_backfilled = False
+
+
+def ensure_status_key_indexes(db) -> None:
+    try:
+        for collection in (db.orders, db.orders_archive):
+            collection.create_index([(STATUS_KEY, 1), ("createdAt", -1)])
+            collection.create_index([(PAYMENT_STATUS_KEY, 1), ("createdAt", -1)])
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure order status key indexes: {exc}")
+
+
+def status_key(value: Any, default: str = "pending") -> str:
+    return str(value or "").strip().lower() or default
+
+
+def status_keys(statuses: Iterable[str]) -> list[str]:
+    """Normalise a set of status names for an ``{"statusKey": {"$in": ...}}`` match."""
+
+    return sorted({status_key(status) for status in statuses})
+
+
+def order_status_keys(order: dict[str, Any]) -> dict[str, str]:
+    """Both keys for a whole order document (inserts and the backfill)."""
+
+    return {
+        STATUS_KEY: status_key(order.get("status")),
+        PAYMENT_STATUS_KEY: status_key((order.get("payment") or {}).get("status")),
+    }
+
+
+def with_status_keys(update: dict[str, Any]) -> dict[str, Any]:
+    """Return ``update`` with the keys for any status it ``$set``s added to that ``$set``."""
+
+    fields = update.get("$set")
+    if not fields:
+        return update
+    keys: dict[str, str] = {}
+    if "status" in fields:
+        keys[STATUS_KEY] = status_key(fields["status"])
+    if "payment.status" in fields:
+        keys[PAYMENT_STATUS_KEY] = status_key(fields["payment.status"])
+    elif isinstance(fields.get("payment"), dict):
+        keys[PAYMENT_STATUS_KEY] = status_key(fields["payment"].get("status"))
+    if not keys:
+        return update
+    return {**update, "$set": {**fields, **keys}}
+
+
+def status_keys_backfilled(db) -> bool:
+    """True once ``backfill_status_keys`` has completed (cached per process from then on)."""
+
+    global _backfilled
+    if not _backfilled:
+        _backfilled = db.migrations.find_one({"_id": BACKFILL_MARKER, "completedAt": {"$exists": True}}) is not None
+    return _backfilled
+
+
+def _computed_status_key() -> dict[str, Any]:
+    # ``status_key`` of ``status`` as an aggregation expression
+    key = {"$toLower": {"$trim": {"input": {"$toString": {"$ifNull": ["$status", ""]}}}}}
+    return {"$let": {"vars": {"key": key}, "in": {"$cond": [{"$eq": ["$$key", ""]}, "pending", "$$key"]}}}
+
+
+def status_key_match(db, keys: Iterable[str]) -> dict[str, Any]:
+    """Filter on ``statusKey``; before the backfill has completed, orders without one match on ``status``."""
+
+    keys = list(keys)
+    if status_keys_backfilled(db):
+        return {STATUS_KEY: {"$in": keys}}
+    # Still served by the statusKey index: a missing key is indexed as null
+    return {
+        STATUS_KEY: {"$in": keys + [None]},
+        "$expr": {"$in": [{"$ifNull": [f"${STATUS_KEY}", _computed_status_key()]}, keys]},
+    }
+
+
+def status_key_group(db) -> Any:
+    """``$group`` key for the status key, computed from ``status`` for orders not backfilled yet."""
+
+    if status_keys_backfilled(db):
+        return f"${STATUS_KEY}"
+    return {"$ifNull": [f"${STATUS_KEY}", _computed_status_key()]}
+
+
+def backfill_status_keys(db, batch_size: int = 500) -> int:
+    """Set the keys on hot and archived orders that lack them; return the number of orders updated."""
+
+    updated = 0
+    query = {"$or": [{STATUS_KEY: {"$exists": False}}, {PAYMENT_STATUS_KEY: {"$exists": False}}]}
+    for collection in (db.orders, db.orders_archive):
+        while True:
+            batch = list(collection.find(query, {"status": 1, "payment.status": 1}).limit(batch_size))
+            if not batch:
+                break
+            collection.bulk_write(
+                [UpdateOne({"_id": order["_id"]}, {"$set": order_status_keys(order)}) for order in batch],
+                ordered=False,
+            )
+            updated += len(batch)
+    db.migrations.update_one(
+        {"_id": BACKFILL_MARKER}, {"$set": {"completedAt": datetime.utcnow(), "updated": updated}}, upsert=True
+    )
+    return updated
+
+
+def ensure_status_keys(db, batch_size: int = 500) -> int:
+    """Startup job: run the backfill unless it has already completed; return the number of orders updated."""
+
+    if status_keys_backfilled(db):
+        return 0
+    return backfill_status_keys(db, batch_size=batch_size)
+
+
+__all__ = [
+    "BACKFILL_MARKER",
+    "PAYMENT_STATUS_KEY",
+    "STATUS_KEY",
+    "backfill_status_keys",
+    "ensure_status_key_indexes",
+    "ensure_status_keys",
+    "order_status_keys",
+    "status_key",
+    "status_key_group",
+    "status_key_match",
+    "status_keys",
+    "status_keys_backfilled",
+    "with_status_keys",
+]
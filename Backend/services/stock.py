@@ -0,0 +1,177 @@
+"""Stock bookkeeping for checkout.
+
+Stock is taken for a whole basket with a single ``bulk_write`` of conditional
+``$inc`` decrements. On a replica set / sharded cluster the decrements and the
+order insert run in one multi-document transaction, so a crash can never leave
+stock taken without an order. Standalone servers have no transactions, so we
+fall back to the same unordered ``bulk_write`` followed by a compensating
+rollback of the lines that matched when any line was short.
+
+Each successful checkout (and each rollback) appends its movements to the
+inventory ledger with one ``insert_many``, and the new order's ``order.created``
+outbox event -- inside the transaction when there is one.
+"""
+from __future__ import annotations
+
+import uuid
+from typing import Any, Iterable
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from services.inventory_ledger import ORDER, ROLLBACK, movement, record_movements
+from services.outbox import ORDER_CREATED, build_event, record_events
+from services.status_keys import order_status_keys
+from services.transactions import is_transactions_rejected, mark_transactions_unsupported, supports_transactions
+
+
+class InsufficientStockError(Exception):
+    """Raised when a product cannot cover the quantity requested for it."""
+
+    def __init__(self, product_name: str | None = None):
+        super().__init__(product_name or "product")
+        self.product_name = product_name
+
+
+def merge_requirements(requirements: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Collapse repeated products into one requirement so each is checked once."""
+
+    merged: dict[Any, dict[str, Any]] = {}
+    for requirement in requirements:
+        existing = merged.get(requirement["product_id"])
+        if existing:
+            existing["quantity"] += requirement["quantity"]
+        else:
+            merged[requirement["product_id"]] = dict(requirement)
+    return list(merged.values())
+
+
+def _decrement_ops(requirements: list[dict[str, Any]]) -> list[UpdateOne]:
+    return [
+        UpdateOne(
+            {"_id": requirement["product_id"], "stock": {"$gte": requirement["quantity"]}},
+            {"$inc": {"stock": -requirement["quantity"]}},
+        )
+        for requirement in requirements
+    ]
+
+
+def _movements(requirements: list[dict[str, Any]], sign: int, reason: str, order: dict[str, Any]) -> list[dict[str, Any]]:
+    return [
+        movement(requirement["product_id"], sign * requirement["quantity"], reason, orderId=order.get("orderId"))
+        for requirement in requirements
+    ]
+
+
+def restore_stock(db, requirements: list[dict[str, Any]], session=None, order: dict[str, Any] | None = None) -> None:
+    """Give back previously decremented quantities in one round trip."""
+
+    if not requirements:
+        return
+    db.products.bulk_write(
+        [
+            UpdateOne({"_id": requirement["product_id"]}, {"$inc": {"stock": requirement["quantity"]}})
+            for requirement in requirements
+        ],
+        ordered=False,
+        session=session,
+    )
+    record_movements(db, _movements(requirements, 1, ROLLBACK, order or {}), session=session)
+
+
+def _first_short_requirement(db, requirements: list[dict[str, Any]]) -> dict[str, Any]:
+    ids = [requirement["product_id"] for requirement in requirements]
+    stock_by_id = {
+        doc["_id"]: int(doc.get("stock") or 0)
+        for doc in db.products.find({"_id": {"$in": ids}}, {"stock": 1})
+    }
+    for requirement in requirements:
+        if stock_by_id.get(requirement["product_id"], 0) < requirement["quantity"]:
+            return requirement
+    return requirements[0]
+
+
+def _place_order_in_transaction(db, order: dict[str, Any], requirements: list[dict[str, Any]]):
+    def _callback(session):
+        result = db.products.bulk_write(_decrement_ops(requirements), ordered=False, session=session)
+        if result.modified_count != len(requirements):
+            raise InsufficientStockError()
+        inserted_id = db.orders.insert_one(order, session=session).inserted_id
+        record_movements(db, _movements(requirements, -1, ORDER, order), session=session)
+        record_events(db, [build_event(order, ORDER_CREATED)], session=session)
+        return inserted_id
+
+    try:
+        with db.client.start_session() as session:
+            return session.with_transaction(_callback)
+    except InsufficientStockError:
+        # The transaction was aborted, so current stock is the pre-checkout state.
+        raise InsufficientStockError(_first_short_requirement(db, requirements).get("name"))
+
+
+def _place_order_with_compensation(db, order: dict[str, Any], requirements: list[dict[str, Any]]):
+    # Every decrement is tagged with this checkout's token so that, when only
+    # some lines matched, a single read tells which ones to give back.
+    token = uuid.uuid4().hex
+    product_ids = [requirement["product_id"] for requirement in requirements]
+    decremented: list[dict[str, Any]] = []
+    try:
+        result = db.products.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": requirement["product_id"], "stock": {"$gte": requirement["quantity"]}},
+                    {"$inc": {"stock": -requirement["quantity"]}, "$addToSet": {"pendingCheckouts": token}},
+                )
+                for requirement in requirements
+            ],
+            ordered=False,
+        )
+        if result.modified_count != len(requirements):
+            matched = {doc["_id"] for doc in db.products.find({"_id": {"$in": product_ids}, "pendingCheckouts": token}, {"_id": 1})}
+            decremented = [requirement for requirement in requirements if requirement["product_id"] in matched]
+            short = next(requirement for requirement in requirements if requirement["product_id"] not in matched)
+            raise InsufficientStockError(short.get("name"))
+        decremented = requirements
+        inserted_id = db.orders.insert_one(order).inserted_id
+    except Exception:
+        if decremented:
+            # Keep the ledger honest about the partial decrement and its rollback.
+            record_movements(db, _movements(decremented, -1, ORDER, order))
+        restore_stock(db, decremented, order=order)
+        raise
+    finally:
+        db.products.update_many({"_id": {"$in": product_ids}}, {"$pull": {"pendingCheckouts": token}})
+        # Drop the emptied array; the size filter keeps markers another checkout added since
+        db.products.update_many(
+            {"_id": {"$in": product_ids}, "pendingCheckouts": {"$size": 0}}, {"$unset": {"pendingCheckouts": ""}}
+        )
+    record_movements(db, _movements(requirements, -1, ORDER, order))
+    record_events(db, [build_event(order, ORDER_CREATED)])
+    return inserted_id
+
+
+def place_order(db, order: dict[str, Any], requirements: list[dict[str, Any]]):
+    """Decrement stock for every requirement and insert ``order``; return the new ``_id``.
+
+    Raises ``InsufficientStockError`` (with nothing written) when any product is short.
+    """
+
+    order.update(order_status_keys(order))
+    requirements = merge_requirements(requirements)
+    if supports_transactions(db):
+        try:
+            return _place_order_in_transaction(db, order, requirements)
+        except OperationFailure as exc:
+            if not is_transactions_rejected(exc):
+                raise
+            mark_transactions_unsupported()
+    return _place_order_with_compensation(db, order, requirements)
+
+
+__all__ = [
+    "InsufficientStockError",
+    "merge_requirements",
+    "place_order",
+    "restore_stock",
+    "supports_transactions",
+]
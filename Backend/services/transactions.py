@@ -0,0 +1,59 @@
+"""Helpers for running a group of writes in one multi-document transaction.
+
+Transactions need a replica set or sharded cluster. On a standalone server the
+callback simply runs without a session, so callers must order their writes so
+that a crash between them is recoverable.
+"""
+from __future__ import annotations
+
+from typing import Any, Callable
+
+from pymongo.errors import OperationFailure
+
+_transactions_supported: bool | None = None
+
+
+def supports_transactions(db) -> bool:
+    """Return True when the connected deployment accepts multi-document transactions."""
+
+    global _transactions_supported
+    if _transactions_supported is None:
+        try:
+            hello = db.command("hello")
+            _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        except Exception:  # pragma: no cover - depends on server / driver
+            _transactions_supported = False
+    return _transactions_supported
+
+
+def mark_transactions_unsupported() -> None:
+    global _transactions_supported
+    _transactions_supported = False
+
+
+def is_transactions_rejected(exc: OperationFailure) -> bool:
+    """IllegalOperation: the server refused to start a transaction after all."""
+
+    return exc.code == 20
+
+
+def run_in_transaction(db, callback: Callable[[Any], Any]) -> Any:
+    """Call ``callback(session)`` inside a transaction, or ``callback(None)`` when unsupported."""
+
+    if supports_transactions(db):
+        try:
+            with db.client.start_session() as session:
+                return session.with_transaction(callback)
+        except OperationFailure as exc:
+            if not is_transactions_rejected(exc):
+                raise
+            mark_transactions_unsupported()
+    return callback(None)
+
+
+__all__ = [
+    "is_transactions_rejected",
+    "mark_transactions_unsupported",
+    "run_in_transaction",
+    "supports_transactions",
+]
@@ -0,0 +1,463 @@
+"""Local VNPAY and MoMo gateway simulator.
+
+Stands in for both sandboxes so checkout can be exercised end to end offline
+and load-tested in CI. It implements, signed with the same secrets as the
+real gateways (``Config.VNP_HASH_SECRET`` / ``Config.MOMO_SECRET_KEY``):
+
+* MoMo: the create API (returns a ``payUrl`` on this simulator), the payment
+  page (redirects to ``redirectUrl`` and sends the signed IPN to ``ipnUrl``)
+  and the query API;
+* VNPAY: the payment page ``vpcpay.html`` (verifies the URL signature and
+  redirects to ``vnp_ReturnUrl`` with a signed result; optionally also calls
+  ``--vnpay-ipn-url``) and the ``querydr`` API.
+
+Visiting a payment page means "the customer pays". The outcome is random
+(``--decline-rate``) unless forced with ``?outcome=paid|failed``. Behaviour
+is tunable at start-up or at runtime through ``PUT /_sim/config``:
+
+* ``latency_ms`` / ``jitter_ms``: added to every gateway API answer;
+* ``failure_rate``: share of API calls answered with HTTP 503;
+* ``decline_rate``: share of payments that fail;
+* ``callback_delay_ms``: delay before an IPN is sent;
+* ``duplicate_rate`` / ``drop_rate``: share of IPNs sent twice / never sent.
+
+Run from the ``Backend`` directory::
+
+    JWT_SECRET_KEY=dev python -m simulators.gateways --port 9080 --latency-ms 50 --duplicate-rate 0.1
+
+and point the API at it::
+
+    MOMO_ENDPOINT=http://127.0.0.1:9080/momo/v2/gateway/api/create
+    MOMO_QUERY_ENDPOINT=http://127.0.0.1:9080/momo/v2/gateway/api/query
+    VNP_PAY_URL=http://127.0.0.1:9080/vnpay/paymentv2/vpcpay.html
+    VNP_QUERY_URL=http://127.0.0.1:9080/vnpay/merchant_webapi/api/transaction
+
+What the gateway "knows" can also be set directly (e.g. to test
+reconciliation of a payment whose IPN was lost)::
+
+    curl -X PUT localhost:9080/_sim/transactions/vnpay/<order _id> \\
+         -H 'Content-Type: application/json' -d '{"status": "paid", "amount": 362500}'
+
+``benchmarks.payment_checkout`` drives full checkouts through it.
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any
+from urllib.parse import urlencode
+
+import requests
+from flask import Flask, jsonify, redirect, request
+
+from config import Config
+from momo_service import hmac_sha256, momo_canonical
+from services.signing import signatures_match
+from vnpay_utils import QUERY_RESPONSE_HASH_FIELDS, canonical_query, hmac_sha512
+
+MOMO_CREATE_PATH = "/momo/v2/gateway/api/create"
+MOMO_QUERY_PATH = "/momo/v2/gateway/api/query"
+MOMO_PAY_PATH = "/momo/pay/<order_id>"
+VNPAY_PAY_PATH = "/vnpay/paymentv2/vpcpay.html"
+VNPAY_QUERY_PATH = "/vnpay/merchant_webapi/api/transaction"
+
+# Gateway codes used for each simulated state
+VNPAY_TRANSACTION_STATUS = {"paid": "00", "failed": "02", "pending": "01"}
+VNPAY_RESPONSE_CODE = {"paid": "00", "failed": "24"}  # 24: customer cancelled
+MOMO_RESULT_CODE = {"paid": 0, "failed": 1006, "pending": 1000}  # 1006: customer declined
+
+
+class Behaviour:
+    """Tunable latency and fault injection."""
+
+    FIELDS = ("latency_ms", "jitter_ms", "failure_rate", "decline_rate", "callback_delay_ms", "duplicate_rate", "drop_rate")
+
+    def __init__(
+        self,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        failure_rate: float = 0.0,
+        decline_rate: float = 0.0,
+        callback_delay_ms: float = 0,
+        duplicate_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self.callback_delay_ms = callback_delay_ms
+        self.duplicate_rate = duplicate_rate
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def roll(self, rate: float) -> bool:
+        with self._lock:
+            return self._random.random() < rate
+
+    def api_delay(self) -> None:
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def update(self, values: dict[str, Any]) -> None:
+        for name in self.FIELDS:
+            if name in values:
+                setattr(self, name, float(values[name]))
+
+    def as_dict(self) -> dict[str, float]:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class TransactionStore:
+    """What the gateway knows, keyed by ``(gateway, order reference)``."""
+
+    def __init__(self):
+        self._data: dict[tuple[str, str], dict[str, Any]] = {}
+        self._ids = itertools.count(int(time.time()) % 10**6 * 10**4)
+        self._lock = threading.Lock()
+
+    def put(self, gateway: str, ref: str, status: str, amount: int, transaction_id: str | None = None, **extra: Any) -> dict[str, Any]:
+        with self._lock:
+            record = {
+                **self._data.get((gateway, ref), {}),
+                **extra,
+                "status": status,
+                "amount": int(amount),
+                "transactionId": transaction_id or str(next(self._ids)),
+                "payDate": (datetime.utcnow() + timedelta(hours=7)).strftime("%Y%m%d%H%M%S"),
+            }
+            self._data[(gateway, ref)] = record
+            return dict(record)
+
+    def get(self, gateway: str, ref: str) -> dict[str, Any] | None:
+        with self._lock:
+            record = self._data.get((gateway, ref))
+            return dict(record) if record else None
+
+    def all(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [{"gateway": gateway, "ref": ref, **record} for (gateway, ref), record in self._data.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class CallbackSender:
+    """Deliver IPNs in the background, with the configured delay, duplicates and drops."""
+
+    def __init__(self, behaviour: Behaviour, workers: int = 16):
+        self.behaviour = behaviour
+        self.session = requests.Session()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sim-ipn")
+        self.stats = {"sent": 0, "duplicates": 0, "dropped": 0, "failed": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def _deliver(self, method: str, url: str, payload: dict[str, Any]) -> None:
+        time.sleep(self.behaviour.callback_delay_ms / 1000)
+        for attempt in range(3):  # gateways retry until they get a 2xx
+            try:
+                if method == "GET":
+                    response = self.session.get(url, params=payload, timeout=10, allow_redirects=False)
+                else:
+                    response = self.session.post(url, json=payload, timeout=10)
+                if response.status_code < 400:
+                    self._count("sent")
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2 * 2**attempt)
+        self._count("failed")
+
+    def send(self, method: str, url: str, payload: dict[str, Any]) -> None:
+        if not url:
+            return
+        if self.behaviour.roll(self.behaviour.drop_rate):
+            self._count("dropped")
+            return
+        self._pool.submit(self._deliver, method, url, payload)
+        if self.behaviour.roll(self.behaviour.duplicate_rate):
+            self._count("duplicates")
+            self._pool.submit(self._deliver, method, url, payload)
+
+
+def _outcome(behaviour: Behaviour) -> str:
+    forced = request.args.get("outcome")
+    if forced in ("paid", "failed"):
+        return forced
+    return "failed" if behaviour.roll(behaviour.decline_rate) else "paid"
+
+
+def _vnpay_signature(params: dict[str, Any]) -> str:
+    return hmac_sha512(Config.VNP_HASH_SECRET, canonical_query(params))
+
+
+def _momo_signature(fields: dict[str, Any]) -> str:
+    return hmac_sha256(Config.MOMO_SECRET_KEY, momo_canonical({"accessKey": Config.MOMO_ACCESS_KEY, **fields}))
+
+
+# Fields of the IPN signature besides accessKey / ipnUrl / redirectUrl (as in verify_momo_signature)
+MOMO_IPN_SIGNED = ("amount", "extraData", "orderId", "orderInfo", "partnerCode", "requestId", "requestType", "transId", "transTime")
+
+
+def create_app(behaviour: Behaviour | None = None, store: TransactionStore | None = None, vnpay_ipn_url: str | None = None) -> Flask:
+    behaviour = behaviour or Behaviour()
+    store = store or TransactionStore()
+    sender = CallbackSender(behaviour)
+    app = Flask(__name__)
+    app.config.update(BEHAVIOUR=behaviour, TRANSACTIONS=store, CALLBACKS=sender)
+
+    def _unavailable():
+        behaviour.api_delay()
+        if behaviour.roll(behaviour.failure_rate):
+            return jsonify({"message": "Simulated gateway failure"}), 503
+        return None
+
+    # ---- MoMo ----
+
+    @app.route(MOMO_CREATE_PATH, methods=["POST"])
+    def momo_create():
+        failure = _unavailable()
+        if failure:
+            return failure
+        body = request.get_json(force=True, silent=True) or {}
+        expected = _momo_signature(
+            {
+                key: body.get(key, "")
+                for key in ("amount", "extraData", "ipnUrl", "orderId", "orderInfo", "partnerCode", "redirectUrl", "requestId", "requestType")
+            }
+        )
+        result = {
+            "partnerCode": body.get("partnerCode"),
+            "orderId": body.get("orderId"),
+            "requestId": body.get("requestId"),
+            "responseTime": int(time.time() * 1000),
+        }
+        if not signatures_match(expected, body.get("signature")):
+            return jsonify({**result, "resultCode": 11, "message": "Access denied"})
+        order_id = str(body["orderId"])
+        store.put(
+            "momo", order_id, "pending", int(body.get("amount") or 0), "0",
+            request={key: body.get(key) for key in ("requestId", "orderInfo", "extraData", "ipnUrl", "redirectUrl", "requestType", "partnerCode")},
+        )
+        pay_url = f"{request.host_url.rstrip('/')}{MOMO_PAY_PATH.replace('<order_id>', order_id)}"
+        return jsonify(
+            {**result, "amount": int(body.get("amount") or 0), "resultCode": 0, "message": "Thành công.", "payUrl": pay_url, "deeplink": pay_url}
+        )
+
+    @app.route(MOMO_PAY_PATH, methods=["GET"])
+    def momo_pay(order_id):
+        record = store.get("momo", order_id)
+        if record is None or "request" not in record:
+            return jsonify({"message": "Unknown payment"}), 404
+        outcome = _outcome(behaviour)
+        record = store.put("momo", order_id, outcome, record["amount"])
+        created = record["request"]
+        payload = {
+            "partnerCode": created["partnerCode"],
+            "orderId": order_id,
+            "requestId": created["requestId"],
+            "amount": record["amount"],
+            "orderInfo": created["orderInfo"],
+            "orderType": "momo_wallet",
+            "transId": int(record["transactionId"]),
+            "resultCode": MOMO_RESULT_CODE[outcome],
+            "message": "Successful." if outcome == "paid" else "Transaction denied by user.",
+            "payType": "qr",
+            "responseTime": int(time.time() * 1000),
+            "transTime": int(time.time() * 1000),
+            "extraData": created["extraData"] or "",
+            "requestType": created["requestType"],
+        }
+        payload["signature"] = _momo_signature(
+            {"ipnUrl": created["ipnUrl"], "redirectUrl": created["redirectUrl"], **{key: payload[key] for key in MOMO_IPN_SIGNED}}
+        )
+        sender.send("POST", created["ipnUrl"], payload)
+        return redirect(f"{created['redirectUrl']}?{urlencode(payload)}")
+
+    @app.route(MOMO_QUERY_PATH, methods=["POST"])
+    def momo_query():
+        failure = _unavailable()
+        if failure:
+            return failure
+        body = request.get_json(force=True, silent=True) or {}
+        order_id = str(body.get("orderId") or "")
+        expected = _momo_signature({"orderId": order_id, "partnerCode": body.get("partnerCode", ""), "requestId": body.get("requestId", "")})
+        result = {
+            "partnerCode": body.get("partnerCode"),
+            "orderId": order_id,
+            "requestId": body.get("requestId"),
+            "extraData": "",
+            "responseTime": int(time.time() * 1000),
+        }
+        if not signatures_match(expected, body.get("signature")):
+            return jsonify({**result, "resultCode": 11, "message": "Access denied"})
+        record = store.get("momo", order_id)
+        if record is None:
+            return jsonify({**result, "resultCode": 42, "message": "Invalid orderId or orderId is not found"})
+        return jsonify(
+            {
+                **result,
+                "amount": record["amount"],
+                "transId": int(record["transactionId"]) if record["status"] != "pending" else 0,
+                "payType": "qr",
+                "resultCode": MOMO_RESULT_CODE[record["status"]],
+                "message": record["status"],
+                "lastUpdated": int(time.time() * 1000),
+            }
+        )
+
+    # ---- VNPAY ----
+
+    @app.route(VNPAY_PAY_PATH, methods=["GET"])
+    def vnpay_pay():
+        params = request.args.to_dict()
+        if not signatures_match(_vnpay_signature(params), params.get("vnp_SecureHash")):
+            return jsonify({"message": "Sai chữ ký (invalid signature)"}), 400
+
+        outcome = _outcome(behaviour)
+        txn_ref = params["vnp_TxnRef"]
+        record = store.put("vnpay", txn_ref, outcome, int(params.get("vnp_Amount") or 0) // 100)
+        result = {
+            "vnp_Amount": params.get("vnp_Amount"),
+            "vnp_BankCode": "NCB",
+            "vnp_CardType": "ATM",
+            "vnp_OrderInfo": params.get("vnp_OrderInfo"),
+            "vnp_PayDate": record["payDate"],
+            "vnp_ResponseCode": VNPAY_RESPONSE_CODE[outcome],
+            "vnp_TmnCode": params.get("vnp_TmnCode"),
+            "vnp_TransactionNo": record["transactionId"] if outcome == "paid" else "0",
+            "vnp_TransactionStatus": VNPAY_TRANSACTION_STATUS[outcome],
+            "vnp_TxnRef": txn_ref,
+        }
+        result["vnp_SecureHash"] = _vnpay_signature(result)
+        sender.send("GET", vnpay_ipn_url, result)
+        return redirect(f"{params['vnp_ReturnUrl']}?{urlencode(result)}")
+
+    @app.route(VNPAY_QUERY_PATH, methods=["POST"])
+    def vnpay_query():
+        failure = _unavailable()
+        if failure:
+            return failure
+        body = request.get_json(force=True, silent=True) or {}
+        expected = hmac_sha512(
+            Config.VNP_HASH_SECRET,
+            "|".join(
+                str(body.get(key) or "")
+                for key in (
+                    "vnp_RequestId", "vnp_Version", "vnp_Command", "vnp_TmnCode", "vnp_TxnRef",
+                    "vnp_TransactionDate", "vnp_CreateDate", "vnp_IpAddr", "vnp_OrderInfo",
+                )
+            ),
+        )
+        record = store.get("vnpay", str(body.get("vnp_TxnRef") or ""))
+        if not signatures_match(expected, body.get("vnp_SecureHash")):
+            code, message = "97", "Invalid Checksum"
+        elif record is None:
+            code, message = "91", "Not found transaction"
+        else:
+            code, message = "00", "QueryDR Success"
+
+        result = {
+            "vnp_ResponseId": uuid.uuid4().hex,
+            "vnp_Command": "querydr",
+            "vnp_ResponseCode": code,
+            "vnp_Message": message,
+            "vnp_TmnCode": body.get("vnp_TmnCode"),
+            "vnp_TxnRef": body.get("vnp_TxnRef"),
+        }
+        if code == "00":
+            result.update(
+                {
+                    "vnp_Amount": str(record["amount"] * 100),
+                    "vnp_OrderInfo": body.get("vnp_OrderInfo"),
+                    "vnp_BankCode": "NCB",
+                    "vnp_PayDate": record["payDate"],
+                    "vnp_TransactionNo": record["transactionId"],
+                    "vnp_TransactionType": "01",
+                    "vnp_TransactionStatus": VNPAY_TRANSACTION_STATUS[record["status"]],
+                }
+            )
+        result["vnp_SecureHash"] = hmac_sha512(
+            Config.VNP_HASH_SECRET, "|".join(str(result.get(key) or "") for key in QUERY_RESPONSE_HASH_FIELDS)
+        )
+        return jsonify(result)
+
+    # ---- Simulator control ----
+
+    @app.route("/_sim/config", methods=["GET", "PUT"])
+    def sim_config():
+        if request.method == "PUT":
+            behaviour.update(request.get_json(force=True, silent=True) or {})
+        return jsonify(behaviour.as_dict())
+
+    @app.route("/_sim/stats", methods=["GET"])
+    def sim_stats():
+        return jsonify({"callbacks": dict(sender.stats), "transactions": len(store.all())})
+
+    @app.route("/_sim/transactions/<gateway>/<ref>", methods=["PUT"])
+    def put_transaction(gateway, ref):
+        body = request.get_json(force=True, silent=True) or {}
+        status = body.get("status")
+        if gateway not in ("vnpay", "momo") or status not in VNPAY_TRANSACTION_STATUS:
+            return jsonify({"error": "gateway must be vnpay|momo and status paid|failed|pending"}), 400
+        record = store.put(gateway, ref, status, body.get("amount") or 0, body.get("transactionId"))
+        return jsonify(record), 200
+
+    @app.route("/_sim/transactions", methods=["GET", "DELETE"])
+    def list_transactions():
+        if request.method == "DELETE":
+            store.clear()
+        return jsonify(store.all())
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9080)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of API calls answered with 503")
+    parser.add_argument("--decline-rate", type=float, default=0.0, help="share of payments that fail")
+    parser.add_argument("--callback-delay-ms", type=float, default=0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="share of IPNs delivered twice")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of IPNs never delivered")
+    parser.add_argument("--vnpay-ipn-url", default=None, help="also send VNPAY results server-to-server here")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--quiet", action="store_true", help="do not log every request")
+    args = parser.parse_args()
+
+    if args.quiet:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    behaviour = Behaviour(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        failure_rate=args.failure_rate,
+        decline_rate=args.decline_rate,
+        callback_delay_ms=args.callback_delay_ms,
+        duplicate_rate=args.duplicate_rate,
+        drop_rate=args.drop_rate,
+        seed=args.seed,
+    )
+    create_app(behaviour, vnpay_ipn_url=args.vnpay_ipn_url).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
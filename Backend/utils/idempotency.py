@@ -0,0 +1,144 @@
+"""Idempotency-Key support for non-idempotent POST endpoints.
+
+The first request carrying a given key claims a record in the
+``idempotency_keys`` collection, runs the endpoint and stores its response.
+Retries with the same key replay that stored response instead of executing
+again; a duplicate that arrives while the first request is still running
+waits for it to finish. Records expire through a TTL index.
+"""
+from __future__ import annotations
+
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Any, Callable
+
+from flask import Response, current_app, jsonify, request
+from pymongo.errors import DuplicateKeyError
+
+from config import Config
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+def ensure_idempotency_indexes(db) -> None:
+    try:
+        db.idempotency_keys.create_index("expiresAt", expireAfterSeconds=0)
+    except Exception as exc:  # pragma: no cover - log but continue startup
+        print(f"Warning: failed to ensure TTL index on idempotency_keys.expiresAt: {exc}")
+
+
+def _fingerprint() -> str:
+    digest = hashlib.sha256()
+    digest.update(request.method.encode("utf-8"))
+    digest.update(request.path.encode("utf-8"))
+    digest.update(request.get_data() or b"")
+    return digest.hexdigest()
+
+
+def _replay(record: dict[str, Any]) -> Response:
+    response = Response(
+        record.get("body") or "",
+        status=record.get("status") or 200,
+        mimetype=record.get("mimetype") or "application/json",
+    )
+    response.headers[REPLAYED_HEADER] = "true"
+    return response
+
+
+def _claim(db, record_id: str, fingerprint: str) -> bool:
+    """Try to become the request that executes for this key."""
+
+    now = datetime.utcnow()
+    try:
+        db.idempotency_keys.insert_one(
+            {
+                "_id": record_id,
+                "state": "in_progress",
+                "fingerprint": fingerprint,
+                "lockedUntil": now + timedelta(seconds=Config.IDEMPOTENCY_LOCK_TIMEOUT_SECONDS),
+                "createdAt": now,
+                "expiresAt": now + timedelta(seconds=Config.IDEMPOTENCY_KEY_TTL_SECONDS),
+            }
+        )
+        return True
+    except DuplicateKeyError:
+        # Take over a lock abandoned by a crashed worker -- only for the same request body;
+        # a different body falls through to the caller's 422 check.
+        result = db.idempotency_keys.update_one(
+            {"_id": record_id, "state": "in_progress", "fingerprint": fingerprint, "lockedUntil": {"$lt": now}},
+            {"$set": {"lockedUntil": now + timedelta(seconds=Config.IDEMPOTENCY_LOCK_TIMEOUT_SECONDS)}},
+        )
+        return result.modified_count == 1
+
+
+def idempotent(scope: str) -> Callable:
+    """Honour the ``Idempotency-Key`` header on an authenticated endpoint.
+
+    Must be applied below ``token_required`` so keys are namespaced per user.
+    Requests without the header run unchanged.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def decorated(current_user: dict, *args: Any, **kwargs: Any):
+            key = (request.headers.get(IDEMPOTENCY_HEADER) or "").strip()
+            if not key:
+                return fn(current_user, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({"error": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters"}), 400
+
+            db = current_app.mongo_db
+            record_id = f"{scope}:{current_user['_id']}:{key}"
+            fingerprint = _fingerprint()
+            deadline = time.monotonic() + Config.IDEMPOTENCY_WAIT_SECONDS
+            delay = 0.05
+
+            while not _claim(db, record_id, fingerprint):
+                record = db.idempotency_keys.find_one({"_id": record_id})
+                # None: the owner failed and released the key; claim again after the back-off
+                if record is not None:
+                    if record.get("fingerprint") != fingerprint:
+                        return jsonify({"error": f"{IDEMPOTENCY_HEADER} was already used for a different request"}), 422
+                    if record.get("state") == "completed":
+                        return _replay(record)
+                if time.monotonic() >= deadline:
+                    return jsonify({"error": "A request with this Idempotency-Key is still being processed"}), 409
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+
+            try:
+                response = current_app.make_response(fn(current_user, *args, **kwargs))
+            except Exception:
+                db.idempotency_keys.delete_one({"_id": record_id, "state": "in_progress"})
+                raise
+
+            if response.status_code >= 500:
+                # Server errors are not final: let the client retry for real.
+                db.idempotency_keys.delete_one({"_id": record_id, "state": "in_progress"})
+                return response
+
+            db.idempotency_keys.update_one(
+                {"_id": record_id},
+                {
+                    "$set": {
+                        "state": "completed",
+                        "status": response.status_code,
+                        "mimetype": response.mimetype,
+                        "body": response.get_data(as_text=True),
+                        "completedAt": datetime.utcnow(),
+                    },
+                    "$unset": {"lockedUntil": ""},
+                },
+            )
+            return response
+
+        return decorated
+
+    return decorator
+
+
+__all__ = ["IDEMPOTENCY_HEADER", "REPLAYED_HEADER", "ensure_idempotency_indexes", "idempotent"]
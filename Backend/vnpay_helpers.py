@@ -3,19 +3,15 @@ VNPAY Payment Integration Helper Functions
 Tích hợp cổng thanh toán VNPAY theo tài liệu chính thức PAY - VNPAY
 """
 
-import hashlib
-import hmac
 import json
 from datetime import datetime, timedelta
 from typing import Dict, Optional, Tuple
-from urllib.parse import urlencode
-
-try:
-    import requests  # used to fetch correct time if local clock is skewed
-except Exception:  # pragma: no cover
-    requests = None
 
 from config import Config
+from services import payment_log
+from services.clock import now_gmt7
+from services.signing import signatures_match
+from vnpay_utils import canonical_query, hmac_sha512
 
 
 class VNPAYHelper:
@@ -25,48 +21,9 @@ class VNPAYHelper:
     def _now_gmt7() -> datetime:
         """
         Return current time in GMT+7.
-        If local system clock is wrong, try multiple external sources as fallbacks.
+        Local clock skew is corrected with the offset cached by services.clock.
         """
-        if requests:
-            try:
-                resp = requests.get(
-                    "https://worldtimeapi.org/api/timezone/Asia/Ho_Chi_Minh", timeout=2
-                )
-                if resp.ok:
-                    data = resp.json()
-                    dt_str = data.get("datetime")
-                    if dt_str:
-                        return datetime.fromisoformat(dt_str)
-            except Exception:
-                pass
-
-            try:
-                resp = requests.get(
-                    "https://timeapi.io/api/Time/current/zone?timeZone=Asia/Ho_Chi_Minh",
-                    timeout=2,
-                )
-                if resp.ok:
-                    data = resp.json()
-                    return datetime(
-                        data["year"],
-                        data["month"],
-                        data["day"],
-                        data["hour"],
-                        data["minute"],
-                        int(data["seconds"]),
-                    )
-            except Exception:
-                pass
-
-            try:
-                resp = requests.head("https://www.google.com", timeout=2)
-                date_hdr = resp.headers.get("Date")
-                if date_hdr:
-                    dt = datetime.strptime(date_hdr, "%a, %d %b %Y %H:%M:%S GMT")
-                    return dt + timedelta(hours=7)
-            except Exception:
-                pass
-        return datetime.utcnow() + timedelta(hours=7)
+        return now_gmt7()
 
     @staticmethod
     def usd_to_vnd(amount_usd: float) -> int:
@@ -140,11 +97,8 @@ class VNPAYHelper:
         if bank_code and bank_code.strip():
             request_data["vnp_BankCode"] = bank_code
         
-        # Step 5: Sort parameters by key (required for signature)
-        sorted_params = sorted(request_data.items())
-
-        # Step 6: URL-encode sorted params to a query string (used for both hash and final URL)
-        hash_data = urlencode(sorted_params)
+        # Step 5-6: Sort by key and URL-encode (used for both hash and final URL)
+        hash_data = canonical_query(request_data)
 
         # Step 7: Generate HMAC SHA512 signature (do NOT include vnp_SecureHashType in signed data)
         vnp_secure_hash = VNPAYHelper.create_signature(hash_data)
@@ -168,11 +122,7 @@ class VNPAYHelper:
         Returns:
             64-char hex string (SHA512)
         """
-        return hmac.new(
-            Config.VNP_HASH_SECRET.encode(),
-            data.encode(),
-            hashlib.sha512
-        ).hexdigest()
+        return hmac_sha512(Config.VNP_HASH_SECRET, data)
 
     @staticmethod
     def verify_response_signature(params: Dict[str, str]) -> bool:
@@ -193,17 +143,11 @@ class VNPAYHelper:
         # Extract signature from params
         vnp_secure_hash = params.get("vnp_SecureHash", "")
         
-        # Create copy of params without signature for hash calculation
-        params_copy = {k: v for k, v in params.items() if k not in {"vnp_SecureHash", "vnp_SecureHashType"}}
-        
-        # Sort and create hash data string (URL-encoded)
-        sorted_params = sorted(params_copy.items())
-        hash_data = urlencode(sorted_params)
+        # Same canonical string as the payment URL: vnp_* params without the hash, sorted, URL-encoded
+        calculated_hash = VNPAYHelper.create_signature(canonical_query(params))
 
-        # Generate signature and compare (VNPAY signs with SHA512 HMAC)
-        calculated_hash = VNPAYHelper.create_signature(hash_data)
-        
-        return calculated_hash.lower() == vnp_secure_hash.lower()
+        # Constant-time comparison (VNPAY signs with SHA512 HMAC)
+        return signatures_match(calculated_hash, vnp_secure_hash)
 
     @staticmethod
     def get_response_description(response_code: str) -> str:
@@ -271,7 +215,7 @@ def log_vnpay_transaction(
     error_msg: Optional[str] = None,
 ) -> None:
     """
-    Log VNPAY transaction events for debugging and monitoring
+    Record a VNPAY transaction event in the payment audit log (services.payment_log)
     
     Args:
         event: Event type (CREATE_URL, IPN_RECEIVED, VERIFIED, UPDATED, FAILED_VERIFY, etc.)
@@ -283,15 +227,14 @@ def log_vnpay_transaction(
         error_msg: Error message if any
     """
     
-    timestamp = datetime.utcnow() + timedelta(hours=7)
-    log_message = f"[{timestamp.strftime('%Y-%m-%d %H:%M:%S')}] VNPAY {event}: OrderID={order_id}, Status={status}, Amount={amount_vnd} VND"
-    
-    if response_code:
-        log_message += f", ResponseCode={response_code}"
-    if transaction_no:
-        log_message += f", TransactionNo={transaction_no}"
-    if error_msg:
-        log_message += f", Error={error_msg}"
-    
-    print(log_message)
-    # TODO: Implement proper logging to file/database if needed
+    payment_log.record(
+        event.lower(),
+        "vnpay",
+        order_id,
+        level="error" if error_msg else "info",
+        status=status,
+        amountVnd=amount_vnd,
+        responseCode=response_code,
+        transactionNo=transaction_no,
+        error=error_msg,
+    )
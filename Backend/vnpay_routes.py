@@ -4,14 +4,18 @@ Integrated payment flow based on official VNPAY documentation
 """
 
 from flask import request, jsonify, redirect
-from bson import ObjectId
-from bson.errors import InvalidId
 from datetime import datetime, timedelta
 from urllib.parse import urlencode, quote
 from functools import wraps
 import json
+import traceback
 
 from config import Config
+from services import payment_log
+from services.order_lookup import find_order
+from services.outbox import update_order
+from services.payment_callbacks import AMOUNT_MISMATCH, callback_key, seen_callback
+from services.payment_events import enqueue_event
 from vnpay_helpers import VNPAYHelper, log_vnpay_transaction
 
 
@@ -23,6 +27,15 @@ def get_client_ip(req):
     return req.remote_addr or '127.0.0.1'
 
 
+def _ipn_ack(record):
+    """IPN response for a callback we have already processed."""
+    if record.get('outcome') == AMOUNT_MISMATCH:
+        return {'RspCode': '04', 'Message': 'Invalid amount'}
+    if record.get('applied') is False:
+        return {'RspCode': '02', 'Message': 'Order Already Updated'}
+    return {'RspCode': '00', 'Message': 'Confirm Success'}
+
+
 def setup_vnpay_routes(app, db, token_required):
     """
     Setup VNPAY payment routes
@@ -89,13 +102,7 @@ def setup_vnpay_routes(app, db, token_required):
             print(f"{'='*80}")
 
             # Step 2: Find order in database
-            order = None
-            try:
-                # Try as MongoDB ObjectId first
-                order = db.orders.find_one({'_id': ObjectId(order_id)})
-            except (InvalidId, TypeError):
-                # Try as string orderId
-                order = db.orders.find_one({'orderId': order_id})
+            order = find_order(db, order_id)
 
             if not order:
                 print(f"❌ Order not found: {order_id}")
@@ -185,8 +192,8 @@ def setup_vnpay_routes(app, db, token_required):
 
             # Step 10: Update order payment status to PENDING
             try:
-                db.orders.update_one(
-                    {'_id': order['_id']},
+                update_order(
+                    db, order,
                     {
                         '$set': {
                             'payment.method': 'VNPAY',
@@ -194,8 +201,7 @@ def setup_vnpay_routes(app, db, token_required):
                             'payment.initiatedAt': datetime.utcnow(),
                             'updatedAt': datetime.utcnow()
                         }
-                    },
-                    upsert=False
+                    }
                 )
                 print(f"📝 Order updated: payment.status = Pending")
                 
@@ -250,8 +256,9 @@ def setup_vnpay_routes(app, db, token_required):
         This is the most important endpoint:
         - VNPAY server calls this after payment completes
         - This endpoint is the source of truth for payment status
-        - We update order status here
-        - We return RspCode to tell VNPAY if we successfully processed
+        - We store the notification in payment_events; the payment-events
+          worker updates the order status
+        - We return RspCode 00 once the notification is stored
         
         Query parameters: Same as Return URL
         vnp_Amount, vnp_BankCode, vnp_ResponseCode, vnp_TransactionStatus, etc.
@@ -264,23 +271,11 @@ def setup_vnpay_routes(app, db, token_required):
         """
         
         try:
-            print(f"\n{'='*80}")
-            print(f"📬 VNPAY IPN RECEIVED")
-            print(f"{'='*80}")
-
             # Step 1: Get all query parameters from VNPAY
             params = request.args.to_dict()
-            
-            print(f"\n📥 Received parameters from VNPAY:")
-            for key, value in sorted(params.items()):
-                if key != 'vnp_SecureHash':
-                    print(f"   {key}: {value}")
-                else:
-                    print(f"   {key}: {value[:20]}...")
 
             # Step 2: Validate checksum signature
             if not VNPAYHelper.verify_response_signature(params):
-                print(f"\n❌ SIGNATURE VERIFICATION FAILED")
                 log_vnpay_transaction(
                     event="IPN_VERIFY_FAILED",
                     order_id=params.get('vnp_TxnRef', 'unknown'),
@@ -294,191 +289,39 @@ def setup_vnpay_routes(app, db, token_required):
                     'Message': 'Invalid Signature'
                 }), 200
 
-            print(f"✅ SIGNATURE VERIFICATION PASSED")
-
             # Step 3: Extract key parameters
             txn_ref = params.get('vnp_TxnRef')  # Order ID
             amount_vnd = int(params.get('vnp_Amount', '0')) // 100  # Convert from x100 format
             response_code = params.get('vnp_ResponseCode')  # Payment result
-            transaction_status = params.get('vnp_TransactionStatus')  # Transaction status
             transaction_no = params.get('vnp_TransactionNo')  # VNPAY transaction ID
-            bank_code = params.get('vnp_BankCode')
-            pay_date = params.get('vnp_PayDate')
-
-            print(f"\n🔍 Key Parameters:")
-            print(f"   txn_ref (Order ID): {txn_ref}")
-            print(f"   Amount: {amount_vnd} VND")
-            print(f"   Response Code: {response_code}")
-            print(f"   Transaction Status: {transaction_status}")
-            print(f"   Transaction No: {transaction_no}")
-            print(f"   Bank: {bank_code}")
-            print(f"   Pay Date: {pay_date}")
-
-            # Step 4: Find order in database
-            order = None
-            try:
-                order = db.orders.find_one({'_id': ObjectId(txn_ref)})
-            except (InvalidId, TypeError):
-                order = db.orders.find_one({'orderId': txn_ref})
-
-            if not order:
-                print(f"\n❌ Order not found: {txn_ref}")
-                
-                return jsonify({
-                    'RspCode': '01',
-                    'Message': 'Order not found'
-                }), 200
-
-            print(f"✅ Order found: {txn_ref}")
-
-            # Step 5: Check if order was already updated before (idempotency)
-            payment_info = order.get('payment') or {}
-            current_status = payment_info.get('status') or 'Unknown'
-
-            is_first_update = current_status.lower() not in ['paid', 'failed']
-
-            if not is_first_update:
-                print(f"\n⚠️  Order already updated with status: {current_status}")
-                print(f"   Returning RspCode=02 (Already Updated)")
-                
-                return jsonify({
-                    'RspCode': '02',
-                    'Message': 'Order Already Updated'
-                }), 200
-
-            print(f"✅ First time update for this order")
-
-            # Step 6: Verify amount matches
-            expected_total_usd = float(order.get('total') or order.get('totalUsd') or 0)
-            expected_amount_vnd = VNPAYHelper.usd_to_vnd(expected_total_usd)
-
-            if amount_vnd != expected_amount_vnd:
-                print(f"\n❌ AMOUNT MISMATCH:")
-                print(f"   Expected: {expected_amount_vnd} VND")
-                print(f"   Paid: {amount_vnd} VND")
 
-                # Update order to FAILED due to amount mismatch
-                db.orders.update_one(
-                    {'_id': order['_id']},
-                    {
-                        '$set': {
-                            'payment.status': 'Failed',
-                            'payment.failReason': 'Amount mismatch',
-                            'payment.expectedAmount': expected_amount_vnd,
-                            'payment.receivedAmount': amount_vnd,
-                            'status': 'Payment Failed',
-                            'updatedAt': datetime.utcnow()
-                        }
-                    }
-                )
-
-                log_vnpay_transaction(
-                    event="IPN_AMOUNT_MISMATCH",
-                    order_id=txn_ref,
-                    status="FAILED",
-                    amount_vnd=amount_vnd,
-                    response_code=response_code,
-                    error_msg=f"Expected {expected_amount_vnd}, got {amount_vnd}"
-                )
-
-                return jsonify({
-                    'RspCode': '04',
-                    'Message': 'Invalid amount'
-                }), 200
-
-            print(f"✅ Amount verified: {amount_vnd} VND")
-
-            # Step 7: Determine payment status based on VNPAY response
-            # According to VNPAY documentation:
-            # ResponseCode '00' = success
-            # TransactionStatus '00' = transaction successful
-            
-            is_payment_success = (response_code == '00') and (transaction_status == '00')
-
-            print(f"\n{'='*60}")
-            if is_payment_success:
-                print(f"✅ PAYMENT SUCCESSFUL - Updating order to PAID")
-                print(f"{'='*60}")
-                
-                # Update order status to PAID
-                db.orders.update_one(
-                    {'_id': order['_id']},
-                    {
-                        '$set': {
-                            'payment.method': 'VNPAY',
-                            'payment.status': 'Paid',
-                            'payment.transactionNo': transaction_no,
-                            'payment.bankCode': bank_code,
-                            'payment.payDate': pay_date,
-                            'payment.ipnReceivedAt': datetime.utcnow(),
-                            'status': 'Paid',
-                            'paidAt': datetime.utcnow(),
-                            'updatedAt': datetime.utcnow()
-                        }
-                    }
-                )
-
-                log_vnpay_transaction(
-                    event="IPN_SUCCESS",
-                    order_id=txn_ref,
-                    status="PAID",
-                    amount_vnd=amount_vnd,
-                    response_code=response_code,
-                    transaction_no=transaction_no
-                )
-
-                # Return RspCode 00 to tell VNPAY we successfully processed
-                return jsonify({
-                    'RspCode': '00',
-                    'Message': 'Confirm Success'
-                }), 200
-
-            else:
-                print(f"❌ PAYMENT FAILED - Updating order to FAILED")
-                print(f"   Response Code: {response_code}")
-                print(f"   Transaction Status: {transaction_status}")
-                print(f"{'='*60}")
-
-                # Get error message from helper
-                error_msg = VNPAYHelper.get_response_description(response_code)
-
-                # Update order status to FAILED
-                db.orders.update_one(
-                    {'_id': order['_id']},
-                    {
-                        '$set': {
-                            'payment.method': 'VNPAY',
-                            'payment.status': 'Failed',
-                            'payment.responseCode': response_code,
-                            'payment.failReason': error_msg,
-                            'payment.transactionNo': transaction_no,
-                            'payment.ipnReceivedAt': datetime.utcnow(),
-                            'status': 'Payment Failed',
-                            'updatedAt': datetime.utcnow()
-                        }
-                    }
-                )
-
-                log_vnpay_transaction(
-                    event="IPN_FAILED",
-                    order_id=txn_ref,
-                    status="FAILED",
-                    amount_vnd=amount_vnd,
-                    response_code=response_code,
-                    transaction_no=transaction_no,
-                    error_msg=error_msg
-                )
+            # Step 4: VNPAY retries until it gets an answer - duplicates are answered
+            # from the stored outcome without touching the order
+            callback_id = callback_key(transaction_no, params.get('vnp_SecureHash'))
+            seen = seen_callback(db, 'vnpay', callback_id)
+            if seen:
+                payment_log.record('ipn_duplicate', 'vnpay', txn_ref, outcome=seen.get('outcome'), transactionNo=transaction_no)
+                return jsonify(_ipn_ack(seen)), 200
+
+            # Step 5: Store the notification and confirm receipt. Order lookup, amount
+            # check and the status update run in the payment-events worker
+            # (services.payment_events -> payment_callbacks.process_vnpay_callback).
+            event_id = enqueue_event(db, 'vnpay', txn_ref, params)
+            payment_log.record(
+                'ipn_queued', 'vnpay', txn_ref,
+                eventId=event_id, amountVnd=amount_vnd, responseCode=response_code, params=params,
+            )
 
-                # Return RspCode 00 anyway - we processed the failure successfully
-                return jsonify({
-                    'RspCode': '00',
-                    'Message': 'Confirm Success'
-                }), 200
+            return jsonify({
+                'RspCode': '00',
+                'Message': 'Confirm Success'
+            }), 200
 
         except Exception as e:
-            print(f"\n❌ IPN ERROR: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            payment_log.record(
+                'ipn_error', 'vnpay', request.args.get('vnp_TxnRef'), level='error',
+                error=str(e), traceback=traceback.format_exc(), params=request.args.to_dict(),
+            )
 
             # Return error code to trigger VNPAY retry
             return jsonify({
@@ -508,72 +351,51 @@ def setup_vnpay_routes(app, db, token_required):
         """
         
         try:
-            print(f"\n{'='*80}")
-            print(f"🔙 VNPAY RETURN HANDLER (Browser Redirect)")
-            print(f"{'='*80}")
-
             # Step 1: Get all query parameters from VNPAY
             params = request.args.to_dict()
 
             if not params:
-                print(f"\n❌ No parameters received")
                 return redirect(f"{Config.FRONTEND_URL}/payment-fail?method=vnpay&message=No+parameters")
 
             # Step 2: Validate signature for security
             if not VNPAYHelper.verify_response_signature(params):
-                print(f"\n❌ SIGNATURE VERIFICATION FAILED")
                 txn_ref = params.get('vnp_TxnRef', 'unknown')
-                
+                payment_log.record('return_rejected', 'vnpay', txn_ref, level='warning', reason='invalid_signature', params=params)
                 return redirect(
                     f"{Config.FRONTEND_URL}/payment-fail?orderId={txn_ref}&method=vnpay&message=Invalid+signature"
                 )
 
-            print(f"✅ SIGNATURE VERIFICATION PASSED")
-
             # Step 3: Extract parameters
             txn_ref = params.get('vnp_TxnRef')
-            amount_vnd = int(params.get('vnp_Amount', '0')) // 100
             response_code = params.get('vnp_ResponseCode')
             transaction_status = params.get('vnp_TransactionStatus')
-            transaction_no = params.get('vnp_TransactionNo')
-
-            print(f"\n🔍 Parameters:")
-            print(f"   Order ID: {txn_ref}")
-            print(f"   Amount: {amount_vnd} VND")
-            print(f"   Response Code: {response_code}")
-            print(f"   Transaction Status: {transaction_status}")
-            print(f"   Transaction No: {transaction_no}")
 
             # Step 4: Find order (read current status from DB - IPN should have updated it)
-            order = None
-            try:
-                order = db.orders.find_one({'_id': ObjectId(txn_ref)})
-            except (InvalidId, TypeError):
-                order = db.orders.find_one({'orderId': txn_ref})
+            order = find_order(db, txn_ref)
 
             if not order:
-                print(f"\n❌ Order not found: {txn_ref}")
+                payment_log.record('return_rejected', 'vnpay', txn_ref, level='warning', reason='order_not_found', params=params)
                 return redirect(
                     f"{Config.FRONTEND_URL}/payment-fail?orderId={txn_ref}&method=vnpay&message=Order+not+found"
                 )
 
             # Step 5: Get order amount for frontend display
             order_total_usd = float(order.get('total') or order.get('totalUsd') or 0)
-            
-            print(f"💰 Order amount: {order_total_usd} USD")
 
             # Step 6: Check current order status (should be updated by IPN)
             payment_info = order.get('payment') or {}
             current_payment_status = payment_info.get('status', 'Unknown')
 
-            print(f"\n📊 Order current status: {current_payment_status}")
-
             # Step 7: Determine what to display to user
             # Trust the order status set by IPN, but also look at VNPAY response
             
-            if current_payment_status.lower() == 'paid' or (response_code == '00' and transaction_status == '00'):
-                print(f"\n✅ PAYMENT SUCCESS - Redirecting to success page")
-                
+            success = current_payment_status.lower() == 'paid' or (response_code == '00' and transaction_status == '00')
+            payment_log.record(
+                'return_received', 'vnpay', txn_ref,
+                paymentStatus=current_payment_status, success=success, params=params,
+            )
+
+            if success:
                 redirect_url = (
                     f"{Config.FRONTEND_URL}/payment-success?"
                     f"orderId={txn_ref}&"
@@ -582,8 +404,6 @@ def setup_vnpay_routes(app, db, token_required):
                 )
                 
             else:
-                print(f"\n❌ PAYMENT FAILED - Redirecting to failure page")
-                
                 # Get error message
                 error_msg = VNPAYHelper.get_response_description(response_code)
                 error_msg_encoded = quote(error_msg)
@@ -596,16 +416,14 @@ def setup_vnpay_routes(app, db, token_required):
                     f"message={error_msg_encoded}"
                 )
 
-            print(f"🔄 Redirecting to: {redirect_url[:80]}...")
-            print(f"{'='*80}\n")
-            
             return redirect(redirect_url), 302
 
         except Exception as e:
-            print(f"\n❌ RETURN ERROR: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            
+            payment_log.record(
+                'return_error', 'vnpay', request.args.get('vnp_TxnRef'), level='error',
+                error=str(e), traceback=traceback.format_exc(), params=request.args.to_dict(),
+            )
+
             return redirect(
                 f"{Config.FRONTEND_URL}/payment-fail?method=vnpay&message=Error+processing+payment"
             ), 302
@@ -2,25 +2,48 @@
 
 from __future__ import annotations
 
-import hashlib
-import hmac
 import json
+import re
+import uuid
 from datetime import datetime, timedelta
-from typing import Dict
-from urllib.parse import urlencode
-
-try:
-    import requests  # used to fetch correct time if local clock is skewed
-except Exception:  # pragma: no cover - requests may not be available
-    requests = None
+from typing import Any, Dict
+from urllib.parse import parse_qs, quote_plus, urlsplit
 
 from config import Config
+from services import http_client
+from services.clock import now_gmt7
+from services.signing import hmac_hex, signatures_match
+
+SIGNATURE_FIELDS = frozenset({"vnp_SecureHash", "vnp_SecureHashType"})
 
 
 def hmac_sha512(key: str, data: str) -> str:
     """Return the hexadecimal SHA512 HMAC for the given data."""
 
-    return hmac.new(key.encode("utf-8"), data.encode("utf-8"), hashlib.sha512).hexdigest()
+    return hmac_hex(key, data, "sha512")
+
+
+# Characters quote_plus leaves alone; most VNPAY values (amounts, codes, dates) need no encoding
+_UNRESERVED = re.compile(r"[A-Za-z0-9_.~-]*\Z")
+
+
+def _encode(text: str) -> str:
+    return text if _UNRESERVED.match(text) else quote_plus(text)
+
+
+def canonical_query(params: Dict[str, Any]) -> str:
+    """The string VNPAY 2.1.0 signs, for both payment URLs and results.
+
+    ``vnp_*`` parameters except the hash fields, sorted by key and url-encoded
+    (``quote_plus``, as ``urlencode`` does). A payment URL uses it verbatim as
+    its query string.
+    """
+
+    return "&".join(
+        f"{_encode(key)}={_encode(str(value))}"
+        for key, value in sorted(params.items())
+        if key.startswith("vnp_") and key not in SIGNATURE_FIELDS
+    )
 
 
 def _format_datetime(dt: datetime) -> str:
@@ -28,57 +51,9 @@ def _format_datetime(dt: datetime) -> str:
 
 
 def _now_gmt7() -> datetime:
-    """
-    Return current time in GMT+7.
-    If local system clock is wrong, try multiple external sources before falling back.
-    """
-    if requests:
-        # Source 1: worldtimeapi.org
-        try:
-            resp = requests.get(
-                "https://worldtimeapi.org/api/timezone/Asia/Ho_Chi_Minh", timeout=2
-            )
-            if resp.ok:
-                data = resp.json()
-                dt_str = data.get("datetime")
-                if dt_str:
-                    return datetime.fromisoformat(dt_str)
-        except Exception:
-            pass
-
-        # Source 2: timeapi.io
-        try:
-            resp = requests.get(
-                "https://timeapi.io/api/Time/current/zone?timeZone=Asia/Ho_Chi_Minh",
-                timeout=2,
-            )
-            if resp.ok:
-                data = resp.json()
-                # timeapi.io returns fields year, month, day, hour, minute, seconds
-                return datetime(
-                    data["year"],
-                    data["month"],
-                    data["day"],
-                    data["hour"],
-                    data["minute"],
-                    int(data["seconds"]),
-                )
-        except Exception:
-            pass
-
-        # Source 3: Date header from a HEAD request (UTC), then shift +7
-        try:
-            resp = requests.head("https://www.google.com", timeout=2)
-            date_hdr = resp.headers.get("Date")
-            if date_hdr:
-                # Example: 'Wed, 27 Nov 2024 01:00:00 GMT'
-                dt = datetime.strptime(date_hdr, "%a, %d %b %Y %H:%M:%S GMT")
-                return dt + timedelta(hours=7)
-        except Exception:
-            pass
-
-    # Fallback: local system clock
-    return datetime.utcnow() + timedelta(hours=7)
+    """Return current time in GMT+7, corrected for local clock skew (see services.clock)."""
+
+    return now_gmt7()
 
 
 def build_payment_url(
@@ -132,9 +107,8 @@ def build_payment_url(
         "vnp_ExpireDate": _format_datetime(expire_at),
     }
     
-    # For signing, use URL-encoded string of sorted params (same encoding as query)
-    sorted_items = sorted(params.items())
-    hash_data = urlencode(sorted_items)
+    # The signed string doubles as the query string
+    hash_data = canonical_query(params)
     vnp_secure_hash = hmac_sha512(Config.VNP_HASH_SECRET, hash_data)
 
     # Build final payment URL using the same encoded string
@@ -155,9 +129,73 @@ def verify_vnpay_signature(params: Dict[str, str]) -> bool:
     if not secure_hash:
         return False
 
-    data = {k: v for k, v in params.items() if k not in {"vnp_SecureHash", "vnp_SecureHashType"}}
-    sorted_items = sorted(data.items())
-    hash_data = "&".join([f"{k}={v}" for k, v in sorted_items])
-    calculated_hash = hmac_sha512(Config.VNP_HASH_SECRET, hash_data)
+    return signatures_match(hmac_sha512(Config.VNP_HASH_SECRET, canonical_query(params)), secure_hash)
+
+
+def create_date_of(payment_url: str) -> str | None:
+    """Return the ``vnp_CreateDate`` of a URL built by ``build_payment_url``.
+
+    ``querydr`` needs it as ``vnp_TransactionDate``, so it is stored on the order.
+    """
+
+    values = parse_qs(urlsplit(payment_url).query).get("vnp_CreateDate")
+    return values[0] if values else None
 
-    return calculated_hash.lower() == secure_hash.lower()
+
+QUERY_RESPONSE_HASH_FIELDS = (
+    "vnp_ResponseId", "vnp_Command", "vnp_ResponseCode", "vnp_Message", "vnp_TmnCode",
+    "vnp_TxnRef", "vnp_Amount", "vnp_BankCode", "vnp_PayDate", "vnp_TransactionNo",
+    "vnp_TransactionType", "vnp_TransactionStatus", "vnp_OrderInfo", "vnp_PromotionCode",
+    "vnp_PromotionAmount",
+)
+
+
+def query_transaction(txn_ref: str, transaction_date: str, ip_addr: str = "127.0.0.1") -> Dict[str, Any]:
+    """Ask VNPAY for the current result of a payment (``querydr``).
+
+    Args:
+        txn_ref: vnp_TxnRef the payment URL was built with.
+        transaction_date: vnp_CreateDate of that payment URL (yyyyMMddHHmmss, GMT+7).
+        ip_addr: IP of the server making the request.
+
+    Returns:
+        The decoded JSON answer. Raises ``ValueError`` when its signature is invalid.
+    """
+
+    params = {
+        "vnp_RequestId": uuid.uuid4().hex,
+        "vnp_Version": Config.VNP_VERSION,
+        "vnp_Command": "querydr",
+        "vnp_TmnCode": Config.VNP_TMN_CODE,
+        "vnp_TxnRef": txn_ref,
+        "vnp_OrderInfo": f"Truy van giao dich {txn_ref}",
+        "vnp_TransactionDate": transaction_date,
+        "vnp_CreateDate": _format_datetime(_now_gmt7()),
+        "vnp_IpAddr": ip_addr,
+    }
+    # querydr signs a fixed, pipe separated field order (not the sorted query string)
+    hash_data = "|".join(
+        str(params[key])
+        for key in (
+            "vnp_RequestId", "vnp_Version", "vnp_Command", "vnp_TmnCode", "vnp_TxnRef",
+            "vnp_TransactionDate", "vnp_CreateDate", "vnp_IpAddr", "vnp_OrderInfo",
+        )
+    )
+    params["vnp_SecureHash"] = hmac_sha512(Config.VNP_HASH_SECRET, hash_data)
+
+    response = http_client.post("vnpay", Config.VNP_QUERY_URL, json=params)
+    response.raise_for_status()
+    result = response.json()
+    if not verify_query_response(result):
+        raise ValueError(f"Invalid signature on VNPAY querydr response for {txn_ref}")
+    return result
+
+
+def verify_query_response(result: Dict[str, Any]) -> bool:
+    """Verify the signature of a ``querydr`` answer."""
+
+    secure_hash = (result or {}).get("vnp_SecureHash")
+    if not secure_hash:
+        return False
+    hash_data = "|".join(str(result.get(key) or "") for key in QUERY_RESPONSE_HASH_FIELDS)
+    return signatures_match(hmac_sha512(Config.VNP_HASH_SECRET, hash_data), secure_hash)
@@ -102,6 +102,10 @@ const orders = {
     const response = await api.get(`/api/admin/orders/${id}`);
     return response.data;
   },
+  activity: async (id, params = {}) => {
+    const response = await api.get(`/api/admin/orders/${id}/activity`, { params });
+    return response.data;
+  },
   updateStatus: async (id, status) => {
     const response = await api.patch(`/api/admin/orders/${id}/status`, { status });
     return response.data;
@@ -47,6 +47,8 @@ const AdminOrderDetail = () => {
   const [savingNotes, setSavingNotes] = useState(false);
   const [statusUpdating, setStatusUpdating] = useState(false);
   const [feedback, setFeedback] = useState(null);
+  const [history, setHistory] = useState(null);
+  const [historyLoading, setHistoryLoading] = useState(false);
 
   const loadOrder = useCallback(async () => {
     try {
@@ -69,6 +71,31 @@ const AdminOrderDetail = () => {
     loadOrder();
   }, [loadOrder]);
 
+  useEffect(() => {
+    // The preview on the order changed; drop any stale full history.
+    setHistory(null);
+  }, [order]);
+
+  const loadHistory = useCallback(
+    async (page = 1) => {
+      try {
+        setHistoryLoading(true);
+        const response = await adminApi.orders.activity(id, { page, limit: 20 });
+        setHistory((prev) => ({
+          items: page === 1 || !prev ? response.items : [...prev.items, ...response.items],
+          total: response.total,
+          page: response.page,
+        }));
+      } catch (err) {
+        console.error("Failed to load order activity", err);
+        setFeedback({ type: "danger", message: "Không thể tải lịch sử hoạt động." });
+      } finally {
+        setHistoryLoading(false);
+      }
+    },
+    [id]
+  );
+
   useEffect(() => {
     if (!feedback) {
       return undefined;
@@ -144,7 +171,8 @@ const AdminOrderDetail = () => {
     [notes, order?.notes]
   );
 
-  const activityLog = order?.activity_log || [];
+  const activityLog = history ? history.items : order?.activity_log || [];
+  const hasMoreHistory = history ? history.items.length < history.total : activityLog.length > 0;
 
   if (loading) {
     return (
@@ -338,6 +366,16 @@ const AdminOrderDetail = () => {
                   ))}
                 </ul>
               )}
+              {hasMoreHistory && (
+                <button
+                  type="button"
+                  className="btn btn-link text-decoration-none ps-0 mt-2"
+                  onClick={() => loadHistory(history ? history.page + 1 : 1)}
+                  disabled={historyLoading}
+                >
+                  {historyLoading ? "Đang tải..." : history ? "Tải thêm" : "Xem toàn bộ lịch sử"}
+                </button>
+              )}
             </div>
           </div>
         </div>
@@ -20,6 +20,7 @@ const normalizeSummary = (raw) => {
     totalOrders: src.totalOrders ?? src.total_orders ?? 0,
     totalUsers: src.totalUsers ?? src.total_users ?? 0,
     activeProducts: src.activeProducts ?? src.active_products ?? 0,
+    cacheAgeSeconds: src.cacheAgeSeconds ?? src.cache_age_seconds ?? null,
   };
 };
 
@@ -118,6 +119,11 @@ const Dashboard = () => {
         <SummaryCard label="Nguoi dung" value={summary.totalUsers || 0} />
         <SummaryCard label="San pham dang ban" value={summary.activeProducts || 0} />
       </Row>
+      {summary.cacheAgeSeconds != null && (
+        <p className="text-muted small mb-0">
+          So lieu cap nhat {Math.round(summary.cacheAgeSeconds)} giay truoc
+        </p>
+      )}
 
       <Row className="mt-3">
         <Col lg={8} className="mb-3">
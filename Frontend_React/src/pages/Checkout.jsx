@@ -1,9 +1,9 @@
 // Checkout Page Component - Thanh toán COD + VNPAY
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useCart } from '../contexts/CartContext';
 import { useAuth } from '../contexts/AuthContext';
-import { ordersAPI, paymentAPI } from '../services/api';
+import { newIdempotencyKey, ordersAPI, paymentAPI } from '../services/api';
 import Navbar from '../components/Navbar';
 import Footer from '../components/Footer';
 import '../styles/Checkout.css';
@@ -17,6 +17,8 @@ const Checkout = () => {
   const [orderPlaced, setOrderPlaced] = useState(false);
   const [orderId, setOrderId] = useState('');
   const [paymentMethod, setPaymentMethod] = useState('cod');
+  // One key per checkout attempt: resubmitting the same form replays the original order
+  const checkoutKeyRef = useRef(newIdempotencyKey());
 
   // Shipping form state
   const [shippingInfo, setShippingInfo] = useState({
@@ -102,7 +104,7 @@ const Checkout = () => {
       console.log("📦 Creating order with data:", orderData);
 
       // Step 1: Tạo đơn hàng trên backend
-      const response = await ordersAPI.createOrder(orderData);
+      const response = await ordersAPI.createOrder(orderData, checkoutKeyRef.current);
 
       if (response.order) {
         const createdOrder = response.order;
@@ -147,7 +149,7 @@ const Checkout = () => {
             amount: Math.round(createdOrder.total * 100) || Math.round(total * 100), // VNPAY tính bằng VND
             returnUrl: `${window.location.origin}/payment-result`, // URL trả về sau khi thanh toán
             description: `Thanh toan don hang ${orderId}`
-          });
+          }, `${checkoutKeyRef.current}:vnpay`);
 
           if (paymentResponse.payment_url || paymentResponse.paymentUrl) {
             console.log("✅ Payment URL received, redirecting to VNPAY gateway");
@@ -166,7 +168,7 @@ const Checkout = () => {
           // Step 2: Gọi API tạo URL thanh toán MoMo
           const paymentResponse = await paymentAPI.createMomoPayment({
             orderId: orderId
-          });
+          }, `${checkoutKeyRef.current}:momo`);
 
           if (paymentResponse.success && paymentResponse.payUrl) {
             console.log("✅ MoMo Payment URL received, redirecting to MoMo gateway");
@@ -182,6 +184,10 @@ const Checkout = () => {
       }
     } catch (error) {
       console.error('❌ Error placing order:', error);
+      if (error.response) {
+        // The server answered, so the attempt is final; a corrected resubmission needs a fresh key
+        checkoutKeyRef.current = newIdempotencyKey();
+      }
       const errorMsg = error.response?.data?.error || error.message || 'Failed to place order';
       alert(`Lỗi: ${errorMsg}`);
     } finally {
@@ -42,7 +42,11 @@ const PaymentResult = () => {
                 dbStatus === 'Paid' || expectedStatus === 'Paid' || parseInt(momoResultCode) === 0;
 
               if (!isSynced && !isSuccess) {
-                setTimeout(() => verifyPaymentStatus(), 2000);
+                // Wait on the server for the IPN to land instead of polling every 2s
+                paymentAPI
+                  .waitForPaymentUpdate(verifyResponse.orderId || momoOrderId, verifyResponse.paymentStatus)
+                  .then(() => verifyPaymentStatus())
+                  .catch(() => setTimeout(() => verifyPaymentStatus(), 2000));
                 setPaymentStatus({
                   isSuccess: false,
                   isMomo: true,
@@ -1,8 +1,14 @@
-import React from 'react';
+import React, { useEffect, useState } from 'react';
 import { useSearchParams, useNavigate } from 'react-router-dom';
 import Navbar from '../components/Navbar';
 import Footer from '../components/Footer';
 import '../styles/PaymentResult.css';
+import { paymentAPI, parseRetryAfter } from '../services/api';
+
+const FOLLOW_BASE_DELAY_MS = 1000;
+const FOLLOW_MAX_DELAY_MS = 30000;
+// A long-poll that lasted this long was held by the server, not turned away
+const FOLLOW_HELD_MS = 5000;
 
 const PaymentSuccess = () => {
   const [searchParams] = useSearchParams();
@@ -39,6 +45,55 @@ const PaymentSuccess = () => {
 
   const isCod = method?.toLowerCase() === 'cod';
 
+  // The gateway redirect can arrive before its IPN: follow the order until the payment is final
+  const [paymentState, setPaymentState] = useState(null);
+
+  useEffect(() => {
+    if (!orderId || isCod) return undefined;
+    const controller = new AbortController();
+    let timer = null;
+    let misses = 0;
+
+    // Re-poll right away after a change or a full long-poll; back off while the server answers
+    // at once without news (busy) or fails, and never sooner than its Retry-After.
+    const next = (since, retryAfter, immediate) => {
+      misses = immediate ? 0 : misses + 1;
+      const backoff = immediate ? 0 : Math.min(FOLLOW_MAX_DELAY_MS, FOLLOW_BASE_DELAY_MS * 2 ** (misses - 1));
+      const delay = Math.max(backoff, (retryAfter ?? 0) * 1000);
+      timer = setTimeout(() => follow(since), delay);
+    };
+
+    const follow = async (since) => {
+      const startedAt = Date.now();
+      try {
+        const state = await paymentAPI.waitForPaymentUpdate(orderId, since, undefined, { signal: controller.signal });
+        if (controller.signal.aborted) return;
+        setPaymentState(state);
+        const held = Date.now() - startedAt >= FOLLOW_HELD_MS;
+        if (!state.final) next(state.paymentStatus, state.retryAfter, state.changed || held);
+      } catch (err) {
+        if (controller.signal.aborted) return;
+        const status = err.response?.status;
+        if (status === 401 || status === 403 || status === 404) return;
+        console.error('❌ Error following payment status:', err);
+        next(since, parseRetryAfter(err.response?.headers), false);
+      }
+    };
+
+    follow();
+    return () => {
+      controller.abort();
+      clearTimeout(timer);
+    };
+  }, [orderId, isCod]);
+
+  const paymentStatusLabels = {
+    Paid: 'Đã thanh toán',
+    Pending: 'Đang xác nhận...',
+    Failed: 'Thanh toán thất bại',
+    Expired: 'Đã hết hạn',
+  };
+
   return (
     <div className="payment-result">
       <Navbar />
@@ -78,6 +133,14 @@ const PaymentSuccess = () => {
                         <td className="text-end font-monospace">{orderId}</td>
                       </tr>
                     )}
+                    {!isCod && paymentState && (
+                      <tr className="border-bottom">
+                        <td className="fw-semibold text-muted">Trạng thái:</td>
+                        <td className={`text-end ${paymentState.paymentStatus === 'Paid' ? 'text-success' : 'text-warning'}`}>
+                          {paymentStatusLabels[paymentState.paymentStatus] || paymentState.paymentStatus}
+                        </td>
+                      </tr>
+                    )}
                     {!isCod && transactionNo && (
                       <tr className="border-bottom">
                         <td className="fw-semibold text-muted">Số tham chiếu:</td>
@@ -26,6 +26,25 @@ api.interceptors.request.use(
   }
 );
 
+// Idempotency keys let the backend replay the first response when a request is retried,
+// so a double click or network retry never creates a second order or payment.
+export const newIdempotencyKey = () =>
+  (typeof crypto !== 'undefined' && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+const idempotencyHeaders = (key) => (key ? { headers: { 'Idempotency-Key': key } } : undefined);
+
+// Retry-After in seconds (delta-seconds or HTTP date), or null when absent
+export const parseRetryAfter = (headers) => {
+  const value = headers?.['retry-after'];
+  if (!value) return null;
+  const seconds = Number(value);
+  if (Number.isFinite(seconds)) return Math.max(0, seconds);
+  const date = Date.parse(value);
+  return Number.isNaN(date) ? null : Math.max(0, (date - Date.now()) / 1000);
+};
+
 // Response interceptor for error handling
 // Keep 401 errors for callers to handle so we can show a meaningful message
 // instead of abruptly clearing storage and redirecting.
@@ -247,9 +266,9 @@ export const ordersAPI = {
     }
   },
 
-  createOrder: async (orderData) => {
+  createOrder: async (orderData, idempotencyKey) => {
     try {
-      const response = await api.post('/api/orders', orderData);
+      const response = await api.post('/api/orders', orderData, idempotencyHeaders(idempotencyKey));
       return response.data;
     } catch (error) {
       console.warn('Orders API unavailable, mocking order creation.');
@@ -280,8 +299,9 @@ export const ordersAPI = {
     }
   },
 
-  reorder: async (orderId) => {
-    const response = await api.post(`/api/orders/${orderId}/reorder`);
+  // mode: 'replace' (default) swaps the cart for the order, 'merge' adds to it
+  reorder: async (orderId, mode = 'replace') => {
+    const response = await api.post(`/api/orders/${orderId}/reorder`, { mode });
     return response.data;
   },
 
@@ -296,11 +316,11 @@ export const ordersAPI = {
 // ========== PAYMENT APIs ==========
 
 export const paymentAPI = {
-  createVnpayPayment: async (payload) => {
+  createVnpayPayment: async (payload, idempotencyKey) => {
     try {
       console.log("🔗 API: POST /api/payment/vnpay/create", payload);
       // Đây là endpoint tạo URL thanh toán VNPAY từ backend
-      const response = await api.post('/api/payment/vnpay/create', payload);
+      const response = await api.post('/api/payment/vnpay/create', payload, idempotencyHeaders(idempotencyKey));
       console.log("✅ VNPAY Payment URL received:", response.data);
       return response.data;
     } catch (error) {
@@ -309,11 +329,11 @@ export const paymentAPI = {
     }
   },
 
-  createMomoPayment: async (payload) => {
+  createMomoPayment: async (payload, idempotencyKey) => {
     try {
       console.log("🔗 API: POST /api/payment/momo", payload);
       // Endpoint tạo URL thanh toán MoMo từ backend
-      const response = await api.post('/api/payment/momo', payload);
+      const response = await api.post('/api/payment/momo', payload, idempotencyHeaders(idempotencyKey));
       console.log("✅ MoMo Payment URL received:", response.data);
       return response.data;
     } catch (error) {
@@ -335,6 +355,20 @@ export const paymentAPI = {
       // Don't throw - let caller handle gracefully with fallback
       throw error;
     }
+  },
+
+  // Long-poll: the backend holds the request until the payment status differs from `since`
+  // (IPN processed, reconciliation, expiry) or `timeout` seconds pass (changed: false).
+  // `retryAfter` carries the server's Retry-After (seconds) when it answered without waiting.
+  waitForPaymentUpdate: async (orderId, since, timeout = 25, { signal } = {}) => {
+    const params = { timeout };
+    if (since) params.since = since;
+    const response = await api.get(`/api/orders/${orderId}/payment-events`, {
+      params,
+      signal,
+      timeout: (timeout + 10) * 1000
+    });
+    return { ...response.data, retryAfter: parseRetryAfter(response.headers) };
   }
 };
 